@@ -0,0 +1,132 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Teams alerts sent in the background, so that raising one never holds up
+detection, with repeated alerts coalesced into a single card.
+"""
+import copy
+import logging
+import threading
+import time
+from functools import partial
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from autoreduce_run_detection.api import LazySession, create_session, post_with_retries
+from autoreduce_run_detection.settings import ALERT_WINDOW, ALERT_TIMEOUT
+
+if TYPE_CHECKING:
+    import requests
+
+LOGGING = logging.getLogger(__package__)
+
+TEAMS_CARD_DATA = {
+    "@context": "https://schema.org/extensions",
+    "@type": "MessageCard",
+    "themeColor": "0072C6",
+    "title": "Alert Raised",
+    "text": "",
+    "potentialAction": []
+}
+
+
+class PendingAlert:
+    """
+    Alerts of one instrument and error class raised since its last card was sent
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.count = 0
+        self.sent_at: Optional[float] = None
+
+
+class AlertDispatcher(threading.Thread):
+    """
+    Sends alerts to a Teams channel from a background thread. The first
+    alert of an instrument and error class is sent straight away, any more
+    within ALERT_WINDOW seconds are sent as a single card once it has passed.
+    """
+
+    def __init__(self, url: str, session: Optional["requests.Session"] = None, window: float = ALERT_WINDOW):
+        super().__init__(name="alert-dispatcher", daemon=True)
+        self.url = url
+        self.session = session if session is not None else LazySession(partial(create_session, pool_size=1))
+        self.window = window
+        self._pending: Dict[Tuple[str, str], PendingAlert] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def alert(self, instrument: str, error_class: str, text: str):
+        """
+        Queue an alert without waiting for it to be sent
+
+        Args:
+            instrument: Instrument the alert is about
+            error_class: Kind of failure, alerts are coalesced per instrument and error class
+            text: Text of the card
+        """
+        with self._lock:
+            pending = self._pending.setdefault((instrument, error_class), PendingAlert())
+            pending.text = text
+            pending.count += 1
+        self._wake.set()
+
+    def flush(self, force: bool = False):
+        """
+        Send a card for every instrument and error class whose window has passed
+
+        Args:
+            force: Send every queued alert regardless of its window
+        """
+        now = time.monotonic()
+        cards = []
+        with self._lock:
+            for key, pending in list(self._pending.items()):
+                due = force or pending.sent_at is None or now - pending.sent_at >= self.window
+                if pending.count and due:
+                    text = pending.text
+                    if pending.count > 1:
+                        text += f" ({pending.count} failures in the last {self.window:g}s)"
+                    cards.append(text)
+                    pending.count = 0
+                    pending.sent_at = now
+                elif not pending.count and due:
+                    del self._pending[key]
+        for text in cards:
+            self._send(text)
+
+    def _send(self, text: str):
+        import requests  # pylint:disable=import-outside-toplevel,redefined-outer-name
+
+        data = copy.deepcopy(TEAMS_CARD_DATA)
+        data["text"] = text
+        try:
+            response = post_with_retries(self.session, self.url, retries=0, timeout=ALERT_TIMEOUT, json=data)
+            if response.status_code >= 400:
+                LOGGING.error("Teams rejected alert with status code %i: %s", response.status_code, text)
+        except requests.exceptions.RequestException:
+            LOGGING.error("Failed to send message using this TEAMS url: %s", self.url)
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.flush()
+            except Exception:  # pylint:disable=broad-except
+                LOGGING.exception("Sending alerts failed")
+            # Wake up for new alerts, and regularly for alerts waiting for their window to pass
+            self._wake.wait(min(self.window, 1.0))
+            self._wake.clear()
+
+    def stop(self):
+        """
+        Stop the background thread and send any alerts still queued
+        """
+        self._stopping.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join()
+        self.flush(force=True)
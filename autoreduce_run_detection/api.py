@@ -0,0 +1,196 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+HTTP access to the autoreduce API through a pooled keep-alive session,
+retrying transient failures with jittered exponential backoff, and a
+circuit breaker to stop sending requests while the API is down.
+"""
+import logging
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+from autoreduce_run_detection.settings import (API_CONNECT_TIMEOUT, API_READ_TIMEOUT, API_RETRIES, API_BACKOFF,
+                                               API_BACKOFF_MAX, POLL_WORKERS, CIRCUIT_FAILURES, CIRCUIT_RESET_TIMEOUT)
+
+if TYPE_CHECKING:
+    import requests
+
+# requests takes longer to import than a --once invocation with nothing new takes to run,
+# so it is only imported once a request is made
+
+LOGGING = logging.getLogger(__package__)
+
+
+def create_session(pool_size: int = POLL_WORKERS) -> "requests.Session":
+    """
+    Create a session whose connections are kept alive and shared between
+    the instruments polled concurrently
+
+    Args:
+        pool_size: Maximum number of connections kept open to each host
+    """
+    # pylint:disable=import-outside-toplevel,redefined-outer-name
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class LazySession:
+    """
+    Stands in for a session, creating it with `factory` when the first
+    request is made, so that invocations with nothing to submit never
+    import the HTTP stack
+    """
+
+    def __init__(self, factory: Callable[[], "requests.Session"] = create_session):
+        self.factory = factory
+        self._session: Optional["requests.Session"] = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> "requests.Session":
+        """
+        The session, created on first use
+        """
+        with self._lock:
+            if self._session is None:
+                self._session = self.factory()
+            return self._session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def close(self):
+        """
+        Close the session if it has been created
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Seconds to wait before retrying, chosen at random up to an exponentially
+    growing limit so that instruments failing together don't retry together
+    """
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF * 2**attempt))
+
+
+def post_with_retries(session: Optional["requests.Session"],
+                      url: str,
+                      retries: Optional[int] = None,
+                      **kwargs) -> "requests.Response":
+    """
+    POST to the API, retrying connection errors and 5xx responses
+
+    Args:
+        session: Session to send the request with, a new connection is used if None
+        url: URL to POST to
+        retries: Number of retries after the first attempt, API_RETRIES if not given
+        kwargs: Passed on to the session's post
+    Returns:
+        The response, which is the last 5xx response if the retries are used up
+    Raises:
+        requests.exceptions.RequestException: If the request failed and can't be retried
+    """
+    import requests  # pylint:disable=import-outside-toplevel,redefined-outer-name
+
+    # A read timeout is not retried, the API may have accepted the runs before the response was lost
+    retried_exceptions = (requests.exceptions.ConnectionError, )
+    if retries is None:
+        retries = API_RETRIES
+    kwargs.setdefault("timeout", (API_CONNECT_TIMEOUT, API_READ_TIMEOUT))
+    sender = session if session is not None else requests
+    attempt = 0
+    while True:
+        try:
+            response = sender.post(url, **kwargs)
+            if response.status_code < 500 or attempt >= retries:
+                return response
+            reason = f"status code {response.status_code}"
+        except retried_exceptions as err:
+            if attempt >= retries:
+                raise
+            reason = str(err)
+        delay = backoff_delay(attempt)
+        attempt += 1
+        LOGGING.warning("Retrying POST to %s in %.2fs (attempt %i of %i) after %s", url, delay, attempt, retries,
+                        reason)
+        time.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failed requests, after which requests
+    are refused straight away. Every `reset_timeout` seconds one request is
+    let through as a probe; the circuit closes again once a request succeeds.
+    """
+
+    def __init__(self, failures: int = CIRCUIT_FAILURES, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """
+        Whether requests are currently being refused
+        """
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent. While the circuit is open only one
+        request is allowed every `reset_timeout` seconds.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            # Let this request probe the API, and no other until the next timeout
+            self._opened_at = now
+            return True
+
+    def record_success(self):
+        """
+        Record a request that reached the API, closing the circuit
+        """
+        with self._lock:
+            if self._opened_at is not None:
+                LOGGING.info("Autoreduce API is available again, resuming submissions")
+            self._consecutive = 0
+            self._opened_at = None
+
+    def record_failure(self) -> bool:
+        """
+        Record a request that failed to reach the API
+
+        Returns:
+            True if this failure opened the circuit
+        """
+        with self._lock:
+            self._consecutive += 1
+            if self._opened_at is not None:
+                self._opened_at = time.monotonic()
+                return False
+            if self.failures <= 0 or self._consecutive < self.failures:
+                return False
+            self._opened_at = time.monotonic()
+        LOGGING.error("Autoreduce API failed %i times in a row, pausing submissions for %ss", self._consecutive,
+                      self.reset_timeout)
+        return True
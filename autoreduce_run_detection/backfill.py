@@ -0,0 +1,166 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Submission of past runs of an instrument again, e.g. to reprocess a cycle,
+at a limited rate and resuming where an interrupted backfill stopped.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Set, Tuple
+
+from autoreduce_run_detection.data_index import from_ranges, to_ranges
+from autoreduce_run_detection.settings import BACKFILL_RATE, BACKFILL_WORKERS, SUBMIT_CHUNK_SIZE
+
+LOGGING = logging.getLogger(__package__)
+
+
+def run_range(value: str) -> Tuple[int, int]:
+    """
+    Parse a run range given on the command line, e.g. 44700-44750 or 44700
+    """
+    first, _, last = value.partition("-")
+    try:
+        return int(first), int(last or first)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"expected a run range such as 44700-44750, got '{value}'") from err
+
+
+class RateLimiter:
+    """
+    Spaces out calls from any number of threads to at most `rate` per second, unlimited if not positive
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait for the next free slot
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class BackfillCheckpoint:
+    """
+    The runs of a backfill and those already acknowledged, kept as ranges in
+    a JSON file that is replaced after each acknowledged chunk
+    """
+
+    def __init__(self, location: str, runs: Set[int]):
+        self.location = location
+        self.runs = set(runs)
+        self.done: Set[int] = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, location: str, runs: Set[int]) -> "BackfillCheckpoint":
+        """
+        Load the progress of an earlier attempt at the same backfill, if any
+        """
+        checkpoint = cls(location, runs)
+        try:
+            with open(location, mode='r', encoding="utf-8") as checkpoint_file:
+                saved = json.load(checkpoint_file)
+            checkpoint.done = from_ranges(saved["done"]) & checkpoint.runs
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            if os.path.exists(location):
+                LOGGING.warning("Ignoring unreadable backfill checkpoint %s: %s", location, err)
+        return checkpoint
+
+    def remaining(self) -> Set[int]:
+        """
+        Runs not yet acknowledged
+        """
+        with self._lock:
+            return self.runs - self.done
+
+    def mark_done(self, start_run: int, end_run: int):
+        """
+        Record runs start_run up to but not including end_run as acknowledged
+        """
+        with self._lock:
+            self.done.update(range(start_run, end_run))
+            saved = {"runs": to_ranges(self.runs), "done": to_ranges(self.done)}
+            temporary = f"{self.location}.tmp"
+            with open(temporary, mode='w', encoding="utf-8") as checkpoint_file:
+                json.dump(saved, checkpoint_file)
+            os.replace(temporary, self.location)
+
+    def discard(self):
+        """
+        Remove the checkpoint of a finished backfill, so the same runs can be backfilled again
+        """
+        try:
+            os.remove(self.location)
+        except FileNotFoundError:
+            pass
+
+
+def backfill_chunks(runs: Set[int]) -> List[Tuple[int, int]]:
+    """
+    Split runs into (start_run, end_run) chunks of consecutive runs, at most SUBMIT_CHUNK_SIZE long
+    """
+    chunks = []
+    for first, last in to_ranges(runs):
+        for start_run in range(first, last + 1, SUBMIT_CHUNK_SIZE):
+            chunks.append((start_run, min(start_run + SUBMIT_CHUNK_SIZE, last + 1)))
+    return chunks
+
+
+def run_backfill(checkpoint: BackfillCheckpoint,
+                 submit: Callable[[int, int], object],
+                 rate: float = BACKFILL_RATE,
+                 workers: int = BACKFILL_WORKERS) -> bool:
+    """
+    Submit the runs of a backfill that haven't been acknowledged yet, in
+    parallel but starting at most `rate` submissions per second. A chunk
+    that fails is left for the next attempt without stopping the others.
+
+    Args:
+        checkpoint: Runs to submit and the progress of earlier attempts
+        submit: Submits runs start_run up to but not including end_run, raising if they are not acknowledged
+        rate: Maximum submissions started per second
+        workers: Number of submissions made concurrently
+    Returns:
+        True once every run has been acknowledged
+    """
+    remaining = checkpoint.remaining()
+    chunks = backfill_chunks(remaining)
+    LOGGING.info("Backfilling %i runs in %i chunks, %i already submitted", len(remaining), len(chunks),
+                 len(checkpoint.runs) - len(remaining))
+    limiter = RateLimiter(rate)
+
+    def _submit(chunk: Tuple[int, int]):
+        limiter.acquire()
+        try:
+            submit(*chunk)
+        except Exception as err:  # pylint:disable=broad-except
+            LOGGING.error("Backfill of runs %i - %i failed: %s", chunk[0], chunk[1] - 1, err)
+            return
+        checkpoint.mark_done(*chunk)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(_submit, chunks))
+
+    remaining = checkpoint.remaining()
+    if remaining:
+        LOGGING.error("Backfill incomplete, %i runs were not submitted. Run it again to resume.", len(remaining))
+        return False
+    LOGGING.info("Backfill complete, %i runs submitted", len(checkpoint.runs))
+    checkpoint.discard()
+    return True
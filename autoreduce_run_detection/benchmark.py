@@ -0,0 +1,545 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Benchmark of run detection against a synthetic ISIS archive and a stub
+autoreduce API, e.g.
+
+    python -m autoreduce_run_detection.benchmark --instruments 300 --cycles 50 --api-latency 0.05
+
+Reports cycle latency percentiles, submission throughput and peak memory so
+that changes can be compared over time. With --startup it instead times cold
+starts, the import of run detection and whole --once invocations in which no
+instrument has changed, as made by cron.
+"""
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence
+
+from autoreduce_run_detection import run_detection
+from autoreduce_run_detection.services import ContextOptions
+from autoreduce_run_detection.stat_cache import StatCache
+
+LOGGING = logging.getLogger(__package__)
+
+
+def instrument_names(count: int) -> List[str]:
+    """
+    Distinct synthetic instrument names, BENCH0, BENCH1, ...
+    """
+    return [f"BENCH{index}" for index in range(count)]
+
+
+def summary_record(instrument: str, run: int) -> str:
+    """
+    A summary.txt record in the fixed width layout written by the instruments
+    """
+    return (f"{instrument[:3]}{run % 100000:05d}{'Bench,User':<17}{f'Benchmark run {run}':<24}"
+            f"01-JAN-2022 00:00:00{1.0:>8} {1000000 + run % 1000}\n")
+
+
+class SyntheticArchive:
+    """
+    A /isis/NDX<instrument>/Instrument tree under `root`, with a lastrun.txt,
+    journal/summary.txt and data/cycle_bench directory for each instrument.
+    Instruments start from `first_run` unless given in `first_runs`.
+    """
+
+    def __init__(self,
+                 root: str,
+                 instruments: Sequence[str],
+                 first_run: int = 1000,
+                 first_runs: Optional[Dict[str, int]] = None):
+        self.root = root
+        self.instruments = list(instruments)
+        self.last_runs = {instrument: (first_runs or {}).get(instrument, first_run) for instrument in self.instruments}
+        for instrument in self.instruments:
+            for directory in (self._logs(instrument, "journal"), self._data_dir(instrument)):
+                os.makedirs(directory, exist_ok=True)
+            self._write_last_run(instrument)
+            with open(self._summary_file(instrument), mode='w', encoding="utf-8"):
+                pass
+
+    def _logs(self, instrument: str, *parts: str) -> str:
+        return os.path.join(self.root, f"NDX{instrument}", "Instrument", "logs", *parts)
+
+    def _data_dir(self, instrument: str) -> str:
+        return os.path.join(self.root, f"NDX{instrument}", "Instrument", "data", "cycle_bench")
+
+    def _summary_file(self, instrument: str) -> str:
+        return self._logs(instrument, "journal", "summary.txt")
+
+    def _write_last_run(self, instrument: str):
+        # Replaced by a rename, as the instrument control software does
+        location = self._logs(instrument, "lastrun.txt")
+        with open(f"{location}.tmp", mode='w', encoding="utf-8") as last_run:
+            last_run.write(f"{instrument} {self.last_runs[instrument]:08d} 0 \n")
+        os.replace(f"{location}.tmp", location)
+
+    def rows(self) -> List[List[str]]:
+        """
+        Last runs CSV rows pointing at the archive
+        """
+        return [[
+            instrument,
+            str(self.last_runs[instrument]),
+            self._logs(instrument, "lastrun.txt"),
+            self._summary_file(instrument),
+            os.path.dirname(self._data_dir(instrument)), ".nxs"
+        ] for instrument in self.instruments]
+
+    def write_csv(self, csv_name: str):
+        """
+        Write the last runs CSV file for the current state of the archive
+        """
+        with open(csv_name, mode='w', encoding="utf-8", newline='') as csv_file:
+            csv.writer(csv_file).writerows(self.rows())
+
+    def end_run(self, instrument: str, count: int = 1):
+        """
+        End `count` runs on an instrument: write their data files and summary
+        records, then advance its lastrun.txt
+        """
+        first = self.last_runs[instrument] + 1
+        with open(self._summary_file(instrument), mode='a', encoding="utf-8") as summary:
+            for run in range(first, first + count):
+                summary.write(summary_record(instrument, run))
+                with open(os.path.join(self._data_dir(instrument), f"{instrument}{run:08d}.nxs"), mode='wb'):
+                    pass
+        self.last_runs[instrument] = first + count - 1
+        self._write_last_run(instrument)
+
+    def set_last_run(self, instrument: str, run: Optional[int]):
+        """
+        Bring an instrument to `run`, ending the runs up to it, or write a
+        lastrun.txt that can't be read when `run` is None
+
+        Returns:
+            The location of the instrument's lastrun.txt
+        """
+        if run is None:
+            location = self._logs(instrument, "lastrun.txt")
+            with open(f"{location}.tmp", mode='w', encoding="utf-8") as last_run:
+                last_run.write("\n")
+            os.replace(f"{location}.tmp", location)
+        elif run > self.last_runs[instrument]:
+            self.end_run(instrument, run - self.last_runs[instrument])
+        else:
+            # Run numbers going back or an unreadable lastrun.txt being written again
+            self.last_runs[instrument] = run
+            self._write_last_run(instrument)
+        return self._logs(instrument, "lastrun.txt")
+
+
+class RunSimulator:
+    """
+    Ends runs on the archive's instruments as a Poisson process, with a mean
+    of `runs_per_hour` runs on each instrument
+    """
+
+    def __init__(self, archive: SyntheticArchive, runs_per_hour: float = 20, seed: Optional[int] = None):
+        self.archive = archive
+        self.runs_per_hour = runs_per_hour
+        self._random = random.Random(seed)
+
+    def _arrivals(self, seconds: float) -> int:
+        if self.runs_per_hour <= 0:
+            return 0
+        arrivals = 0
+        elapsed = self._random.expovariate(self.runs_per_hour / 3600)
+        while elapsed < seconds:
+            arrivals += 1
+            elapsed += self._random.expovariate(self.runs_per_hour / 3600)
+        return arrivals
+
+    def advance(self, seconds: float) -> int:
+        """
+        Simulate `seconds` of beam time
+
+        Returns:
+            The number of runs ended
+        """
+        ended = 0
+        for instrument in self.archive.instruments:
+            count = self._arrivals(seconds)
+            if count:
+                self.archive.end_run(instrument, count)
+                ended += count
+        return ended
+
+
+class StubReductionAPI:
+    """
+    Local stand-in for the autoreduce API's /runs/<instrument> endpoint. Each
+    request is answered after `latency` seconds (plus up to `jitter` more), or
+    after one of `latencies` picked at random, and fails with a 503 with a
+    probability of `error_rate`. The runs accepted are counted by instrument.
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 seed: Optional[int] = None,
+                 latencies: Optional[Sequence[float]] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.latencies = list(latencies or [])
+        self.requests = 0
+        self.errors = 0
+        self.runs_received = 0
+        # (instrument, run) -> number of times it was accepted
+        self.received: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive as the API does, so the session's connection pool is exercised
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):  # pylint:disable=invalid-name
+                """
+                Accept a submission of runs
+                """
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                api.handle(self, body)
+
+            def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler, bind_and_activate=False)
+        # Every poll worker may connect at once, more than the default backlog of 5
+        self._server.request_queue_size = 128
+        self._server.server_bind()
+        self._server.server_activate()
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05, ), name="stub-api", daemon=True)
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL to use as AUTOREDUCE_API_URL
+        """
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api"
+
+    def handle(self, handler: BaseHTTPRequestHandler, body: bytes):
+        """
+        Answer one request, after the injected latency
+        """
+        with self._lock:
+            self.requests += 1
+            if self.latencies:
+                delay = self._random.choice(self.latencies)
+            else:
+                delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+        time.sleep(delay)
+        if not handler.path.startswith("/api/runs/"):
+            status = 404
+        elif fail:
+            status = 503
+        else:
+            status = 200
+            payload = json.loads(body or b"{}")
+            runs = payload["runs"] if "runs" in payload else range(payload["start"], payload["end"] + 1)
+            instrument = handler.path[len("/api/runs/"):]
+            with self._lock:
+                self.runs_received += len(runs)
+                self.received.update((instrument, run) for run in runs)
+        if status != 200:
+            with self._lock:
+                self.errors += 1
+        response = json.dumps({"status": status}).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(response)))
+        handler.end_headers()
+        handler.wfile.write(response)
+
+    def start(self):
+        """
+        Start serving in the background
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving and release the port
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class SlowMountStatCache(StatCache):
+    """
+    Stat cache that delays every lastrun.txt read by `latency` seconds, as on a slow archive mount
+    """
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    def read(self, path: str, reader: Callable[[], List[str]]) -> List[str]:
+        time.sleep(self.latency)
+        return super().read(path, reader)
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of the values, e.g. fraction=0.95 for the 95th percentile
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def peak_memory_mb() -> float:
+    """
+    Peak resident set size of the process in MiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KiB elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(  # pylint:disable=too-many-arguments
+        *,
+        instruments: int = 30,
+        cycles: int = 20,
+        mode: str = "once",
+        simulated_interval: float = 15,
+        runs_per_hour: float = 20,
+        api_latency: float = 0.0,
+        api_jitter: float = 0.0,
+        api_error_rate: float = 0.0,
+        read_latency: float = 0.0,
+        seed: Optional[int] = 0) -> Dict[str, float]:
+    """
+    Run detection cycles against a synthetic archive and a stub API
+
+    Args:
+        instruments: Number of instruments in the archive
+        cycles: Number of detection cycles to time
+        mode: "once" for an update_last_runs invocation per cycle, as with --once,
+              or "daemon" to reuse a RunDetectionDaemon between cycles
+        simulated_interval: Seconds of beam time simulated between cycles
+        runs_per_hour: Mean rate of runs ending on each instrument
+        api_latency: Seconds taken by the stub API to answer each request
+        api_jitter: Up to this many more seconds are added at random to each answer
+        api_error_rate: Fraction of requests answered with a 503
+        read_latency: Seconds added to every lastrun.txt read
+        seed: Seed of the simulator and stub API, for repeatable runs
+    Returns:
+        The report of the benchmark
+    """
+    # pylint:disable=too-many-locals
+    api = StubReductionAPI(api_latency, api_jitter, api_error_rate, seed)
+    api.start()
+    durations = []
+    runs_ended = 0
+    with tempfile.TemporaryDirectory() as root:
+        archive = SyntheticArchive(os.path.join(root, "isis"), instrument_names(instruments))
+        simulator = RunSimulator(archive, runs_per_hour, seed)
+        csv_name = os.path.join(root, "last_runs.csv")
+        archive.write_csv(csv_name)
+        options = ContextOptions(api_url=api.url,
+                                 alerts=False,
+                                 stat_cache=SlowMountStatCache(read_latency) if read_latency > 0 else None)
+        daemon = run_detection.RunDetectionDaemon(csv_name, options=options) if mode == "daemon" else None
+        try:
+            for _ in range(cycles):
+                runs_ended += simulator.advance(simulated_interval)
+                start = time.perf_counter()
+                if daemon is not None:
+                    daemon.run_cycle()
+                else:
+                    run_detection.update_last_runs(csv_name, options=options)
+                durations.append(time.perf_counter() - start)
+        finally:
+            if daemon is not None:
+                daemon.context.close()
+    api.stop()
+
+    total = sum(durations)
+    return {
+        "instruments": instruments,
+        "cycles": cycles,
+        "cycle_p50": percentile(durations, 0.5),
+        "cycle_p95": percentile(durations, 0.95),
+        "cycle_p99": percentile(durations, 0.99),
+        "cycle_max": max(durations, default=0.0),
+        "runs_ended": runs_ended,
+        "runs_submitted": api.runs_received,
+        "api_requests": api.requests,
+        "api_errors": api.errors,
+        "runs_per_second": api.runs_received / total if total else 0.0,
+        "instruments_per_second": instruments * cycles / total if total else 0.0,
+        "peak_memory_mb": peak_memory_mb()
+    }
+
+
+def import_times(stderr: str) -> Dict[str, float]:
+    """
+    Cumulative seconds taken to import each module, from the output of python -X importtime
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            _, cumulative, module = line.split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def run_startup_benchmark(instruments: int = 30, repeats: int = 5) -> Dict[str, float]:
+    """
+    Time fresh interpreters importing run detection and making --once
+    invocations in which no instrument has changed
+
+    Args:
+        instruments: Number of instruments in the archive
+        repeats: Number of imports and invocations to time
+    Returns:
+        The report of the benchmark
+    """
+    import_durations = []
+    once_durations = []
+    http_imported = False
+    with tempfile.TemporaryDirectory() as root:
+        archive = SyntheticArchive(os.path.join(root, "isis"), instrument_names(instruments))
+        archive.write_csv(os.path.join(root, "last_runs.csv"))
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = {
+            **os.environ, "AUTOREDUCTION_USERDIR": root,
+            "PYTHONPATH": os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")]))
+        }
+        for _ in range(repeats):
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", "import autoreduce_run_detection.run_detection"],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True)
+            import_durations.append(import_times(result.stderr)["autoreduce_run_detection.run_detection"])
+
+            start = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-m", "autoreduce_run_detection.run_detection", "--once"],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True)
+            once_durations.append(time.perf_counter() - start)
+            # Nothing has changed, so nothing should have been submitted
+            http_imported = http_imported or "requests" in import_times(result.stderr)
+
+    return {
+        "instruments": instruments,
+        "repeats": repeats,
+        "import_p50": percentile(import_durations, 0.5),
+        "import_max": max(import_durations, default=0.0),
+        "once_p50": percentile(once_durations, 0.5),
+        "once_max": max(once_durations, default=0.0),
+        "http_imported": http_imported
+    }
+
+
+def format_startup_report(report: Dict[str, float]) -> str:
+    """
+    Human readable form of a startup benchmark report
+    """
+    return "\n".join([
+        f"{report['instruments']} instruments, {report['repeats']} cold starts",
+        f"import: p50 {report['import_p50']:.4f}s  max {report['import_max']:.4f}s",
+        f"--once with no new runs: p50 {report['once_p50']:.4f}s  max {report['once_max']:.4f}s",
+        f"HTTP stack imported: {'yes' if report['http_imported'] else 'no'}",
+    ])
+
+
+def format_report(report: Dict[str, float]) -> str:
+    """
+    Human readable form of a benchmark report
+    """
+    return "\n".join([
+        f"{report['instruments']} instruments, {report['cycles']} cycles",
+        f"cycle latency: p50 {report['cycle_p50']:.4f}s  p95 {report['cycle_p95']:.4f}s  "
+        f"p99 {report['cycle_p99']:.4f}s  max {report['cycle_max']:.4f}s",
+        f"throughput: {report['runs_per_second']:.1f} runs/s, "
+        f"{report['instruments_per_second']:.1f} instrument polls/s",
+        f"runs: {report['runs_ended']} ended, {report['runs_submitted']} submitted in {report['api_requests']} "
+        f"requests ({report['api_errors']} failed)",
+        f"peak memory: {report['peak_memory_mb']:.1f} MiB",
+    ])
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Benchmark entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--instruments", type=int, default=30, help="Number of synthetic instruments")
+    parser.add_argument("--cycles",
+                        type=int,
+                        default=20,
+                        help="Number of detection cycles to time, or cold starts with --startup")
+    parser.add_argument("--mode",
+                        choices=["once", "daemon"],
+                        default="once",
+                        help="Run each cycle as a --once invocation or in a resident daemon")
+    parser.add_argument("--simulated-interval",
+                        type=float,
+                        default=15,
+                        help="Seconds of beam time simulated between cycles")
+    parser.add_argument("--runs-per-hour", type=float, default=20, help="Mean rate of runs ending per instrument")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds taken by the stub API to answer")
+    parser.add_argument("--api-jitter", type=float, default=0.0, help="Random extra seconds added to each answer")
+    parser.add_argument("--api-error-rate", type=float, default=0.0, help="Fraction of requests answered with a 503")
+    parser.add_argument("--read-latency", type=float, default=0.0, help="Seconds added to every lastrun.txt read")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the simulation")
+    parser.add_argument("--startup",
+                        action="store_true",
+                        help="Time the import and --once invocations of run detection in fresh interpreters")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON, e.g. to keep for comparison")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        report = run_startup_benchmark(instruments=args.instruments, repeats=args.cycles)
+        print(json.dumps(report, indent=2) if args.json else format_startup_report(report))
+        return
+
+    # The per-cycle logging of run detection would dominate the timings
+    logging.getLogger(__package__).setLevel(logging.WARNING)
+    report = run_benchmark(instruments=args.instruments,
+                           cycles=args.cycles,
+                           mode=args.mode,
+                           simulated_interval=args.simulated_interval,
+                           runs_per_hour=args.runs_per_hour,
+                           api_latency=args.api_latency,
+                           api_jitter=args.api_jitter,
+                           api_error_rate=args.api_error_rate,
+                           read_latency=args.read_latency,
+                           seed=args.seed)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == '__main__':
+    main()  # pragma: no cover
@@ -0,0 +1,146 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+STOMP client for publishing messages to ActiveMQ or any other STOMP broker
+in transactions that are confirmed with a receipt. Requires stomp.py, which
+is installed with the `stomp` extra.
+"""
+import logging
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import stomp
+from stomp.exception import StompException
+
+LOGGING = logging.getLogger(__package__)
+
+
+class StompError(Exception):
+    """
+    The broker refused a frame
+    """
+
+
+class ReceiptListener(stomp.ConnectionListener):
+    """
+    Wakes a publisher waiting for the broker to confirm a commit, or to report an error instead
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._receipts: Set[str] = set()
+        self._error: Optional[str] = None
+        self._disconnected = False
+
+    def on_receipt(self, headers: Dict[str, str], body: str):
+        with self._condition:
+            self._receipts.add(headers.get("receipt-id"))
+            self._condition.notify_all()
+
+    def on_error(self, headers: Dict[str, str], body: str):
+        with self._condition:
+            self._error = headers.get("message", body)
+            self._condition.notify_all()
+
+    def on_disconnected(self):
+        with self._condition:
+            self._disconnected = True
+            self._condition.notify_all()
+
+    def wait(self, receipt: str, timeout: float):
+        """
+        Wait for the receipt
+
+        Raises:
+            StompError: If the broker reports an error
+            OSError: If the connection closes or the receipt doesn't arrive in time
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: receipt in self._receipts or self._error is not None or self._disconnected, timeout):
+                raise TimeoutError(f"No receipt from the broker within {timeout:g}s")
+            if receipt in self._receipts:
+                self._receipts.discard(receipt)
+                return
+            if self._error is not None:
+                raise StompError(self._error)
+            raise ConnectionError("Connection closed by the broker")
+
+
+class StompClient:
+    """
+    A connection to a STOMP broker, opened when first needed and again after
+    it has failed. Not thread safe, publishes must be serialised by the caller.
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 login: Optional[str] = None,
+                 passcode: Optional[str] = None,
+                 vhost: Optional[str] = None,
+                 timeout: float = 10):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.passcode = passcode
+        self.vhost = vhost or host
+        self.timeout = timeout
+        self._connection: Optional[stomp.Connection12] = None
+        self._listener: Optional[ReceiptListener] = None
+
+    def _connect(self):
+        self._connection = stomp.Connection12([(self.host, self.port)],
+                                              vhost=self.vhost,
+                                              timeout=self.timeout,
+                                              reconnect_attempts_max=1)
+        self._listener = ReceiptListener()
+        self._connection.set_listener("receipts", self._listener)
+        self._connection.connect(self.login, self.passcode, wait=True)
+        LOGGING.info("Connected to STOMP broker %s:%i", self.host, self.port)
+
+    def publish(self, messages: List[Tuple[str, Dict[str, str], bytes]]) -> str:
+        """
+        Send messages in one transaction and wait for the broker to confirm the commit
+
+        Args:
+            messages: Destination, extra headers and body of each message
+        Returns:
+            The identifier of the committed transaction
+        Raises:
+            StompError: If the broker reports an error
+            OSError: If the connection fails or the confirmation times out
+        """
+        try:
+            if self._connection is None:
+                self._connect()
+            transaction = self._connection.begin()
+            for destination, headers, body in messages:
+                self._connection.send(destination, body, headers=headers, transaction=transaction)
+            self._connection.commit(transaction, receipt=transaction)
+            self._listener.wait(transaction, self.timeout)
+            return transaction
+        except StompException as err:
+            # The broker discards a transaction that isn't committed when the connection closes
+            self.close()
+            raise ConnectionError(f"{type(err).__name__}: {err}") from err
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Close the connection, a later publish opens a new one
+        """
+        if self._connection is not None:
+            try:
+                self._connection.disconnect()
+            except (StompException, OSError):
+                pass
+            # Not waiting for the disconnect receipt, which a broken connection would never send
+            self._connection.transport.disconnect_socket()
+        self._connection = None
+        self._listener = None
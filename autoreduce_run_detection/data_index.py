@@ -0,0 +1,248 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Index of the run data files in the instruments' data directories, used to
+hold back runs until their data file has landed in a cycle directory.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from autoreduce_run_detection.settings import DATA_HOLD_TIMEOUT
+
+LOGGING = logging.getLogger(__package__)
+
+CYCLE_PREFIX = "cycle_"
+RUN_FILE_PATTERN = re.compile(r"[A-Za-z]+?0*(\d+)$")
+
+
+def to_ranges(runs: Set[int]) -> List[Tuple[int, int]]:
+    """
+    Compact a set of run numbers into sorted (first, last) ranges
+    """
+    ranges: List[Tuple[int, int]] = []
+    for run in sorted(runs):
+        if ranges and ranges[-1][1] == run - 1:
+            ranges[-1] = (ranges[-1][0], run)
+        else:
+            ranges.append((run, run))
+    return ranges
+
+
+def from_ranges(ranges: List[Tuple[int, int]]) -> Set[int]:
+    """
+    Expand (first, last) ranges back into a set of run numbers
+    """
+    return {run for first, last in ranges for run in range(first, last + 1)}
+
+
+def list_runs(directory: str, file_ext: str) -> Set[int]:
+    """
+    Run numbers of the data files with the given extension in a directory, e.g. 44733 for WISH00044733.nxs
+    """
+    runs = set()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            match = RUN_FILE_PATTERN.match(stem)
+            if ext == file_ext and match is not None:
+                runs.add(int(match.group(1)))
+    return runs
+
+
+class DataDirectoryIndex:
+    """
+    The run data files in the cycle directories of one data directory. A
+    cycle directory is only listed again when its modification time
+    changes, and the data directory itself only when a cycle is added.
+    The cycles are replaced rather than changed in place, so they can be
+    saved while the directory is being refreshed.
+    """
+
+    def __init__(self,
+                 data_dir: str,
+                 file_ext: str,
+                 mtime_ns: int = 0,
+                 cycles: Optional[Dict[str, Tuple[int, List[Tuple[int, int]]]]] = None):
+        self.data_dir = data_dir
+        self.file_ext = file_ext
+        self.mtime_ns = mtime_ns
+        # cycle name -> (mtime_ns, runs)
+        self.cycles: Dict[str, Tuple[int, Set[int]]] = {
+            name: (cycle_mtime, from_ranges(ranges))
+            for name, (cycle_mtime, ranges) in (cycles or {}).items()
+        }
+
+    def refresh(self) -> bool:
+        """
+        Bring the index up to date with the data directory
+
+        Returns:
+            True if anything has changed
+        """
+        changed = False
+        cycles = dict(self.cycles)
+        mtime_ns = os.stat(self.data_dir).st_mtime_ns
+        if mtime_ns != self.mtime_ns:
+            with os.scandir(self.data_dir) as entries:
+                names = {entry.name for entry in entries if entry.name.startswith(CYCLE_PREFIX) and entry.is_dir()}
+            cycles = {name: cycles.get(name, (0, set())) for name in names}
+            changed = True
+        for name, (cycle_mtime, _) in list(cycles.items()):
+            path = os.path.join(self.data_dir, name)
+            try:
+                current_mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                del cycles[name]
+                changed = True
+                continue
+            if current_mtime != cycle_mtime:
+                cycles[name] = (current_mtime, list_runs(path, self.file_ext))
+                changed = True
+        self.cycles, self.mtime_ns = cycles, mtime_ns
+        return changed
+
+    def has_run(self, run: int) -> bool:
+        """
+        Whether the data file of a run is in any cycle directory
+        """
+        return any(run in runs for _, runs in self.cycles.values())
+
+    def to_json(self) -> dict:
+        """
+        Compact form saved between invocations
+        """
+        return {
+            "data_dir": self.data_dir,
+            "file_ext": self.file_ext,
+            "mtime_ns": self.mtime_ns,
+            "cycles": {name: [mtime, to_ranges(runs)]
+                       for name, (mtime, runs) in self.cycles.items()}
+        }
+
+
+class DataIndex:
+    """
+    The data directory indexes of every instrument along with the runs
+    currently held back, persisted between invocations. Each instrument's
+    data directory is read under a lock of its own, so a hung mount only
+    holds up the instrument it belongs to.
+    """
+
+    def __init__(self,
+                 directories: Optional[Dict[str, DataDirectoryIndex]] = None,
+                 held: Optional[Dict[str, Dict[str, float]]] = None,
+                 clock: Callable[[], float] = time.time):
+        self._directories = directories or {}
+        # Current wall clock time, when runs are first held and released
+        self.clock = clock
+        # instrument -> {run: time it was first held}
+        self._held = held or {}
+        # Guards the dictionaries above and _dirty, never held while the archive is read
+        self._lock = threading.Lock()
+        self._instrument_locks: Dict[str, threading.Lock] = {}
+        self._dirty = False
+
+    def _hold(self, instrument: str, directory: DataDirectoryIndex, held: Dict[str, float], start_run: int,
+              end_run: int) -> int:
+        """
+        Hold back the runs from the first one whose data file is missing,
+        recording when each run was first held in `held`
+
+        Returns:
+            The first run to hold back, end_run if every run is ready
+        """
+        now = self.clock()
+        for run in range(start_run, end_run):
+            if directory.has_run(run):
+                continue
+            held_since = held.setdefault(str(run), now)
+            if now - held_since < DATA_HOLD_TIMEOUT:
+                return run
+            LOGGING.warning("Data file of %s run %i still missing after %is, submitting it anyway", instrument, run,
+                            DATA_HOLD_TIMEOUT)
+        return end_run
+
+    def ready_until(self, instrument: str, data_dir: str, file_ext: str, start_run: int, end_run: int) -> int:
+        """
+        Find the first run in start_run up to but not including end_run that
+        must be held back because its data file hasn't landed yet. Runs held
+        for longer than DATA_HOLD_TIMEOUT seconds are released anyway.
+
+        Returns:
+            The first run to hold back, end_run if every run is ready
+        """
+        with self._lock:
+            instrument_lock = self._instrument_locks.setdefault(instrument, threading.Lock())
+        with instrument_lock:
+            with self._lock:
+                directory = self._directories.get(instrument)
+                if directory is None or (directory.data_dir, directory.file_ext) != (data_dir, file_ext):
+                    directory = self._directories[instrument] = DataDirectoryIndex(data_dir, file_ext)
+                previously_held = self._held.get(instrument, {})
+            try:
+                changed = directory.refresh()
+            except OSError as err:
+                LOGGING.warning("Unable to index data directory of %s, not holding runs back: %s", instrument, err)
+                return end_run
+
+            held = dict(previously_held)
+            ready_until = self._hold(instrument, directory, held, start_run, end_run)
+            # Forget runs that are no longer held
+            for run in [run for run in held if int(run) < ready_until]:
+                del held[run]
+            with self._lock:
+                self._held[instrument] = held
+                self._dirty |= changed or held != previously_held
+        if ready_until < end_run:
+            LOGGING.info("Holding runs %i - %i of %s until the data file of run %i lands", ready_until, end_run - 1,
+                         instrument, ready_until)
+        return ready_until
+
+    @classmethod
+    def load(cls, location: str, clock: Callable[[], float] = time.time) -> "DataIndex":
+        """
+        Load the index saved by a previous invocation, or an empty index
+
+        Args:
+            location: Where the index is saved
+            clock: Current wall clock time
+        """
+        try:
+            with open(location, mode='r', encoding="utf-8") as index_file:
+                saved = json.load(index_file)
+            directories = {
+                instrument: DataDirectoryIndex(**directory)
+                for instrument, directory in saved["directories"].items()
+            }
+            held = saved["held"]
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            if os.path.exists(location):
+                LOGGING.warning("Ignoring unreadable data index %s: %s", location, err)
+            directories, held = {}, {}
+        return cls(directories, held, clock)
+
+    def save(self, location: str):
+        """
+        Save the index for the next invocation if it has changed
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            saved = {
+                "directories": {instrument: directory.to_json()
+                                for instrument, directory in self._directories.items()},
+                "held": dict(self._held)
+            }
+        temporary = f"{location}.tmp"
+        with open(temporary, mode='w', encoding="utf-8") as index_file:
+            json.dump(saved, index_file)
+        os.replace(temporary, location)
@@ -0,0 +1,212 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+End to end latency of each run, from the instrument writing lastrun.txt to
+the run being detected and then acknowledged by the submission sinks.
+"""
+import glob
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, NamedTuple, Optional
+
+from autoreduce_run_detection.locations import latency_location
+from autoreduce_run_detection.metrics import RUN_LATENCY_QUANTILE_SECONDS, RUN_LATENCY_SECONDS
+from autoreduce_run_detection.settings import LATENCY_WINDOW
+
+LOGGING = logging.getLogger(__package__)
+
+STAGES = ("detection", "submission", "total")
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RunTiming(NamedTuple):
+    """
+    When a run's lastrun.txt was written, and when the run was detected and acknowledged, as Unix times
+    """
+    run: int
+    written: float
+    detected: float
+    acknowledged: float
+
+    def stage(self, name: str) -> float:
+        """
+        Seconds spent in a stage: "detection", "submission" or "total"
+        """
+        # The archive's clock may be ahead of ours, don't report negative delays
+        if name == "detection":
+            return max(self.detected - self.written, 0.0)
+        if name == "submission":
+            return self.acknowledged - self.detected
+        return max(self.acknowledged - self.written, 0.0)
+
+
+def quantile(values: List[float], fraction: float) -> float:
+    """
+    Nearest rank quantile of sorted values
+    """
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class LatencyTracker:
+    """
+    Runs detected but not yet acknowledged, kept as ranges sharing the time
+    their lastrun.txt was written and the time they were detected, and the
+    timings of each instrument's most recent acknowledged runs
+    """
+
+    def __init__(self,
+                 pending: Optional[Dict[str, List[List[float]]]] = None,
+                 timings: Optional[Dict[str, Iterable[RunTiming]]] = None,
+                 window: int = LATENCY_WINDOW,
+                 clock: Callable[[], float] = time.time):
+        # instrument -> [[start_run, end_run, written, detected]] in run order
+        self._pending: Dict[str, List[List[float]]] = pending or {}
+        self._timings: Dict[str, Deque[RunTiming]] = {
+            instrument: deque(runs, maxlen=window)
+            for instrument, runs in (timings or {}).items()
+        }
+        self.window = window
+        # Current wall clock time, when runs are detected and acknowledged if not given
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def detected(self, instrument: str, start_run: int, end_run: int, written: float, detected: Optional[float] = None):
+        """
+        Record that runs start_run up to but not including end_run were
+        detected, keeping the earlier detection of runs already pending
+        """
+        with self._lock:
+            pending = self._pending.setdefault(instrument, [])
+            if pending:
+                start_run = max(start_run, int(pending[-1][1]))
+            if start_run >= end_run:
+                return
+            pending.append([start_run, end_run, written, self.clock() if detected is None else detected])
+            self._dirty = True
+
+    def acknowledged(self, instrument: str, start_run: int, end_run: int, acknowledged: Optional[float] = None):
+        """
+        Record that runs start_run up to but not including end_run were
+        acknowledged. Pending runs before them are dropped, they won't be.
+        """
+        acknowledged = self.clock() if acknowledged is None else acknowledged
+        timings = []
+        with self._lock:
+            remaining = []
+            for first, after, written, detected in self._pending.get(instrument, []):
+                first, after = int(first), int(after)
+                for run in range(max(first, start_run), min(after, end_run)):
+                    timings.append(RunTiming(run, written, detected, acknowledged))
+                if after > end_run:
+                    remaining.append([max(first, end_run), after, written, detected])
+            if not timings and remaining == self._pending.get(instrument, []):
+                return
+            self._pending[instrument] = remaining
+            self._timings.setdefault(instrument, deque(maxlen=self.window)).extend(timings)
+            self._dirty = True
+        for timing in timings:
+            for stage in STAGES:
+                RUN_LATENCY_SECONDS.observe(timing.stage(stage), instrument=instrument, stage=stage)
+
+    def timings(self) -> Dict[str, List[RunTiming]]:
+        """
+        The timings of each instrument's most recent acknowledged runs
+        """
+        with self._lock:
+            return {instrument: list(runs) for instrument, runs in self._timings.items() if runs}
+
+    def report(self):
+        """
+        Update the latency quantile gauges and log the median and 99th percentile of each instrument
+        """
+        for instrument, runs in sorted(self.timings().items()):
+            values = {}
+            for stage in STAGES:
+                ordered = sorted(timing.stage(stage) for timing in runs)
+                for fraction in QUANTILES:
+                    values[stage, fraction] = quantile(ordered, fraction)
+                    RUN_LATENCY_QUANTILE_SECONDS.set(values[stage, fraction],
+                                                     instrument=instrument,
+                                                     stage=stage,
+                                                     quantile=str(fraction))
+            LOGGING.info("Run latency of %s over %i runs: p50 %.1fs, p99 %.1fs (detection p50 %.1fs, p99 %.1fs)",
+                         instrument, len(runs), values["total", 0.5], values["total", 0.99], values["detection", 0.5],
+                         values["detection", 0.99])
+
+    @classmethod
+    def load(cls, location: str, clock: Callable[[], float] = time.time) -> "LatencyTracker":
+        """
+        Load the runs saved by a previous invocation, or an empty tracker
+
+        Args:
+            location: Where the runs are saved
+            clock: Current wall clock time
+        """
+        try:
+            with open(location, mode='r', encoding="utf-8") as latency_file:
+                saved = json.load(latency_file)
+            timings = {
+                instrument: [RunTiming(*timing) for timing in runs]
+                for instrument, runs in saved["timings"].items()
+            }
+            return cls(saved["pending"], timings, clock=clock)
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            if os.path.exists(location):
+                LOGGING.warning("Ignoring unreadable run latencies %s: %s", location, err)
+            return cls(clock=clock)
+
+    def save(self, location: str):
+        """
+        Save the runs for the next invocation if they have changed
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            pending = {instrument: [list(entry) for entry in entries] for instrument, entries in self._pending.items()}
+            timings = {instrument: [list(timing) for timing in runs] for instrument, runs in self._timings.items()}
+            self._dirty = False
+        saved = {"pending": pending, "timings": timings}
+        temporary = f"{location}.tmp"
+        with open(temporary, mode='w', encoding="utf-8") as latency_file:
+            json.dump(saved, latency_file)
+        os.replace(temporary, location)
+
+
+def format_report(timings: Dict[str, List[RunTiming]]) -> str:
+    """
+    Table of the latency quantiles of each instrument, splitting the time
+    before a run is detected from the time taken to submit it
+    """
+    header = f"{'Instrument':<12}{'Runs':>6}"
+    for stage in STAGES:
+        header += f"  {stage.capitalize() + ' p50/p95/p99 (s)':>32}"
+    lines = [header]
+    for instrument, runs in sorted(timings.items()):
+        line = f"{instrument:<12}{len(runs):>6}"
+        for stage in STAGES:
+            ordered = sorted(timing.stage(stage) for timing in runs)
+            line += f"  {'/'.join(f'{quantile(ordered, fraction):.1f}' for fraction in QUANTILES):>32}"
+        lines.append(line)
+    if len(lines) == 1:
+        lines.append("No runs have been acknowledged yet")
+    return "\n".join(lines)
+
+
+def latency_report(csv_name) -> str:
+    """
+    Report of the run latencies recorded by the daemon or `--once` invocations, and by any replicas
+    """
+    timings: Dict[str, list] = {}
+    for location in [latency_location(csv_name)] + sorted(glob.glob(f"{glob.escape(str(csv_name))}.*.latency.json")):
+        for instrument, runs in LatencyTracker.load(location).timings().items():
+            timings.setdefault(instrument, []).extend(runs)
+    return format_report(timings)
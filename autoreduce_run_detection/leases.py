@@ -0,0 +1,185 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+File-based leases on instruments, so that several run detection replicas
+can share the instruments between them without polling any twice.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from typing import Iterable, List, Optional, Set
+
+from filelock import FileLock, Timeout
+
+from autoreduce_run_detection.settings import LEASE_TTL
+
+LOGGING = logging.getLogger(__package__)
+
+SHARDING_MODES = ("hash", "lease")
+
+
+def rendezvous_weight(replica: str, instrument: str) -> int:
+    """
+    Weight of a replica for an instrument. Each instrument belongs to the
+    live replica with the highest weight, so only the instruments of a
+    replica that joins or leaves move.
+    """
+    return int.from_bytes(hashlib.sha256(f"{replica}/{instrument}".encode()).digest()[:8], "big")
+
+
+class LeaseManager:
+    """
+    Leases on instruments kept as files in `directory`. A lease names the
+    replica holding it and expires `ttl` seconds after it was last renewed,
+    so the instruments of a crashed replica are taken over by the others.
+    Each live replica also keeps a heartbeat file that expires the same way.
+
+    In "hash" mode a replica claims the instruments it is assigned by
+    rendezvous hashing over the live replicas. In "lease" mode it claims
+    free leases until it holds its fair share of the instruments.
+    """
+
+    def __init__(self, directory: str, replica: str, mode: str = "hash", ttl: float = LEASE_TTL):
+        if mode not in SHARDING_MODES:
+            raise ValueError(f"Unknown sharding mode '{mode}', expected one of {', '.join(SHARDING_MODES)}")
+        self.directory = directory
+        self.replica = replica
+        self.mode = mode
+        self.ttl = ttl
+        self.owned: Set[str] = set()
+        os.makedirs(os.path.join(directory, "replicas"), exist_ok=True)
+
+    def _lease_path(self, instrument: str) -> str:
+        return os.path.join(self.directory, f"{instrument}.lease")
+
+    def _heartbeat_path(self, replica: str) -> str:
+        return os.path.join(self.directory, "replicas", f"{replica}.json")
+
+    @staticmethod
+    def _read(path: str) -> Optional[dict]:
+        try:
+            with open(path, mode='r', encoding="utf-8") as lease_file:
+                return json.load(lease_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            LOGGING.warning("Ignoring unreadable lease %s: %s", path, err)
+            return None
+
+    @staticmethod
+    def _write(path: str, content: dict):
+        temporary = f"{path}.tmp"
+        with open(temporary, mode='w', encoding="utf-8") as lease_file:
+            json.dump(content, lease_file)
+        os.replace(temporary, path)
+
+    def heartbeat(self):
+        """
+        Record that this replica is alive for another `ttl` seconds
+        """
+        self._write(self._heartbeat_path(self.replica), {"expires": time.time() + self.ttl})
+
+    def live_replicas(self) -> List[str]:
+        """
+        Replicas whose heartbeat hasn't expired, always including this one
+        """
+        now = time.time()
+        replicas = {self.replica}
+        with os.scandir(os.path.join(self.directory, "replicas")) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json"):
+                    heartbeat = self._read(entry.path)
+                    if heartbeat is not None and heartbeat.get("expires", 0) > now:
+                        replicas.add(entry.name[:-len(".json")])
+        return sorted(replicas)
+
+    def acquire(self, instrument: str) -> bool:
+        """
+        Take or renew the lease on an instrument
+
+        Returns:
+            True if this replica holds the lease
+        """
+        path = self._lease_path(instrument)
+        try:
+            with FileLock(f"{path}.lock", timeout=1):
+                lease = self._read(path)
+                now = time.time()
+                if lease is not None and lease.get("owner") != self.replica and lease.get("expires", 0) > now:
+                    return False
+                if lease is not None and lease.get("owner") != self.replica:
+                    LOGGING.info("Taking over %s from %s", instrument, lease.get("owner"))
+                self._write(path, {"owner": self.replica, "expires": now + self.ttl})
+                return True
+        except Timeout:
+            return False
+
+    def release(self, instrument: str):
+        """
+        Give up the lease on an instrument if this replica holds it
+        """
+        path = self._lease_path(instrument)
+        try:
+            with FileLock(f"{path}.lock", timeout=1):
+                lease = self._read(path)
+                if lease is not None and lease.get("owner") == self.replica:
+                    os.remove(path)
+        except (Timeout, OSError) as err:
+            LOGGING.warning("Unable to release lease on %s, it will expire: %s", instrument, err)
+        self.owned.discard(instrument)
+
+    def _wanted(self, instruments: List[str], replicas: List[str]) -> List[str]:
+        if self.mode == "hash":
+            return [
+                instrument for instrument in instruments
+                if max(replicas, key=lambda replica, name=instrument: rendezvous_weight(replica, name)) == self.replica
+            ]
+        # Keep the leases already held, then try the others in an order that differs between replicas
+        return sorted(instruments, key=lambda name: (name not in self.owned, rendezvous_weight(self.replica, name)))
+
+    def claim(self, instruments: Iterable[str]) -> Set[str]:
+        """
+        Renew this replica's heartbeat and leases, take the leases it should
+        hold and release the ones it shouldn't
+
+        Args:
+            instruments: Names of every instrument being monitored
+        Returns:
+            The instruments this replica now holds the lease on
+        """
+        instruments = list(instruments)
+        self.heartbeat()
+        replicas = self.live_replicas()
+        wanted = self._wanted(instruments, replicas)
+        limit = len(wanted) if self.mode == "hash" else math.ceil(len(instruments) / len(replicas))
+        owned = set()
+        for instrument in wanted:
+            if len(owned) >= limit:
+                break
+            if self.acquire(instrument):
+                owned.add(instrument)
+        changed = owned != self.owned
+        for instrument in self.owned - owned:
+            self.release(instrument)
+        if changed:
+            LOGGING.info("Replica %s of %i now monitors %i of %i instruments", self.replica, len(replicas), len(owned),
+                         len(instruments))
+        self.owned = owned
+        return set(owned)
+
+    def release_all(self):
+        """
+        Release every lease and the heartbeat, so the other replicas take over straight away
+        """
+        for instrument in list(self.owned):
+            self.release(instrument)
+        try:
+            os.remove(self._heartbeat_path(self.replica))
+        except FileNotFoundError:
+            pass
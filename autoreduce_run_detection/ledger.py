@@ -0,0 +1,96 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Persistent ledger of the runs acknowledged by the submission sinks, so that
+runs are never submitted for reduction twice, e.g. when an acknowledgement
+is lost or the process stops before the last runs are saved.
+"""
+import sqlite3
+import threading
+from typing import List, Tuple
+
+
+class SubmissionLedger:
+    """
+    Acknowledged runs kept per instrument as disjoint ranges in an SQLite
+    database. Ranges are keyed by their first run, so the ranges around any
+    run are found with an index lookup, and a range is merged with the ones
+    it touches when it is recorded, so an instrument whose runs are all
+    acknowledged in order only ever takes up one row.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(location, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS acknowledged ("
+                                     "instrument TEXT NOT NULL, "
+                                     "start_run INTEGER NOT NULL, "
+                                     "end_run INTEGER NOT NULL, "
+                                     "PRIMARY KEY (instrument, start_run)) WITHOUT ROWID")
+
+    def _overlapping(self, instrument: str, start_run: int, end_run: int) -> List[Tuple[int, int]]:
+        """
+        Ranges that overlap or touch runs start_run up to but not including end_run, in order
+        """
+        before = self._connection.execute(
+            "SELECT start_run, end_run FROM acknowledged WHERE instrument = ? AND start_run <= ? "
+            "ORDER BY start_run DESC LIMIT 1", (instrument, start_run)).fetchall()
+        within = self._connection.execute(
+            "SELECT start_run, end_run FROM acknowledged WHERE instrument = ? AND start_run > ? AND start_run <= ? "
+            "ORDER BY start_run", (instrument, start_run, end_run)).fetchall()
+        return [row for row in before if row[1] >= start_run] + within
+
+    def unacknowledged(self, instrument: str, start_run: int, end_run: int) -> List[Tuple[int, int]]:
+        """
+        Split runs start_run up to but not including end_run into the ranges that haven't been acknowledged
+
+        Returns:
+            (start_run, end_run) ranges in order, empty if every run has been acknowledged
+        """
+        with self._lock:
+            acknowledged = self._overlapping(instrument, start_run, end_run)
+        ranges = []
+        for first, after in acknowledged:
+            if first > start_run:
+                ranges.append((start_run, min(first, end_run)))
+            start_run = max(start_run, after)
+        if start_run < end_run:
+            ranges.append((start_run, end_run))
+        return ranges
+
+    def record(self, instrument: str, start_run: int, end_run: int):
+        """
+        Record runs start_run up to but not including end_run as acknowledged, merging the ranges they touch
+        """
+        with self._lock, self._connection:
+            # Take the write lock before reading, other replicas may be merging the same instrument's ranges
+            self._connection.execute("BEGIN IMMEDIATE")
+            touching = self._overlapping(instrument, start_run, end_run)
+            for first, _ in touching:
+                self._connection.execute("DELETE FROM acknowledged WHERE instrument = ? AND start_run = ?",
+                                         (instrument, first))
+            self._connection.execute(
+                "INSERT INTO acknowledged VALUES (?, ?, ?)",
+                (instrument, min([start_run] + [row[0]
+                                                for row in touching]), max([end_run] + [row[1] for row in touching])))
+
+    def ranges(self, instrument: str) -> List[Tuple[int, int]]:
+        """
+        Every acknowledged range of an instrument, in order
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT start_run, end_run FROM acknowledged WHERE instrument = ? ORDER BY start_run",
+                (instrument, )).fetchall()
+
+    def close(self):
+        """
+        Release the database
+        """
+        self._connection.close()
@@ -0,0 +1,73 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Locations of the files kept alongside the last runs CSV file. Files kept by
+one replica only are named after its cache name, the CSV file name followed
+by the replica.
+"""
+
+
+def stat_cache_location(csv_name) -> str:
+    """
+    Location of the lastrun.txt stat cache kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.stat_cache.json"
+
+
+def summary_index_location(csv_name) -> str:
+    """
+    Location of the summary.txt offsets and run metadata kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.summary_index.json"
+
+
+def data_index_location(csv_name) -> str:
+    """
+    Location of the data directory index kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.data_index.json"
+
+
+def schedule_location(csv_name) -> str:
+    """
+    Location of the adaptive polling schedule kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.schedule.json"
+
+
+def ledger_location(csv_name) -> str:
+    """
+    Location of the ledger of acknowledged runs kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.ledger.sqlite3"
+
+
+def latency_location(csv_name) -> str:
+    """
+    Location of the run latencies kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.latency.json"
+
+
+def profile_location(csv_name) -> str:
+    """
+    Location of the directory of slow cycle profiles kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.profiles"
+
+
+def outbox_location(csv_name) -> str:
+    """
+    Location of the submission outbox kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.outbox.sqlite3"
+
+
+def backfill_location(csv_name, instrument: str, label: str) -> str:
+    """
+    Location of the progress of a backfill kept alongside the last runs CSV file
+    """
+    return f"{csv_name}.backfill.{instrument}.{label}.json"
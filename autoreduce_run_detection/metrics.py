@@ -0,0 +1,346 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Counters and histograms of where run detection spends its time, exposed in
+the Prometheus/OpenMetrics text format on a local /metrics endpoint or
+written to a node-exporter textfile.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+LOGGING = logging.getLogger(__package__)
+
+# Upper bounds in seconds, from a cached lastrun.txt stat up to a slow cycle
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds in seconds, from a run picked up by inotify up to one held back for its data file
+LATENCY_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0)
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Registry:
+    """
+    The metrics to expose, rendered in registration order
+    """
+
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "Metric"):
+        """
+        Add a metric to the exposition
+        """
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics.append(metric)
+
+    def render(self, openmetrics: bool = False) -> str:
+        """
+        Render every metric in the OpenMetrics text format, or in the
+        Prometheus text format understood by the node-exporter textfile collector
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(openmetrics))
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric(ABC):
+    """
+    A metric family whose samples are labelled by `labelnames`
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self, family: str) -> List[str]:
+        return [f"# HELP {family} {_escape(self.documentation)}", f"# TYPE {family} {self.type_name}"]
+
+    @abstractmethod
+    def render(self, openmetrics: bool) -> List[str]:
+        """
+        Lines of the metric family in the exposition
+        """
+
+
+class Counter(Metric):
+    """
+    A total that only goes up, exposed as `<name>_total`
+    """
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        """
+        Add to the total of the labelled sample
+        """
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """
+        Current total of the labelled sample
+        """
+        key = self._label_values(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self, openmetrics: bool) -> List[str]:
+        # OpenMetrics names the family without the suffix, the Prometheus format names it after the sample
+        lines = self._header(self.name if openmetrics else f"{self.name}_total")
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Metric):
+    """
+    A value that is set to its latest reading
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        """
+        Set the labelled sample
+        """
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels: str) -> Optional[float]:
+        """
+        Current value of the labelled sample, None if it has never been set
+        """
+        key = self._label_values(labels)
+        with self._lock:
+            return self._values.get(key)
+
+    def render(self, openmetrics: bool) -> List[str]:
+        lines = self._header(self.name)
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative `le` buckets along with their sum and count
+    """
+
+    type_name = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> ([count per bucket, the last one for +Inf], sum)
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        """
+        Record one observation in the labelled sample
+        """
+        key = self._label_values(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observe the seconds taken by the body of a with statement, even if it raises
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        """
+        Number of observations in the labelled sample
+        """
+        key = self._label_values(labels)
+        with self._lock:
+            counts, _ = self._values.get(key, ([0], 0.0))
+            return sum(counts)
+
+    def render(self, openmetrics: bool) -> List[str]:
+        lines = self._header(self.name)
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"), ), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le", ), key + (_format_value(bound), ))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        return lines
+
+
+LAST_RUN_READ_SECONDS = Histogram("run_detection_last_run_read_seconds",
+                                  "Time taken to read an instrument's lastrun.txt", ["instrument"])
+SUBMIT_SECONDS = Histogram("run_detection_submit_seconds", "Time taken to submit runs to the submission sinks",
+                           ["instrument"])
+SUBMIT_RESPONSES = Counter("run_detection_submit_responses",
+                           "Responses to run submissions by status code, 'error' when no response was received",
+                           ["instrument", "code"])
+RUNS_SUBMITTED = Counter("run_detection_runs_submitted", "Runs acknowledged by the submission sinks", ["instrument"])
+DUPLICATE_RUNS = Counter("run_detection_duplicate_runs",
+                         "Runs not submitted again as the ledger shows they were already acknowledged", ["instrument"])
+RUN_LATENCY_SECONDS = Histogram(
+    "run_detection_run_latency_seconds",
+    "Time per run from lastrun.txt being written to the run being detected ('detection'), from detection to "
+    "acknowledgement ('submission') and in total ('total')", ["instrument", "stage"], LATENCY_BUCKETS)
+RUN_LATENCY_QUANTILE_SECONDS = Gauge("run_detection_run_latency_quantile_seconds",
+                                     "Quantiles of the run latency stages over each instrument's most recent runs",
+                                     ["instrument", "stage", "quantile"])
+OUTBOX_PENDING = Gauge("run_detection_outbox_pending",
+                       "Ranges ('ranges') and runs ('runs') waiting in the submission outbox after the last drain",
+                       ["unit"])
+LOCK_WAIT_SECONDS = Histogram("run_detection_lock_wait_seconds", "Time spent waiting for the last runs CSV lock")
+CYCLE_SECONDS = Histogram("run_detection_cycle_seconds",
+                          "Duration of detection cycles polling every instrument ('all') or changed ones ('changed')",
+                          ["scope"])
+
+
+class MetricsServer:
+    """
+    Serves the metrics on http://<address>:<port>/metrics from a background thread
+    """
+
+    def __init__(self, port: int, address: str = "127.0.0.1", registry: Registry = REGISTRY):
+        # Only the daemon serves metrics, --once invocations don't import the HTTP server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # pylint:disable=import-outside-toplevel
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):  # pylint:disable=invalid-name
+                """
+                Serve the exposition on /metrics
+                """
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+                body = registry.render(openmetrics).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+                LOGGING.debug("Metrics request: " + format, *args)
+
+        self._server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """
+        The port being served, useful when started on port 0
+        """
+        return self._server.server_address[1]
+
+    def start(self):
+        """
+        Start serving in the background
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        LOGGING.info("Serving metrics on port %i", self.port)
+
+    def stop(self):
+        """
+        Stop serving and release the port
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def write_textfile(location: str, registry: Registry = REGISTRY):
+    """
+    Write the metrics for the node-exporter textfile collector. The file is
+    replaced atomically so the collector never reads a partial file.
+    """
+    temporary = f"{location}.{os.getpid()}.tmp"
+    with open(temporary, mode='w', encoding="utf-8") as textfile:
+        textfile.write(registry.render())
+    os.replace(temporary, location)
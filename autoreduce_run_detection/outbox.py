@@ -0,0 +1,194 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Persistent outbox of run ranges waiting to be submitted, so that detection
+never waits on the autoreduce API and failed submissions are retried
+without re-detecting them.
+"""
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from autoreduce_run_detection.metrics import OUTBOX_PENDING
+from autoreduce_run_detection.settings import (OUTBOX_DRAIN_INTERVAL, OUTBOX_BACKOFF, OUTBOX_BACKOFF_MAX,
+                                               SUBMIT_CHUNK_SIZE)
+
+LOGGING = logging.getLogger(__package__)
+
+
+class PendingRuns(NamedTuple):
+    """
+    Runs start_run up to but not including end_run of an instrument, waiting to be submitted
+    """
+    entry_id: int
+    instrument: str
+    start_run: int
+    end_run: int
+    attempts: int
+
+
+class Outbox:
+    """
+    Pending submissions kept in an SQLite database. Adjacent or overlapping
+    ranges of the same instrument are coalesced into one.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(location, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS pending ("
+                                     "entry_id INTEGER PRIMARY KEY, "
+                                     "instrument TEXT NOT NULL, "
+                                     "start_run INTEGER NOT NULL, "
+                                     "end_run INTEGER NOT NULL, "
+                                     "attempts INTEGER NOT NULL DEFAULT 0, "
+                                     "next_attempt REAL NOT NULL)")
+
+    def enqueue(self, instrument: str, start_run: int, end_run: int):
+        """
+        Queue runs start_run up to but not including end_run for submission.
+        The range is committed before this returns.
+        """
+        with self._lock, self._connection:
+            touching = self._connection.execute(
+                "SELECT entry_id, start_run, end_run, next_attempt FROM pending "
+                "WHERE instrument = ? AND start_run <= ? AND end_run >= ?",
+                (instrument, end_run, start_run)).fetchall()
+            if not touching:
+                self._connection.execute(
+                    "INSERT INTO pending (instrument, start_run, end_run, next_attempt) VALUES (?, ?, ?, ?)",
+                    (instrument, start_run, end_run, time.time()))
+                return
+            # Merge into the first entry, keeping its retry schedule
+            entry_id = touching[0][0]
+            self._connection.execute(
+                "UPDATE pending SET start_run = ?, end_run = ?, next_attempt = ? WHERE entry_id = ?",
+                (min([start_run] + [row[1] for row in touching]), max([end_run] + [row[2] for row in touching]),
+                 min(row[3] for row in touching), entry_id))
+            for row in touching[1:]:
+                self._connection.execute("DELETE FROM pending WHERE entry_id = ?", (row[0], ))
+
+    def due(self, now: Optional[float] = None) -> List[PendingRuns]:
+        """
+        Pending runs whose next attempt is due, oldest runs first
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT entry_id, instrument, start_run, end_run, attempts FROM pending "
+                "WHERE next_attempt <= ? ORDER BY instrument, start_run", (time.time() if now is None else now, ))
+            return [PendingRuns(*row) for row in rows.fetchall()]
+
+    def advance(self, entry_id: int, start_run: int):
+        """
+        Record that the runs before start_run have been acknowledged, removing the entry once all of them have been
+        """
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE pending SET start_run = ?, attempts = 0 WHERE entry_id = ?",
+                                     (start_run, entry_id))
+            self._connection.execute("DELETE FROM pending WHERE entry_id = ? AND start_run >= end_run", (entry_id, ))
+
+    def retry_later(self, entry_id: int) -> int:
+        """
+        Schedule the next attempt of an entry after a jittered exponential backoff. The attempts are counted in the
+        database, as advance() resets them whenever some of the entry's runs are acknowledged.
+
+        Returns:
+            The number of consecutive failed attempts, including this one
+        """
+        with self._lock, self._connection:
+            attempts, = self._connection.execute("SELECT attempts FROM pending WHERE entry_id = ?",
+                                                 (entry_id, )).fetchone()
+            delay = random.uniform(0, min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF * 2**attempts))
+            self._connection.execute("UPDATE pending SET attempts = attempts + 1, next_attempt = ? WHERE entry_id = ?",
+                                     (time.time() + delay, entry_id))
+        return attempts + 1
+
+    def depth(self) -> Tuple[int, int]:
+        """
+        Returns:
+            The number of pending ranges and the number of runs in them
+        """
+        with self._lock:
+            entries, runs = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(end_run - start_run), 0) FROM pending").fetchone()
+        return entries, runs
+
+    def drain(self, submit: Callable[[str, int, int], None]):
+        """
+        Make one attempt at submitting every due entry, in chunks of at most SUBMIT_CHUNK_SIZE runs
+
+        Args:
+            submit: Submits runs start_run up to but not including end_run of an instrument,
+                    raising an exception if they were not acknowledged
+        """
+        for entry in self.due():
+            start_run = entry.start_run
+            try:
+                while start_run < entry.end_run:
+                    chunk_end = min(start_run + SUBMIT_CHUNK_SIZE, entry.end_run)
+                    submit(entry.instrument, start_run, chunk_end)
+                    start_run = chunk_end
+                    self.advance(entry.entry_id, start_run)
+            except Exception as err:  # pylint:disable=broad-except
+                attempts = self.retry_later(entry.entry_id)
+                LOGGING.error("Queued runs %i - %i for %s not submitted (attempt %i): %s", start_run, entry.end_run,
+                              entry.instrument, attempts, err)
+        self._update_depth()
+
+    def _update_depth(self) -> Tuple[int, int]:
+        """
+        Set the outbox depth gauge to the current depth
+        """
+        entries, runs = self.depth()
+        OUTBOX_PENDING.set(entries, unit="ranges")
+        OUTBOX_PENDING.set(runs, unit="runs")
+        return entries, runs
+
+    def report(self):
+        """
+        Log the depth of the queue
+        """
+        entries, runs = self._update_depth()
+        LOGGING.info("Submission outbox: %i pending ranges, %i runs", entries, runs)
+
+    def close(self):
+        """
+        Release the database
+        """
+        self._connection.close()
+
+
+class OutboxDrainer(threading.Thread):
+    """
+    Drains the outbox in the background every OUTBOX_DRAIN_INTERVAL seconds until stopped
+    """
+
+    def __init__(self, outbox: Outbox, submit: Callable[[str, int, int], None]):
+        super().__init__(name="outbox-drainer", daemon=True)
+        self.outbox = outbox
+        self.submit = submit
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.outbox.drain(self.submit)
+            except Exception:  # pylint:disable=broad-except
+                LOGGING.exception("Draining the submission outbox failed")
+            self._stopping.wait(OUTBOX_DRAIN_INTERVAL)
+
+    def stop(self):
+        """
+        Stop draining once the current pass is done and wait for it
+        """
+        self._stopping.set()
+        self.join()
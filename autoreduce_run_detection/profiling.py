@@ -0,0 +1,343 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Profiles of detection cycles: how long each phase of a cycle and each
+instrument's lastrun.txt read and submission took, and the cProfile
+statistics of the code run. The profiles of slow cycles are kept so that
+they can be looked into after the fact.
+"""
+import cProfile
+import glob
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional
+
+from autoreduce_run_detection.locations import profile_location
+from autoreduce_run_detection.settings import PROFILE_KEEP, PROFILE_SLOW_CYCLE
+
+LOGGING = logging.getLogger(__package__)
+
+# Phases in the order they happen in a cycle, others are listed after them
+PHASES = ("lock", "open", "load", "claim", "read", "submit", "save", "outbox")
+# Seconds after a slow cycle during which the code of the following cycles is profiled
+ARMED_FOR = 3600
+
+
+class CycleProfile:
+    """
+    Timings of one detection cycle and, when profiling code, the cProfile
+    statistics of the cycle's thread and of each call made for an
+    instrument on the worker threads
+    """
+
+    def __init__(self, scope: str, profile_code: bool = True, lock_wait: Optional[float] = None):
+        self.scope = scope
+        # The cycle starts when waiting for the lock on the last runs CSV file starts
+        waited = lock_wait or 0.0
+        self.started = time.time() - waited
+        self.duration = 0.0
+        self.phases: Dict[str, float] = {} if lock_wait is None else {"lock": lock_wait}
+        # instrument -> phase -> seconds
+        self.instruments: Dict[str, Dict[str, float]] = {}
+        # [instrument, phase] of the calls still running when the cycle ended
+        self.unfinished: List[List[str]] = []
+        self._start = time.perf_counter() - waited
+        self._running: Dict[tuple, float] = {}
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._profiles: List[cProfile.Profile] = []
+        self._profile: Optional[cProfile.Profile] = None
+        if profile_code:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self._profile = profile
+            except ValueError as err:
+                LOGGING.warning("Unable to profile the detection cycle: %s", err)
+
+    def record(self, phase: str, seconds: float):
+        """
+        Add time spent in a phase of the cycle
+        """
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time a phase of the cycle
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, instrument: str, phase: str, func: Callable[[], object]) -> Callable[[], object]:
+        """
+        Wrap a call made for an instrument on a worker thread to time and profile it
+        """
+
+        def _call():
+            key = (instrument, phase)
+            start = time.perf_counter()
+            with self._lock:
+                self._running[key] = start
+            profile = cProfile.Profile() if self._profile is not None else None
+            if profile is not None:
+                try:
+                    profile.enable()
+                except ValueError:
+                    # From Python 3.12 the profile of the cycle sees every thread
+                    profile = None
+            try:
+                return func()
+            finally:
+                if profile is not None:
+                    profile.disable()
+                with self._lock:
+                    # A call that outlived its cycle has already been recorded as unfinished
+                    if not self._stopped:
+                        del self._running[key]
+                        self.instruments.setdefault(instrument, {})[phase] = time.perf_counter() - start
+                        if profile is not None:
+                            self._profiles.append(profile)
+
+        return _call
+
+    def stop(self):
+        """
+        Stop timing and profiling the cycle. Calls still running, e.g. stuck
+        on a hung mount, are recorded as unfinished.
+        """
+        now = time.perf_counter()
+        if self._profile is not None:
+            self._profile.disable()
+        with self._lock:
+            self._stopped = True
+            self.duration = now - self._start
+            for (instrument, phase), start in self._running.items():
+                self.instruments.setdefault(instrument, {})[phase] = now - start
+                self.unfinished.append([instrument, phase])
+
+    def stats(self) -> Optional[pstats.Stats]:
+        """
+        The cProfile statistics of the cycle, None if code wasn't profiled
+        """
+        if self._profile is None:
+            return None
+        stats = pstats.Stats(self._profile)
+        with self._lock:
+            profiles = list(self._profiles)
+        if profiles:
+            stats.add(*profiles)
+        return stats
+
+
+def timed_phase(cycle: Optional[CycleProfile], name: str) -> ContextManager:
+    """
+    Time a phase of the cycle if it is being profiled
+    """
+    return cycle.phase(name) if cycle is not None else nullcontext()
+
+
+def timed_call(cycle: Optional[CycleProfile], instrument: str, phase: str,
+               func: Callable[[], object]) -> Callable[[], object]:
+    """
+    Time and profile a call made for an instrument if the cycle is being profiled
+    """
+    return cycle.timed(instrument, phase, func) if cycle is not None else func
+
+
+class CycleProfiler:
+    """
+    Profiles detection cycles, keeping the profiles of those that take at
+    least `threshold` seconds, or of every cycle when `always` is set, in a
+    directory where only the latest `keep` of them are kept. Profiling is
+    disabled when `threshold` is 0 and `always` isn't set.
+
+    Profiling code slows the cycles down, so unless `always` is set only the
+    phases are timed until a cycle is slow. The code of the cycles that
+    follow is then profiled, for up to ARMED_FOR seconds or until the next
+    slow cycle is kept along with its cProfile statistics. Whether code is
+    being profiled is kept in the directory, so it carries over between
+    --once invocations.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 threshold: float = PROFILE_SLOW_CYCLE,
+                 always: bool = False,
+                 keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.threshold = threshold
+        self.always = always
+        self.keep = keep
+        self._armed = os.path.join(directory, "armed")
+
+    def armed(self) -> bool:
+        """
+        Whether the code of the next cycles is profiled after a slow cycle
+        """
+        try:
+            return time.time() - os.path.getmtime(self._armed) < ARMED_FOR
+        except OSError:
+            return False
+
+    @contextmanager
+    def cycle(self, scope: str, lock_wait: Optional[float] = None) -> Iterator[Optional[CycleProfile]]:
+        """
+        Profile a cycle, saving its profile afterwards if it was slow
+
+        Args:
+            scope: What the cycle polled, e.g. "all" or "changed"
+            lock_wait: Seconds already spent waiting for the lock on the last runs CSV file
+        Yields:
+            The profile of the cycle, or None if profiling is disabled
+        """
+        if not self.always and self.threshold <= 0:
+            yield None
+            return
+        profile_code = self.always or self.armed()
+        profile = CycleProfile(scope, profile_code, lock_wait)
+        try:
+            yield profile
+        finally:
+            profile.stop()
+            slow = 0 < self.threshold <= profile.duration
+            try:
+                if self.always or slow:
+                    self.save(profile)
+                if slow and not profile_code:
+                    with open(self._armed, mode='w', encoding="utf-8"):
+                        pass
+                elif slow:
+                    os.remove(self._armed)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                LOGGING.error("Unable to save the profile of the detection cycle: %s", err)
+
+    def save(self, profile: CycleProfile) -> str:
+        """
+        Save the timings and cProfile statistics of a cycle, removing the oldest profiles beyond `keep`
+
+        Returns:
+            Location of the timings
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"cycle-{datetime.fromtimestamp(profile.started).strftime('%Y%m%dT%H%M%S.%f')}-{profile.scope}"
+        stats = profile.stats()
+        if stats is not None:
+            stats.dump_stats(os.path.join(self.directory, f"{name}.prof"))
+        capture = {
+            "scope": profile.scope,
+            "started": profile.started,
+            "duration": profile.duration,
+            "phases": profile.phases,
+            "instruments": profile.instruments,
+            "unfinished": profile.unfinished,
+            "profile": f"{name}.prof" if stats is not None else None
+        }
+        location = os.path.join(self.directory, f"{name}.json")
+        temporary = f"{location}.tmp"
+        with open(temporary, mode='w', encoding="utf-8") as capture_file:
+            json.dump(capture, capture_file)
+        os.replace(temporary, location)
+        if self.always:
+            LOGGING.info("Detection cycle took %.1fs, profile saved to %s", profile.duration, location)
+        elif stats is None:
+            LOGGING.warning(
+                "Detection cycle took %.1fs, longer than %gs, timings saved to %s. The code of the next "
+                "slow cycle will be profiled.", profile.duration, self.threshold, location)
+        else:
+            LOGGING.warning("Detection cycle took %.1fs, longer than %gs, profile saved to %s", profile.duration,
+                            self.threshold, location)
+
+        for old in sorted(glob.glob(os.path.join(glob.escape(self.directory), "cycle-*.json")))[:-self.keep]:
+            for old_file in [old, f"{old[:-len('.json')]}.prof"]:
+                try:
+                    os.remove(old_file)
+                except FileNotFoundError:
+                    pass
+        return location
+
+
+def load_captures(directories: List[str]) -> List[dict]:
+    """
+    Load the saved profiles of the cycles, skipping any that can't be read
+    """
+    captures = []
+    for directory in directories:
+        for location in sorted(glob.glob(os.path.join(glob.escape(directory), "cycle-*.json"))):
+            try:
+                with open(location, mode='r', encoding="utf-8") as capture_file:
+                    capture = json.load(capture_file)
+            except (OSError, ValueError) as err:
+                LOGGING.warning("Ignoring unreadable profile %s: %s", location, err)
+                continue
+            if capture.get("profile"):
+                capture["profile"] = os.path.join(directory, capture["profile"])
+            captures.append(capture)
+    return captures
+
+
+def _format_cycles(captures: List[dict], top: int) -> List[str]:
+    cycles = sorted(captures, key=lambda capture: capture["duration"], reverse=True)[:top]
+    phases = [phase for phase in PHASES if any(phase in capture["phases"] for capture in cycles)]
+    phases += sorted({phase for capture in cycles for phase in capture["phases"]} - set(phases))
+    lines = [f"Slowest of {len(captures)} profiled cycles (seconds)"]
+    lines.append(f"{'Started':<21}{'Scope':<9}{'Total':>8}" + "".join(f"{phase.capitalize():>8}"
+                                                                      for phase in phases) + "  Profile")
+    for capture in cycles:
+        started = datetime.fromtimestamp(capture["started"]).strftime("%Y-%m-%d %H:%M:%S")
+        line = f"{started:<21}{capture['scope']:<9}{capture['duration']:>8.2f}"
+        line += "".join(f"{capture['phases'].get(phase, 0.0):>8.2f}" for phase in phases)
+        lines.append(f"{line}  {capture.get('profile') or '-'}")
+    return lines
+
+
+def _format_instruments(captures: List[dict], top: int) -> List[str]:
+    # instrument -> [cycles, slowest read, slowest submission, unfinished calls]
+    instruments: Dict[str, list] = {}
+    for capture in captures:
+        for instrument, timings in capture["instruments"].items():
+            totals = instruments.setdefault(instrument, [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] = max(totals[1], timings.get("read", 0.0))
+            totals[2] = max(totals[2], timings.get("submit", 0.0))
+        for instrument, _ in capture["unfinished"]:
+            instruments.setdefault(instrument, [0, 0.0, 0.0, 0])[3] += 1
+    lines = ["Slowest instruments (seconds)"]
+    lines.append(f"{'Instrument':<12}{'Cycles':>8}{'Read max':>10}{'Submit max':>12}{'Unfinished':>12}")
+    slowest = sorted(instruments.items(), key=lambda item: (item[1][3], max(item[1][1], item[1][2])), reverse=True)
+    for instrument, (count, read, submit, unfinished) in slowest[:top]:
+        lines.append(f"{instrument:<12}{count:>8}{read:>10.2f}{submit:>12.2f}{unfinished:>12}")
+    return lines
+
+
+def format_summary(captures: List[dict], top: int = 5) -> str:
+    """
+    Table of the slowest profiled cycles with the time spent in each phase,
+    and of the instruments that were slowest to read or submit in them
+    """
+    if not captures:
+        return "No detection cycles have been profiled"
+    return "\n".join(_format_cycles(captures, top) + [""] + _format_instruments(captures, top))
+
+
+def profile_report(csv_name, top: int = 5) -> str:
+    """
+    Summary of the slowest cycles profiled by the daemon or `--once` invocations, and by any replicas
+    """
+    directories = [profile_location(csv_name)] + sorted(glob.glob(f"{glob.escape(str(csv_name))}.*.profiles"))
+    return format_summary(load_captures(directories), top)
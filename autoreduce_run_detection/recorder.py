@@ -0,0 +1,103 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Trace of what run detection saw on the archive and how the submission sinks
+answered, written as JSON lines so that production traffic can be replayed
+against changes before they are deployed.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+LOGGING = logging.getLogger(__package__)
+
+
+class TraceRecorder:
+    """
+    Appends a line to the trace for each change in what an instrument's
+    lastrun.txt reads as, or in the error reading it, and for each
+    submission, e.g.
+
+        {"t":1664582400.12,"i":"WISH","run":"44735"}
+        {"t":1664582400.31,"i":"WISH","error":"InstrumentMonitorError: ..."}
+        {"t":1664582401.02,"i":"WISH","submit":[44734,44736],"d":0.084,"ok":true}
+
+    The file name is passed through time.strftime, so a pattern such as
+    trace-%Y%m%d.jsonl starts a new trace every day. Each trace starts with
+    the first observation of every instrument.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self._lock = threading.Lock()
+        self._location: Optional[str] = None
+        # instrument -> last run or error last recorded in the current trace
+        self._observed: Dict[str, str] = {}
+
+    def _write(self, entry: dict, instrument: str, observed: Optional[str] = None):
+        with self._lock:
+            location = time.strftime(self.pattern, time.localtime(entry["t"]))
+            if location != self._location:
+                self._location = location
+                self._observed = {}
+            if observed is not None:
+                if self._observed.get(instrument) == observed:
+                    return
+                self._observed[instrument] = observed
+            try:
+                with open(location, mode='a', encoding="utf-8") as trace:
+                    trace.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            except OSError as err:
+                LOGGING.warning("Unable to record to the trace %s: %s", location, err)
+
+    def observe(self, instrument: str, read: Callable[[], List[str]]) -> List[str]:
+        """
+        Read an instrument's lastrun.txt, recording the last run or error if it has changed
+        """
+        entry = {"t": round(time.time(), 3), "i": instrument}
+        try:
+            last_run_data = read()
+        except Exception as err:
+            entry["error"] = f"{type(err).__name__}: {err}"
+            self._write(entry, instrument, entry["error"])
+            raise
+        entry["run"] = last_run_data[1]
+        self._write(entry, instrument, entry["run"])
+        return last_run_data
+
+    def submitted(self, instrument: str, start_run: int, end_run: int, submit: Callable[[], object]) -> object:
+        """
+        Submit runs start_run up to but not including end_run, recording how long it took and whether it succeeded
+        """
+        entry = {"t": round(time.time(), 3), "i": instrument, "submit": [start_run, end_run]}
+        start = time.perf_counter()
+        try:
+            acknowledgement = submit()
+        except Exception as err:
+            entry.update(d=round(time.perf_counter() - start, 4), ok=False, error=f"{type(err).__name__}: {err}")
+            self._write(entry, instrument)
+            raise
+        entry.update(d=round(time.perf_counter() - start, 4), ok=True)
+        self._write(entry, instrument)
+        return acknowledgement
+
+
+def read_trace(location: str) -> Iterator[dict]:
+    """
+    The entries of a trace in the order they were recorded, skipping any
+    line cut short, e.g. by the process being killed while writing it
+    """
+    with open(location, mode='r', encoding="utf-8") as trace:
+        for number, line in enumerate(trace, start=1):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                LOGGING.warning("Skipping unreadable line %i of the trace %s", number, location)
+                continue
+            if isinstance(entry, dict) and "t" in entry and "i" in entry:
+                yield entry
@@ -0,0 +1,146 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+The instruments run detection is configured to monitor, compared with the
+rows of the state store so that instruments can be added, removed or moved
+without rebuilding the last runs CSV file.
+"""
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+# Fields of a row that can be overridden per instrument, in row order after the name and last run
+PATH_FIELDS = ("last_run_file", "summary_file", "data_dir", "file_ext")
+
+
+def archive_paths(instrument: str) -> Dict[str, str]:
+    """
+    Where an instrument's files are on the ISIS archive
+    """
+    return {
+        "last_run_file": f'/isis/NDX{instrument}/Instrument/logs/lastrun.txt',
+        "summary_file": f'/isis/NDX{instrument}/Instrument/logs/journal/summary.txt',
+        "data_dir": f'/isis/NDX{instrument}/Instrument/data',
+        "file_ext": '.nxs'
+    }
+
+
+class RegistryChanges(NamedTuple):
+    """
+    What has to change in the state store to match the configured instruments
+    """
+    added: List[str]
+    retired: List[str]
+    moved: List[List[str]]
+
+
+class InstrumentRegistry:
+    """
+    The instruments named in SUPPORTED_INSTRUMENTS and in the instrument
+    configuration file, a JSON object mapping instrument names to any of
+    last_run_file, summary_file, data_dir and file_ext to use instead of the
+    archive's, e.g. {"WISH": {}, "MARI": {"data_dir": "/archive/NDXMARI/data"}},
+    or to null for an instrument to retire, e.g. {"GEM": null}
+    """
+
+    def __init__(self, config_file: Optional[str] = None):
+        self.config_file = config_file
+        self._loaded = None
+        # Whether the last configuration loaded named the instruments in SUPPORTED_INSTRUMENTS,
+        # which then lists every instrument to monitor along with the configuration file
+        self.exhaustive = False
+
+    def _signature(self):
+        supported = os.environ.get("SUPPORTED_INSTRUMENTS")
+        if not self.config_file:
+            return supported, None
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return supported, None
+        return supported, (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def changed(self) -> bool:
+        """
+        Whether the configuration has changed since it was last loaded, true if it never has been
+        """
+        return self._loaded is None or self._signature() != self._loaded
+
+    def invalidate(self):
+        """
+        Load the configuration again next time, e.g. to retry instruments that could not be added
+        """
+        self._loaded = None
+
+    def load(self) -> Optional[Dict[str, Optional[Dict[str, str]]]]:
+        """
+        Read the configured instruments
+
+        Returns:
+            The path overrides of each instrument, in the configured order,
+            None for the instruments to retire, or None if no instruments are
+            configured
+        Raises:
+            OSError: If the configuration file can't be read
+            ValueError: If the configuration file is not a valid configuration
+        """
+        self._loaded = self._signature()
+        names = [name.strip() for name in os.environ.get("SUPPORTED_INSTRUMENTS", "").split(",") if name.strip()]
+        self.exhaustive = bool(names)
+        configured: Dict[str, Optional[Dict[str, str]]] = {name: {} for name in names}
+        if self.config_file:
+            with open(self.config_file, mode='r', encoding="utf-8") as config_file:
+                overrides = json.load(config_file)
+            if not isinstance(overrides, dict):
+                raise ValueError("expected an object mapping instrument names to their locations")
+            for name, paths in overrides.items():
+                if paths is not None and (not isinstance(paths, dict) or set(paths) - set(PATH_FIELDS)
+                                          or not all(isinstance(value, str) for value in paths.values())):
+                    raise ValueError(f"the locations of {name} should map any of {', '.join(PATH_FIELDS)} to a string, "
+                                     "or be null to retire it")
+                configured[name] = paths
+        return configured or None
+
+
+def monitored(configured: Dict[str, Optional[Dict[str, str]]]) -> Dict[str, Dict[str, str]]:
+    """
+    The path overrides of the configured instruments that are not to be retired
+    """
+    return {name: paths for name, paths in configured.items() if paths is not None}
+
+
+def plan_changes(rows: List[List[str]],
+                 configured: Dict[str, Optional[Dict[str, str]]],
+                 exhaustive: bool = False) -> RegistryChanges:
+    """
+    Compare the rows of the state store with the configured instruments.
+    The locations of an instrument are only changed where they are
+    overridden, so rows created or edited by hand are left alone. The
+    instruments configured to be retired are retired, and so are those that
+    aren't configured at all if the configuration is exhaustive, otherwise
+    their rows are kept.
+
+    Args:
+        rows: Rows of the state store
+        configured: The path overrides of each configured instrument, None for those to retire
+        exhaustive: Whether the configured instruments are all of those to monitor
+    Returns:
+        The instruments to add and to retire, and the rows of the
+        instruments whose locations have been overridden with their new
+        locations and unchanged last run
+    """
+    stored = {row[0]: row for row in rows}
+    moved = []
+    for name, overrides in monitored(configured).items():
+        row = stored.get(name)
+        if row is not None:
+            updated = row[:2] + [overrides.get(field, row[index]) for index, field in enumerate(PATH_FIELDS, start=2)]
+            if updated != row:
+                moved.append(updated)
+    return RegistryChanges(
+        added=[name for name in monitored(configured) if name not in stored],
+        retired=[row[0] for row in rows if configured.get(row[0]) is None and (exhaustive or row[0] in configured)],
+        moved=moved)
@@ -0,0 +1,287 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Replay of a trace recorded with TRACE_FILE through run detection, faster
+than it was recorded, against a synthetic archive and a stub autoreduce API, e.g.
+
+    python -m autoreduce_run_detection.replay trace-20221001.jsonl --speed 200
+
+Each instrument's lastrun.txt changes when it did in the trace and the stub
+API answers as slowly, and fails as often, as the API did. Reports whether
+the replay kept up, the detection cycle latency, the run latency in trace
+time, and any run that was acknowledged in the trace but not in the replay
+or that was submitted twice, in which case it exits with a status of 1.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from autoreduce_run_detection import run_detection
+from autoreduce_run_detection.benchmark import StubReductionAPI, SyntheticArchive, percentile
+from autoreduce_run_detection.latency import LatencyTracker
+from autoreduce_run_detection.locations import latency_location
+from autoreduce_run_detection.recorder import read_trace
+from autoreduce_run_detection.services import ContextOptions
+from autoreduce_run_detection.settings import CIRCUIT_RESET_TIMEOUT, POLL_INTERVAL
+
+LOGGING = logging.getLogger(__package__)
+
+
+class Observation(NamedTuple):
+    """
+    What an instrument's lastrun.txt read as from a time in the trace, None if it couldn't be read
+    """
+    time: float
+    instrument: str
+    run: Optional[int]
+
+
+class Trace(NamedTuple):
+    """
+    The observations and acknowledged runs of a trace, and how the API answered
+    """
+    observations: List[Observation]
+    # Where each instrument was before the trace started, including runs it submitted after catching up
+    first_runs: Dict[str, int]
+    acknowledged: Counter
+    latencies: List[float]
+    error_rate: float
+
+    @property
+    def start(self) -> float:
+        """
+        Time of the first observation
+        """
+        return self.observations[0].time
+
+    @property
+    def end(self) -> float:
+        """
+        Time of the last observation
+        """
+        return self.observations[-1].time
+
+
+def parse_trace(entries: Iterable[dict]) -> Trace:
+    """
+    Sort the entries of a trace into the observations to replay and the outcomes to compare against
+
+    Raises:
+        ValueError: If the trace has no observations
+    """
+    observations = []
+    submissions = []
+    for entry in entries:
+        if "submit" in entry:
+            submissions.append(entry)
+        elif "run" in entry or "error" in entry:
+            run = int(entry["run"]) if "run" in entry else None
+            observations.append(Observation(float(entry["t"]), entry["i"], run))
+    if not observations:
+        raise ValueError("the trace has no observations of lastrun.txt to replay")
+    observations.sort(key=lambda observation: observation.time)
+
+    first_runs = {}
+    for observation in observations:
+        if observation.run is not None:
+            first_runs.setdefault(observation.instrument, observation.run)
+    for observation in observations:
+        # Instruments that could never be read start from nothing
+        first_runs.setdefault(observation.instrument, 0)
+    acknowledged: Counter = Counter()
+    for entry in submissions:
+        instrument, (start_run, end_run) = entry["i"], entry["submit"]
+        if instrument not in first_runs:
+            # Submitted from the outbox after the instrument was retired
+            continue
+        first_runs[instrument] = min(first_runs[instrument], start_run - 1)
+        if entry.get("ok"):
+            acknowledged.update((instrument, run) for run in range(start_run, end_run))
+    return Trace(observations=observations,
+                 first_runs=first_runs,
+                 acknowledged=acknowledged,
+                 latencies=[entry["d"] for entry in submissions if entry.get("ok") and "d" in entry],
+                 error_rate=sum(not entry.get("ok") for entry in submissions) / len(submissions) if submissions else 0)
+
+
+class VirtualClock:
+    """
+    Clock of the scheduling and latency code, so that they see the time of the trace
+    """
+
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self) -> float:
+        """
+        The current time in the trace
+        """
+        return self.now
+
+
+def compare(trace: Trace, received: Counter) -> Tuple[int, int, int]:
+    """
+    Compare the runs acknowledged in the trace with the runs the stub API accepted in the replay
+
+    Returns:
+        The number of runs missed, submitted more than once and not acknowledged in the trace
+    """
+    missed = sum(1 for run in trace.acknowledged if run not in received)
+    duplicated = sum(count - 1 for count in received.values() if count > 1)
+    unexpected = sum(1 for run in received if run not in trace.acknowledged)
+    return missed, duplicated, unexpected
+
+
+def replay(location: str,
+           speed: float = 100,
+           interval: float = POLL_INTERVAL,
+           mode: str = "once",
+           seed: Optional[int] = 0) -> Dict[str, float]:
+    """
+    Replay a trace through run detection
+
+    Args:
+        location: The trace, as recorded with TRACE_FILE
+        speed: How many times faster than recorded to replay the trace
+        interval: Seconds of the trace between detection cycles
+        mode: "once" for an update_last_runs invocation per cycle, as with --once,
+              or "daemon" to reuse a RunDetectionDaemon between cycles
+        seed: Seed of the stub API, for repeatable replays
+    Returns:
+        The report of the replay
+    """
+    # pylint:disable=too-many-locals
+    if speed <= 0:
+        raise ValueError("the speed of the replay must be positive")
+    trace = parse_trace(read_trace(location))
+    instruments = sorted(trace.first_runs)
+    stub = StubReductionAPI(error_rate=trace.error_rate,
+                            seed=seed,
+                            latencies=[duration / speed for duration in trace.latencies])
+    stub.start()
+    clock = VirtualClock(trace.start)
+    durations = []
+    behind = 0
+    with tempfile.TemporaryDirectory() as root:
+        archive = SyntheticArchive(os.path.join(root, "isis"), instruments, first_runs=trace.first_runs)
+        csv_name = os.path.join(root, "last_runs.csv")
+        archive.write_csv(csv_name)
+        for row in archive.rows():
+            os.utime(row[2], (trace.start, trace.start))
+        # The recorded answers already include any retries, and the circuit breaker should
+        # stay open for as long in the trace's time as it would have
+        options = ContextOptions(api_url=stub.url,
+                                 api_retries=0,
+                                 circuit_reset_timeout=CIRCUIT_RESET_TIMEOUT / speed,
+                                 alerts=False,
+                                 record=False,
+                                 clock=clock.time)
+        daemon = run_detection.RunDetectionDaemon(csv_name, interval, options=options) if mode == "daemon" else None
+        pending = iter(trace.observations)
+        observation = next(pending, None)
+        started = time.perf_counter()
+        try:
+            while clock.now <= trace.end + interval:
+                while observation is not None and observation.time <= clock.now:
+                    written = archive.set_last_run(observation.instrument, observation.run)
+                    os.utime(written, (observation.time, observation.time))
+                    observation = next(pending, None)
+                start = time.perf_counter()
+                if daemon is not None:
+                    daemon.run_cycle()
+                else:
+                    run_detection.update_last_runs(csv_name, options=options)
+                durations.append(time.perf_counter() - start)
+                clock.now += interval
+                # Keep to the speed of the replay, a cycle taking longer than interval / speed falls behind
+                ahead = (clock.now - trace.start) / speed - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+                else:
+                    behind += 1
+        finally:
+            if daemon is not None:
+                daemon.context.close()
+        elapsed = time.perf_counter() - started
+        timings = LatencyTracker.load(latency_location(csv_name)).timings()
+    stub.stop()
+
+    run_latencies = [timing.stage("total") for runs in timings.values() for timing in runs]
+    missed, duplicated, unexpected = compare(trace, stub.received)
+    return {
+        "instruments": len(instruments),
+        "traced_seconds": trace.end - trace.start,
+        "cycles": len(durations),
+        "speed": speed,
+        "achieved_speed": (clock.now - trace.start) / elapsed if elapsed else 0.0,
+        "cycles_behind": behind,
+        "cycle_p50": percentile(durations, 0.5),
+        "cycle_p99": percentile(durations, 0.99),
+        "cycle_max": max(durations, default=0.0),
+        "runs_acknowledged": len(trace.acknowledged),
+        "runs_submitted": stub.runs_received,
+        "runs_missed": missed,
+        "runs_duplicated": duplicated,
+        "runs_unexpected": unexpected,
+        "run_latency_p50": percentile(run_latencies, 0.5),
+        "run_latency_p99": percentile(run_latencies, 0.99),
+        "api_requests": stub.requests,
+        "api_errors": stub.errors
+    }
+
+
+def format_report(report: Dict[str, float]) -> str:
+    """
+    Human readable form of a replay report
+    """
+    return "\n".join([
+        f"{report['instruments']} instruments, {report['traced_seconds']:.0f}s of trace in {report['cycles']} cycles",
+        f"speed: {report['achieved_speed']:.1f}x of {report['speed']:.1f}x, "
+        f"{report['cycles_behind']} cycles fell behind",
+        f"cycle latency: p50 {report['cycle_p50']:.4f}s  p99 {report['cycle_p99']:.4f}s  "
+        f"max {report['cycle_max']:.4f}s",
+        f"runs: {report['runs_acknowledged']} acknowledged in the trace, {report['runs_submitted']} submitted in "
+        f"{report['api_requests']} requests ({report['api_errors']} failed)",
+        f"correctness: {report['runs_missed']} missed, {report['runs_duplicated']} duplicated, "
+        f"{report['runs_unexpected']} not in the trace",
+        f"run latency in the trace's time: p50 {report['run_latency_p50']:.1f}s  p99 {report['run_latency_p99']:.1f}s",
+    ])
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Replay entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", help="Trace recorded with TRACE_FILE")
+    parser.add_argument("--speed", type=float, default=100, help="How many times faster than recorded to replay")
+    parser.add_argument("--interval",
+                        type=float,
+                        default=POLL_INTERVAL,
+                        help="Seconds of the trace between detection cycles")
+    parser.add_argument("--mode",
+                        choices=["once", "daemon"],
+                        default="once",
+                        help="Run each cycle as a --once invocation or in a resident daemon")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the stub API")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON, e.g. to keep for comparison")
+    args = parser.parse_args(argv)
+
+    # The per-cycle logging of run detection would dominate the timings
+    logging.getLogger(__package__).setLevel(logging.WARNING)
+    report = replay(args.trace, speed=args.speed, interval=args.interval, mode=args.mode, seed=args.seed)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    if report["runs_missed"] or report["runs_duplicated"]:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()  # pragma: no cover
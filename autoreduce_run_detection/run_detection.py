@@ -8,32 +8,58 @@ End of run monitor. Detects new runs that arrive and
 sends them off to the autoreduction service.
 """
 
-import copy
+import argparse
 import csv
 import logging
 import os
-from typing import Optional
+import signal
+import sqlite3
+import threading
+import time
+from functools import partial
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set
 from pathlib import Path
 
 from filelock import FileLock, Timeout
-import requests
-from requests.models import Response
 
-from autoreduce_run_detection.settings import LOCAL_CACHE_LOCATION, AUTOREDUCE_API_URL, AUTOREDUCE_TOKEN, TEAMS_URL
+from autoreduce_run_detection.settings import (LOCAL_CACHE_LOCATION, TEAMS_URL, POLL_WORKERS, READ_TIMEOUT,
+                                               SUBMIT_TIMEOUT, POLL_INTERVAL, FALLBACK_POLL_INTERVAL, SUBMIT_CHUNK_SIZE,
+                                               SUBMIT_RANGES, OUTBOX, SUMMARY_METADATA, WAIT_FOR_DATA_FILES,
+                                               METRICS_PORT, METRICS_ADDRESS, METRICS_TEXTFILE, ADAPTIVE_POLLING,
+                                               SHARDING, REPLICA_ID, BACKFILL_RATE, BACKFILL_WORKERS, INSTRUMENT_CONFIG,
+                                               PROFILE_SLOW_CYCLE, TRACE_FILE)
+from autoreduce_run_detection.alerts import AlertDispatcher
+from autoreduce_run_detection.api import CircuitBreaker, LazySession, create_session
+from autoreduce_run_detection.backfill import BackfillCheckpoint, run_backfill, run_range
+from autoreduce_run_detection.data_index import DataIndex, list_runs
+from autoreduce_run_detection.latency import LatencyTracker, latency_report
+from autoreduce_run_detection.leases import LeaseManager
+from autoreduce_run_detection.locations import (backfill_location, data_index_location, latency_location,
+                                                ledger_location, outbox_location, profile_location, schedule_location,
+                                                stat_cache_location, summary_index_location)
+from autoreduce_run_detection.ledger import SubmissionLedger
+from autoreduce_run_detection.metrics import (CYCLE_SECONDS, DUPLICATE_RUNS, LAST_RUN_READ_SECONDS, LOCK_WAIT_SECONDS,
+                                              RUNS_SUBMITTED, SUBMIT_SECONDS, MetricsServer, write_textfile)
+from autoreduce_run_detection.outbox import Outbox, OutboxDrainer
+from autoreduce_run_detection.profiling import CycleProfile, CycleProfiler, profile_report, timed_call, timed_phase
+from autoreduce_run_detection.recorder import TraceRecorder
+from autoreduce_run_detection.registry import PATH_FIELDS, InstrumentRegistry, archive_paths, monitored, plan_changes
+from autoreduce_run_detection.schedule import PollSchedule
+from autoreduce_run_detection.services import ContextOptions, MonitorServices
+from autoreduce_run_detection.sinks import APISink, SinkUnavailable, SubmissionError, create_sink
+from autoreduce_run_detection.stat_cache import StatCache
+from autoreduce_run_detection.summary import SummaryIndex
+from autoreduce_run_detection.state import StateStore, open_state_store
+from autoreduce_run_detection.watcher import LastRunWatcher
+from autoreduce_run_detection.workers import PollWorkers
+
+if TYPE_CHECKING:
+    import requests
 
 # pylint:disable=abstract-class-instantiated
 
 LOGGING = logging.getLogger(__package__)
 
-TEAMS_CARD_DATA = {
-    "@context": "https://schema.org/extensions",
-    "@type": "MessageCard",
-    "themeColor": "0072C6",
-    "title": "Alert Raised",
-    "text": "",
-    "potentialAction": []
-}
-
 
 class InstrumentMonitorError(Exception):
     """
@@ -44,7 +70,7 @@ class InstrumentMonitorError(Exception):
 
 class InstrumentMonitor:
     """
-    Checks the ISIS archive for new runs on an instrument and submits them to ActiveMQ
+    Checks the ISIS archive for new runs on an instrument and submits them to the autoreduce API or ActiveMQ
     """
 
     def __init__(self,
@@ -53,123 +79,638 @@ class InstrumentMonitor:
                  summary_file: str = "",
                  data_dir: str = "",
                  file_ext: str = "",
-                 teams_url: Optional[str] = None):
+                 services: MonitorServices = MonitorServices()):
         self.instrument_name = instrument_name
         self.last_run_file = last_run_file
         self.summary_file = summary_file
         self.data_dir = data_dir
         self.file_ext = file_ext
-        self.teams_url = teams_url
+        self.alerts = services.alerts
+        self.session = services.session
+        # Submits to the REST API with the monitor's own circuit breaker if no sink is shared
+        self.sink = services.sink if services.sink is not None else APISink(services.session, services.breaker,
+                                                                            services.alerts)
+        self.stat_cache = services.stat_cache
+        self.outbox = services.outbox
+        self.summary_index = services.summary_index
+        self.data_index = services.data_index
+        self.ledger = services.ledger
+        self.latency = services.latency
+        self.recorder = services.recorder
 
     def read_instrument_last_run(self):
         """
-        Read the last run recorded by the instrument from its lastrun.txt
+        Read the last run recorded by the instrument from its lastrun.txt,
+        skipping the read if the file is unchanged since it was last read
 
         Returns:
             Last run on the instrument as a string
         """
+        with LAST_RUN_READ_SECONDS.time(instrument=self.instrument_name):
+            if self.recorder is not None:
+                return self.recorder.observe(self.instrument_name, self._read_cached_last_run_file)
+            return self._read_cached_last_run_file()
+
+    def _read_cached_last_run_file(self):
+        if self.stat_cache is not None:
+            return self.stat_cache.read(self.last_run_file, self._read_last_run_file)
+        return self._read_last_run_file()
+
+    def _read_last_run_file(self):
         with open(self.last_run_file, mode='r', encoding="utf-8") as last_run:
             line_parts = last_run.readline().split()
             if len(line_parts) != 3:
                 raise InstrumentMonitorError(f"Unexpected last run file format for '{self.last_run_file}'")
         return line_parts
 
-    def submit_runs(self, start_run, end_run) -> Response:
+    def submit_runs(self, start_run, end_run) -> object:
         """
-        Submit a run via the REST API
+        Submit a range of runs to the sink, the REST API by default. With a
+        ledger, runs it shows were already acknowledged are left out.
 
         Args:
-            summary_rb_number: RB number of the experiment as read from the summary file
-            run_number: Run number as it appears in lastrun.txt
-            file_name: File name e.g. GEM1234.nxs
-        """
-        runs = list(range(start_run, end_run))
-        runs_str = ",".join([str(run) for run in runs])
-        # Check to see if the last run exists, if not then raise an exception
-        LOGGING.info("Submitting runs in range %s for %s to %s", runs_str, self.instrument_name,
-                     f"{AUTOREDUCE_API_URL}/runs/{self.instrument_name}")
+            start_run: First run number to submit
+            end_run: Run number after the last one to submit
+        Returns:
+            The acknowledgement of the sink, e.g. the response of the API, or
+            a list of them if the runs were submitted in several parts
+        """
+        if self.recorder is not None:
+            return self.recorder.submitted(self.instrument_name, start_run, end_run,
+                                           partial(self._submit_unacknowledged, start_run, end_run))
+        return self._submit_unacknowledged(start_run, end_run)
+
+    def _submit_unacknowledged(self, start_run, end_run) -> object:
+        if self.ledger is None:
+            return self._submit_range(start_run, end_run)
+        ranges = self.ledger.unacknowledged(self.instrument_name, start_run, end_run)
+        duplicates = end_run - start_run - sum(end - start for start, end in ranges)
+        if duplicates:
+            LOGGING.warning("Not submitting %i runs in range %i-%i for %s again, they were already acknowledged",
+                            duplicates, start_run, end_run - 1, self.instrument_name)
+            DUPLICATE_RUNS.inc(duplicates, instrument=self.instrument_name)
+        acknowledgements = [self._submit_range(start, end) for start, end in ranges]
+        if not acknowledgements:
+            return f"Runs {start_run}-{end_run - 1} for {self.instrument_name} were already acknowledged"
+        return acknowledgements[0] if len(acknowledgements) == 1 else acknowledgements
+
+    def _submit_range(self, start_run, end_run) -> object:
+        runs_str = f"{start_run}-{end_run - 1}"
+        if SUBMIT_RANGES:
+            payload = {"start": start_run, "end": end_run - 1}
+        else:
+            payload = {"runs": list(range(start_run, end_run))}
+        payload["user_id"] = 0  # AUTOREDUCTTION_SERVICE user id
+        if self.summary_index is not None and self.summary_file:
+            metadata = self.summary_index.metadata(self.instrument_name, self.summary_file, start_run, end_run)
+            if metadata:
+                payload["metadata"] = metadata
+        LOGGING.info("Submitting runs in range %s for %s to %s", runs_str, self.instrument_name, self.sink)
         try:
-            response = requests.post(
-                f"{AUTOREDUCE_API_URL}/runs/{self.instrument_name}",
-                json={
-                    "runs": runs,
-                    "user_id": 0  # AUTOREDUCTTION_SERVICE user id
-                },
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Token {AUTOREDUCE_TOKEN}"
-                })
-
-            if response.status_code != 200:
-                LOGGING.error("Request error when submitting runs in range %s for %s, error: %s", runs_str,
-                              self.instrument_name, response.text)
-                raise InstrumentMonitorError(f"Request status code is not 200, error: {response.text}")
-            return response
-        except requests.exceptions.RequestException as err:
+            with SUBMIT_SECONDS.time(instrument=self.instrument_name):
+                acknowledgement = self.sink.submit(self.instrument_name, start_run, end_run, payload)
+        except SinkUnavailable as err:
             LOGGING.error("Failed to submit runs %i - %i for instrument %s", start_run, end_run, self.instrument_name)
-            if self.teams_url:
-                data = copy.deepcopy(TEAMS_CARD_DATA)
-                data["text"] = f"Failed to submit runs {runs} for instrument {self.instrument_name}"
-                try:
-                    requests.post(self.teams_url, json=data)
-                except requests.exceptions.RequestException:
-                    LOGGING.error("Failed to send message using this TEAMS url: %s", self.teams_url)
+            if self.alerts is not None:
+                error_class = type(err.__cause__ or err).__name__
+                self.alerts.alert(self.instrument_name, error_class,
+                                  f"Failed to submit runs {runs_str} for instrument {self.instrument_name}")
             else:
                 LOGGING.info("No TEAMS_URL set, not sending message to Teams")
             raise InstrumentMonitorError() from err
-
-    def submit_run_difference(self, local_last_run):
+        except SubmissionError as err:
+            LOGGING.error("Error when submitting runs in range %s for %s, error: %s", runs_str, self.instrument_name,
+                          err)
+            raise InstrumentMonitorError(str(err)) from err
+        RUNS_SUBMITTED.inc(end_run - start_run, instrument=self.instrument_name)
+        if self.ledger is not None:
+            try:
+                self.ledger.record(self.instrument_name, start_run, end_run)
+            except sqlite3.Error as err:
+                LOGGING.error("Unable to record runs %s for %s in the ledger: %s", runs_str, self.instrument_name, err)
+        if self.latency is not None:
+            self.latency.acknowledged(self.instrument_name, start_run, end_run)
+        return acknowledgement
+
+    def submit_run_difference(self,
+                              local_last_run,
+                              last_run_data: Optional[List[str]] = None,
+                              on_progress: Optional[Callable[[str], None]] = None):
         """
         Submit the difference between the last run on the archive for this
-        instrument
+        instrument, in chunks of at most SUBMIT_CHUNK_SIZE runs, or queue it
+        in the outbox if there is one. With a data index, runs from the first
+        one whose data file hasn't landed yet are held back until a later call.
         Args:
             local_last_run: Local last run to check against
+            last_run_data: Already read contents of lastrun.txt, read from the archive if not given
+            on_progress: Called with the last submitted run after each acknowledged chunk, so
+                         progress is kept if a later chunk fails
         """
         # Get archive lastrun.txt
-        last_run_data = self.read_instrument_last_run()
+        if last_run_data is None:
+            last_run_data = self.read_instrument_last_run()
         instrument_last_run = last_run_data[1]
 
         local_run_int = int(local_last_run)
         instrument_run_int = int(instrument_last_run)
+        if self.latency is not None and instrument_run_int > local_run_int:
+            try:
+                written = os.stat(self.last_run_file).st_mtime
+            except OSError as err:
+                LOGGING.warning("Unable to find when %s was written: %s", self.last_run_file, err)
+            else:
+                self.latency.detected(self.instrument_name, local_run_int + 1, instrument_run_int + 1, written)
+
+        end_run = instrument_run_int + 1
+        if self.data_index is not None and instrument_run_int > local_run_int:
+            end_run = self.data_index.ready_until(self.instrument_name, self.data_dir, self.file_ext, local_run_int + 1,
+                                                  end_run)
+            if end_run <= local_run_int + 1:
+                return str(local_run_int)
+
+        if self.outbox is not None:
+            if end_run > local_run_int + 1:
+                self.outbox.enqueue(self.instrument_name, local_run_int + 1, end_run)
+                LOGGING.info("Queued runs %i - %i for %s", local_run_int + 1, end_run - 1, self.instrument_name)
+                if on_progress is not None:
+                    on_progress(str(end_run - 1))
+            return str(end_run - 1)
+
+        for chunk_start in range(local_run_int + 1, end_run, SUBMIT_CHUNK_SIZE):
+            chunk_end = min(chunk_start + SUBMIT_CHUNK_SIZE, end_run)
+            LOGGING.info(self.submit_runs(chunk_start, chunk_end))
+            if on_progress is not None:
+                on_progress(str(chunk_end - 1))
+        return str(end_run - 1)
+
+
+def _instrument_monitor(row: List[str], services: MonitorServices) -> InstrumentMonitor:
+    return InstrumentMonitor(instrument_name=row[0],
+                             last_run_file=row[2],
+                             summary_file=row[3],
+                             data_dir=row[4],
+                             file_ext=row[5],
+                             services=services)
+
+
+def poll_instruments(
+    rows: List[List[str]],
+    monitors: Optional[Dict[str, InstrumentMonitor]] = None,
+    on_update: Optional[Callable[[List[str]], None]] = None,
+    cycle: Optional[CycleProfile] = None,
+    workers: Optional[PollWorkers] = None,
+    observed: Optional[Dict[str, str]] = None,
+    services: MonitorServices = MonitorServices()) -> List[List[str]]:
+    """
+    Poll every instrument in parallel and submit any new runs. The archive is
+    read for all instruments first, then the new runs are submitted, each
+    phase with its own per-instrument deadline. A failing or hung instrument
+    keeps its previous last run and does not hold back the others, and is
+    skipped until the read or submission that missed its deadline returns.
+
+    Args:
+        rows: Rows of the last runs CSV file, updated in place
+        monitors: Instrument monitors kept between cycles, keyed by instrument name.
+                  Missing monitors are created and added to it.
+        on_update: Called with an instrument's row as soon as its last run advances
+        cycle: Profile of the cycle, to time each instrument's lastrun.txt read and submission
+        workers: Workers kept between cycles, the instruments are polled on their own workers if not given
+        observed: Filled with the last run read from the lastrun.txt of each instrument that could be read,
+                  which may be ahead of its row if runs were held back or failed to submit
+        services: Shared by the InstrumentMonitor created for each instrument without a monitor
+    Returns:
+        The updated rows, in the same order as given
+    """
+    if monitors is None:
+        monitors = {}
+    for row in rows:
+        LOGGING.info("Processing instrument %s with last run %i", row[0], int(row[1]))
+        if row[0] not in monitors:
+            monitors[row[0]] = _instrument_monitor(row, services)
+
+    def _advance(index, last_run):
+        rows[index][1] = last_run
+        if on_update is not None:
+            on_update(rows[index])
+
+    def _submit(index):
+        return monitors[rows[index][0]].submit_run_difference(rows[index][1], last_run_data[index],
+                                                              partial(_advance, index))
+
+    executor = workers if workers is not None else PollWorkers(min(POLL_WORKERS, len(rows)))
+    try:
+        with timed_phase(cycle, "read"):
+            last_run_data = executor.call_with_deadlines(
+                {
+                    index: (row[0], timed_call(cycle, row[0], "read", monitors[row[0]].read_instrument_last_run))
+                    for index, row in enumerate(rows)
+                }, READ_TIMEOUT)
+        if observed is not None:
+            observed.update(
+                (rows[index][0], data[1]) for index, data in last_run_data.items() if not isinstance(data, Exception))
+        with timed_phase(cycle, "submit"):
+            submissions = executor.call_with_deadlines(
+                {
+                    index: (rows[index][0], timed_call(cycle, rows[index][0], "submit", partial(_submit, index)))
+                    for index in range(len(rows)) if not isinstance(last_run_data[index], Exception)
+                }, SUBMIT_TIMEOUT)
+    finally:
+        if workers is None:
+            # Don't wait for workers stuck on a hung mount, they are daemon threads
+            executor.shutdown()
+
+    # Merge the outcomes back in CSV order so the logs and state are deterministic
+    for index, row in enumerate(rows):
+        outcome = submissions.get(index, last_run_data[index])
+        if isinstance(outcome, Exception):
+            LOGGING.error(outcome)
+        else:
+            row[1] = outcome
+    return rows
+
+
+def submit_queued_runs(monitors: Dict[str, InstrumentMonitor], services: MonitorServices, instrument: str,
+                       start_run: int, end_run: int):
+    """
+    Submit runs taken from the outbox, raising InstrumentMonitorError if they are not acknowledged
+
+    Args:
+        services: Shared by the InstrumentMonitor created if the instrument is no longer monitored, which
+                  submits the runs straight away, without reading any file of the instrument
+    """
+    monitor = monitors.get(instrument)
+    if monitor is None:
+        monitor = InstrumentMonitor(instrument,
+                                    services=services._replace(stat_cache=None,
+                                                               outbox=None,
+                                                               summary_index=None,
+                                                               data_index=None))
+        LOGGING.warning("Submitting queued runs of %s, which is no longer monitored, without metadata", instrument)
+    LOGGING.info(monitor.submit_runs(start_run, end_run))
+
+
+class RunDetectionContext:
+    """
+    Everything kept alongside the last runs CSV file and shared by the
+    instrument monitors between cycles: the state store and instrument
+    registry, the HTTP session, the submission sink and ledger, the caches
+    and indexes, the run latencies, the alert dispatcher and API circuit
+    breaker, and the optional outbox, polling schedule and trace recorder.
+
+    A replica sharing the instruments with others keeps its own caches,
+    indexes and outbox, named after it, and only its changes to the last
+    runs are written to the shared state store.
+
+    The API URL and a few other settings can be given in `options` rather
+    than taken from the environment, e.g. by the benchmark and replay.
+    """
+
+    def __init__(self, csv_name, replica: Optional[str] = None, options: ContextOptions = ContextOptions()):
+        self.csv_name = csv_name
+        # Base name of the files kept for this process only
+        self.cache_name = csv_name if replica is None else f"{csv_name}.{replica}"
+        # Created when the first runs are submitted, most --once invocations have nothing to submit
+        self.session = LazySession(create_session)
+        self.breaker = CircuitBreaker() if options.circuit_reset_timeout is None else CircuitBreaker(
+            reset_timeout=options.circuit_reset_timeout)
+        self.alerts = AlertDispatcher(TEAMS_URL) if TEAMS_URL and options.alerts else None
+        if self.alerts is not None:
+            self.alerts.start()
+        # Shared by the replicas, an instrument taken over keeps its acknowledged runs
+        self.ledger = SubmissionLedger(ledger_location(csv_name))
+        self.sink = create_sink(self.session,
+                                self.breaker,
+                                self.alerts,
+                                ledger=self.ledger,
+                                api_url=options.api_url,
+                                api_retries=options.api_retries)
+        self.store: StateStore = open_state_store(csv_name, shared=replica is not None)
+        self.registry = InstrumentRegistry(INSTRUMENT_CONFIG)
+        self.stat_cache = options.stat_cache if options.stat_cache is not None else StatCache.load(
+            stat_cache_location(self.cache_name))
+        self.outbox = Outbox(outbox_location(self.cache_name)) if OUTBOX else None
+        self.summary_index = SummaryIndex.load(summary_index_location(self.cache_name)) if SUMMARY_METADATA else None
+        self.clock = options.clock
+        self.data_index = DataIndex.load(data_index_location(self.cache_name),
+                                         self.clock) if WAIT_FOR_DATA_FILES else None
+        self.schedule = PollSchedule.load(schedule_location(self.cache_name), self.clock) if ADAPTIVE_POLLING else None
+        self.latency = LatencyTracker.load(latency_location(self.cache_name), self.clock)
+        self.recorder = TraceRecorder(TRACE_FILE) if TRACE_FILE and options.record else None
+        # Kept between cycles, so an instrument stuck on a hung mount holds on to one thread at most
+        self.workers = PollWorkers()
+        self.services = MonitorServices(alerts=self.alerts,
+                                        breaker=self.breaker,
+                                        session=self.session,
+                                        sink=self.sink,
+                                        stat_cache=self.stat_cache,
+                                        outbox=self.outbox,
+                                        summary_index=self.summary_index,
+                                        data_index=self.data_index,
+                                        ledger=self.ledger,
+                                        latency=self.latency,
+                                        recorder=self.recorder)
+        self.monitors: Dict[str, InstrumentMonitor] = {}
+
+    def reconcile(self, rows: List[List[str]]) -> List[List[str]]:
+        """
+        Bring the state store in line with the configured instruments if the
+        configuration has changed: add the new instruments, retire the ones
+        configured to be retired or, with SUPPORTED_INSTRUMENTS set, not
+        configured at all, and move the ones whose locations are overridden,
+        leaving the other rows as they are
+
+        Args:
+            rows: Rows of the state store
+        Returns:
+            The rows of the instruments to monitor
+        """
+        if not self.registry.changed():
+            return rows
+        try:
+            configured = self.registry.load()
+        except (OSError, ValueError) as err:
+            LOGGING.error("Keeping the current instruments, unable to read %s: %s", self.registry.config_file, err)
+            return rows
+        if configured is None:
+            return rows
+        changes = plan_changes(rows, configured, self.registry.exhaustive)
+        if not any(changes):
+            return rows
+
+        for instrument in changes.retired:
+            LOGGING.info("Retiring instrument %s as it is no longer configured to be monitored", instrument)
+            self.store.remove(instrument)
+            self.monitors.pop(instrument, None)
+        for row in changes.moved:
+            LOGGING.info("Moving instrument %s to %s", row[0], ", ".join(row[2:]))
+            self.store.update(row)
+            # Created again with the new locations
+            self.monitors.pop(row[0], None)
+        added = new_csv_rows(changes.added, configured, self.workers) if changes.added else []
+        for row in added:
+            self.store.update(row)
+        if len(added) < len(changes.added):
+            # Try again next cycle to add the instruments whose lastrun.txt couldn't be read
+            self.registry.invalidate()
+        self.store.flush()
+        return self.store.load()
+
+    def poll(self, rows: List[List[str]], due_only: bool = False, cycle: Optional[CycleProfile] = None):
+        """
+        Poll the instruments of the rows, recording each advance in the state store
 
-        if instrument_run_int > local_run_int:
-            LOGGING.info(self.submit_runs(local_run_int + 1, instrument_run_int + 1))
-        return str(instrument_run_int)
+        Args:
+            rows: Rows of the instruments to poll
+            due_only: With an adaptive polling schedule, only poll the instruments that are due
+            cycle: Profile of the cycle, if it is being profiled
+        """
+        if self.schedule is not None and due_only:
+            rows = self.schedule.due(rows)
+        observed: Dict[str, str] = {}
+        poll_instruments(rows,
+                         self.monitors,
+                         on_update=self.store.update,
+                         cycle=cycle,
+                         workers=self.workers,
+                         observed=observed,
+                         services=self.services)
+        if self.schedule is not None:
+            # Scheduled on what the archive reads as, runs held back or not yet acknowledged still count as a change
+            self.schedule.observe([[row[0], observed.get(row[0])] for row in rows])
+
+    def next_due(self, rows: List[List[str]], default: float) -> float:
+        """
+        Monotonic time at which the next instrument is due to be polled, or
+        `default` if that is sooner
+        """
+        if self.schedule is None:
+            return default
+        now = time.monotonic()
+        due = now + self.schedule.next_due(rows) - self.clock()
+        # Instruments whose poll failed may already be due again, don't poll them in a tight loop
+        return min(default, max(due, now + 1.0))
+
+    def submit_queued_runs(self, instrument: str, start_run: int, end_run: int):
+        """
+        Submit runs taken from the outbox
+        """
+        submit_queued_runs(self.monitors, self.services, instrument, start_run, end_run)
 
+    def save(self):
+        """
+        Persist the state and caches for the next cycle or invocation
+        """
+        # Write any changes not written as they happened
+        self.store.flush()
+        self.stat_cache.save(stat_cache_location(self.cache_name))
+        if self.summary_index is not None:
+            self.summary_index.save(summary_index_location(self.cache_name))
+        if self.data_index is not None:
+            self.data_index.save(data_index_location(self.cache_name))
+        if self.schedule is not None:
+            self.schedule.save(schedule_location(self.cache_name))
+        self.latency.save(latency_location(self.cache_name))
+
+    def report(self):
+        """
+        Log the cache and outbox statistics and the run latencies
+        """
+        self.stat_cache.report()
+        self.latency.report()
+        if self.outbox is not None:
+            self.outbox.report()
 
-def update_last_runs(csv_name):
+    def close(self):
+        """
+        Send any queued alerts and release the sink, session, state store, ledger, outbox and workers
+        """
+        if self.alerts is not None:
+            self.alerts.stop()
+        self.sink.close()
+        self.session.close()
+        self.store.close()
+        self.ledger.close()
+        if self.outbox is not None:
+            self.outbox.close()
+        self.workers.shutdown()
+
+
+def update_last_runs(csv_name,
+                     profile: bool = False,
+                     lock_wait: Optional[float] = None,
+                     options: ContextOptions = ContextOptions()):
     """
     Read the last runs CSV file and bring it up to date with the
     instrument lastrun.txt
 
     Args:
         csv_name: File name of the local last runs CSV file
+        profile: Keep the profile of the invocation even if it isn't slow
+        lock_wait: Seconds spent waiting for the lock on the last runs CSV file, counted as part of the invocation
+        options: Options of the run detection context, e.g. the API URL, left to the settings if not given
+    """
+    profiler = CycleProfiler(profile_location(csv_name), always=profile)
+    with profiler.cycle("once", lock_wait) as cycle:
+        with timed_phase(cycle, "open"):
+            context = RunDetectionContext(csv_name, options=options)
+        try:
+            with CYCLE_SECONDS.time(scope="all"):
+                with timed_phase(cycle, "load"):
+                    rows = context.reconcile(context.store.load())
+                context.poll(rows, due_only=True, cycle=cycle)
+                with timed_phase(cycle, "save"):
+                    context.save()
+                if context.outbox is not None:
+                    # There is no background drainer between invocations, make one attempt at what is due
+                    with timed_phase(cycle, "outbox"):
+                        context.outbox.drain(context.submit_queued_runs)
+            context.report()
+        finally:
+            context.close()
+
+
+class RunDetectionDaemon:
     """
-    # Loop over instruments
-    output = []
-    with open(csv_name, mode='r', encoding="utf-8") as csv_file:
-        csv_reader = csv.reader(csv_file)
-        for row in csv_reader:
-            LOGGING.info("Processing instrument %s with last run %i", row[0], int(row[1]))
-            inst_mon = InstrumentMonitor(instrument_name=row[0],
-                                         last_run_file=row[2],
-                                         summary_file=row[3],
-                                         data_dir=row[4],
-                                         file_ext=row[5],
-                                         teams_url=TEAMS_URL)
+    Resident detection loop. The last runs, instrument monitors and HTTP
+    session are kept in memory between cycles and the state store is only
+    written when a last run has changed. The instruments are reconciled with
+    their configuration at the start of a full poll whenever it has changed.
 
-            try:
-                last_run = inst_mon.submit_run_difference(row[1])
-                row[1] = last_run
-            except InstrumentMonitorError as ex:
-                LOGGING.error(ex)
-            output.append(row)
+    With a watcher, instruments are polled as soon as their lastrun.txt is
+    written and every instrument is polled every `interval` seconds as a
+    fallback for mounts that don't deliver events.
 
-    # Write any changes to the CSV
-    with open(csv_name, mode='w', encoding="utf-8", newline='') as csv_file:
-        csv_writer = csv.writer(csv_file)
-        for row in output:
-            csv_writer.writerow(row)
+    With an adaptive polling schedule, each full poll only polls the
+    instruments that are due and the next one starts when an instrument is
+    due, or after `interval` seconds at the latest.
+
+    With leases, only the instruments this replica holds the lease on are
+    polled. The leases are renewed, and instruments taken over from or
+    handed to other replicas, every third of the lease time to live.
+
+    The profiles of slow cycles, or of every cycle with `profile`, are kept.
+    """
+
+    def __init__(self,
+                 csv_name,
+                 interval: float = POLL_INTERVAL,
+                 watcher: Optional[LastRunWatcher] = None,
+                 leases: Optional[LeaseManager] = None,
+                 profile: bool = False,
+                 options: ContextOptions = ContextOptions()):
+        self.csv_name = csv_name
+        self.interval = interval
+        self.watcher = watcher
+        self.leases = leases
+        self.rows: Optional[List[List[str]]] = None
+        self.context = RunDetectionContext(csv_name, leases.replica if leases is not None else None, options)
+        self.profiler = CycleProfiler(profile_location(self.context.cache_name), always=profile)
+        self._stopping = threading.Event()
+        self._next_claim = 0.0
+        self._last_claim = time.monotonic()
+
+    def stop(self, *_):
+        """
+        Ask the loop to stop once the current cycle is done. Usable as a signal handler.
+        """
+        LOGGING.info("Stopping run detection")
+        self._stopping.set()
+
+    def _claim(self):
+        """
+        Renew this replica's leases and take over or hand over instruments as replicas come and go
+        """
+        self._next_claim = time.monotonic() + self.leases.ttl / 3
+        owned = set(self.leases.owned)
+        try:
+            gained = self.leases.claim(row[0] for row in self.rows) - owned
+        except OSError as err:
+            LOGGING.error("Unable to renew instrument leases: %s", err)
+            if time.monotonic() - self._last_claim > self.leases.ttl:
+                # The leases have expired and may have been taken over, stop polling until they are renewed
+                self.leases.owned = set()
+            return
+        self._last_claim = time.monotonic()
+        if gained:
+            # The instruments taken over may have been advanced by another replica
+            self.rows = self.context.store.load()
+
+    def run_cycle(self, instruments: Optional[Set[str]] = None):
+        """
+        Poll the instruments once and save any changes
+
+        Args:
+            instruments: Names of the instruments to poll, all of them if not given
+        """
+        scope = "all" if instruments is None else "changed"
+        with CYCLE_SECONDS.time(scope=scope), self.profiler.cycle(scope) as cycle:
+            with timed_phase(cycle, "load"):
+                if self.rows is None:
+                    self.rows = self.context.store.load()
+                if instruments is None:
+                    self.rows = self.context.reconcile(self.rows)
+            if self.leases is not None and time.monotonic() >= self._next_claim:
+                with timed_phase(cycle, "claim"):
+                    self._claim()
+            rows = self.rows if instruments is None else [row for row in self.rows if row[0] in instruments]
+            if self.leases is not None:
+                rows = [row for row in rows if row[0] in self.leases.owned]
+            if self.watcher is not None and instruments is None:
+                # (Re)try watching on every full poll, log directories may have been unavailable before
+                for row in rows:
+                    self.watcher.watch(row[0], row[2])
+            self.context.poll(rows, due_only=instruments is None, cycle=cycle)
+            with timed_phase(cycle, "save"):
+                self.context.save()
+        if instruments is None:
+            self.context.report()
+
+    def _run_cycle_safely(self, instruments: Optional[Set[str]] = None):
+        try:
+            self.run_cycle(instruments)
+        except Exception:  # pylint:disable=broad-except
+            LOGGING.exception("Run detection cycle failed")
+
+    def _wait_until(self, deadline: float):
+        """
+        Wait for the next full poll, polling watched instruments as their lastrun.txt changes
+        """
+        remaining = deadline - time.monotonic()
+        while remaining > 0 and not self._stopping.is_set():
+            if self.leases is not None:
+                if time.monotonic() >= self._next_claim:
+                    self._claim()
+                remaining = min(remaining, max(self._next_claim - time.monotonic(), 0))
+            if self.watcher is None:
+                self._stopping.wait(remaining)
+            else:
+                # Wake up regularly to notice a stop request
+                changed = self.watcher.wait_for_changes(min(remaining, 1.0))
+                if changed:
+                    self._run_cycle_safely(changed)
+            remaining = deadline - time.monotonic()
+
+    def run(self):
+        """
+        Run detection cycles every `interval` seconds until stopped
+        """
+        LOGGING.info("Starting run detection with a poll interval of %ss", self.interval)
+        drainer = None
+        if self.context.outbox is not None:
+            drainer = OutboxDrainer(self.context.outbox, self.context.submit_queued_runs)
+            drainer.start()
+        while not self._stopping.is_set():
+            cycle_start = time.monotonic()
+            self._run_cycle_safely()
+            self._wait_until(self.context.next_due(self.rows or [], cycle_start + self.interval))
+        if drainer is not None:
+            drainer.stop()
+        if self.leases is not None:
+            self.leases.release_all()
+        self.context.close()
+        if self.watcher is not None:
+            self.watcher.close()
 
 
 def create_new_csv(csv_name):
@@ -177,36 +718,233 @@ def create_new_csv(csv_name):
     Create a new CSV file with the instrument name and last run
     """
     csv_name.touch(exist_ok=True)
-    supported_instruments = os.environ['SUPPORTED_INSTRUMENTS'].split(',')
-    LOGGING.debug("Supported instruments: %s", supported_instruments)
+    configured = monitored(InstrumentRegistry(INSTRUMENT_CONFIG).load() or {})
+    if not configured:
+        LOGGING.warning("No instruments configured, set SUPPORTED_INSTRUMENTS or INSTRUMENT_CONFIG")
+    LOGGING.debug("Supported instruments: %s", list(configured))
 
     with open(csv_name, mode='w', encoding="utf-8", newline='') as csv_file:
         csv_writer = csv.writer(csv_file)
-        for instrument in supported_instruments:
-            LOGGING.info("Creating initial csv row for instrument %s", instrument)
-            csv_writer.writerow(new_csv_data(instrument))
+        for row in new_csv_rows(list(configured), configured):
+            csv_writer.writerow(row)
 
 
-def new_csv_data(instrument):
+def new_csv_rows(instruments: List[str],
+                 overrides: Optional[Dict[str, Dict[str, str]]] = None,
+                 workers: Optional[PollWorkers] = None) -> List[List[str]]:
     """
-    Create a new row for the CSV file
+    Create the CSV rows for several instruments, reading their lastrun.txt in
+    parallel. Instruments whose lastrun.txt can't be read within the deadline
+    are left out.
+
+    Args:
+        instruments: Names of the instruments
+        overrides: Locations to use instead of the archive's, by instrument
+        workers: Workers kept between cycles, the lastrun.txt are read on their own workers if not given
+    Returns:
+        The new rows, in the same order as the instruments given
+    """
+    for instrument in instruments:
+        LOGGING.info("Creating initial csv row for instrument %s", instrument)
+    executor = workers if workers is not None else PollWorkers(min(POLL_WORKERS, len(instruments)))
+    try:
+        calls = {
+            index: (instrument, partial(new_csv_data, instrument,
+                                        **(overrides or {}).get(instrument, {})))
+            for index, instrument in enumerate(instruments)
+        }
+        outcomes = executor.call_with_deadlines(calls, READ_TIMEOUT)
+    finally:
+        if workers is None:
+            executor.shutdown()
+
+    rows = []
+    for index, instrument in enumerate(instruments):
+        if isinstance(outcomes[index], Exception):
+            LOGGING.error("Unable to create csv row for instrument %s: %s", instrument, outcomes[index])
+        else:
+            rows.append(outcomes[index])
+    return rows
+
+
+def new_csv_data(instrument, **paths):
     """
-    last_run_file = f'/isis/NDX{instrument}/Instrument/logs/lastrun.txt'
-    summary_file = f'/isis/NDX{instrument}/Instrument/logs/journal/summary.txt'
-    data_dir = f'/isis/NDX{instrument}/Instrument/data'
-    file_ext = '.nxs'
-    last_run = InstrumentMonitor(instrument_name=instrument,
-                                 last_run_file=last_run_file,
-                                 summary_file=summary_file,
-                                 data_dir=data_dir,
-                                 file_ext=file_ext).read_instrument_last_run()[1]
-    return [instrument, last_run, last_run_file, summary_file, data_dir, file_ext]
+    Create a new row for the CSV file, with the instrument's locations on the
+    archive unless given as last_run_file, summary_file, data_dir or file_ext
+    """
+    paths = {**archive_paths(instrument), **paths}
+    last_run = InstrumentMonitor(instrument_name=instrument, **paths).read_instrument_last_run()[1]
+    return [instrument, last_run, *(paths[field] for field in PATH_FIELDS)]
 
 
-def main():
+def run_daemon(args: argparse.Namespace, leases: Optional[LeaseManager] = None):
+    """
+    Run the detection daemon until it is stopped by SIGTERM or SIGINT
+
+    Args:
+        args: Parsed command line arguments
+        leases: Leases of the instruments shared with other replicas, if any
+    """
+    watcher = None
+    if args.watch:
+        try:
+            watcher = LastRunWatcher()
+        except OSError as err:
+            LOGGING.error("Unable to watch lastrun.txt files, falling back to polling: %s", err)
+    interval = args.interval
+    if interval is None:
+        interval = FALLBACK_POLL_INTERVAL if watcher is not None else POLL_INTERVAL
+    daemon = RunDetectionDaemon(LOCAL_CACHE_LOCATION, interval, watcher, leases, args.profile)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(METRICS_PORT, METRICS_ADDRESS)
+        metrics_server.start()
+    try:
+        daemon.run()
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+
+
+def backfill(args: argparse.Namespace) -> bool:
+    """
+    Submit past runs of an instrument again. The instrument's last run and
+    the other state of live detection are left alone, so a backfill can run
+    alongside the daemon.
+
+    Args:
+        args: Parsed command line arguments of the backfill subcommand
+    Returns:
+        True once every run has been submitted
+    """
+    rows = {}
+    if os.path.isfile(LOCAL_CACHE_LOCATION):
+        store = open_state_store(LOCAL_CACHE_LOCATION)
+        try:
+            rows = {row[0]: row for row in store.load() if row}
+        finally:
+            store.close()
+    row = rows.get(args.instrument)
+
+    if args.cycle is not None:
+        if row is None:
+            LOGGING.error("%s is not in the last runs CSV file, its data directory is unknown", args.instrument)
+            return False
+        try:
+            runs = list_runs(os.path.join(row[4], args.cycle), row[5])
+        except OSError as err:
+            LOGGING.error("Unable to list the data files of %s: %s", args.cycle, err)
+            return False
+        label = os.path.basename(os.path.normpath(args.cycle))
+    else:
+        first, last = args.runs
+        runs = set(range(first, last + 1))
+        label = f"{first}-{last}"
+    if not runs:
+        LOGGING.error("No runs to backfill for %s", args.instrument)
+        return False
+
+    location = backfill_location(LOCAL_CACHE_LOCATION, args.instrument, label)
+    # Not shared with live detection, so a backfill can't trip its circuit breaker or use up its connections
+    session = LazySession(partial(create_session, pool_size=max(1, args.workers)))
+    sink = create_sink(session, CircuitBreaker())
+    services = MonitorServices(session=session, sink=sink)
+    if row is not None:
+        monitor = _instrument_monitor(row, services)
+    else:
+        monitor = InstrumentMonitor(args.instrument, services=services)
+    try:
+        with FileLock(f"{location}.lock", timeout=1):
+            checkpoint = BackfillCheckpoint.load(location, runs)
+            return run_backfill(checkpoint, monitor.submit_runs, args.rate, args.workers)
+    except Timeout:
+        LOGGING.error("Another backfill of %s %s is running", args.instrument, label)
+        return False
+    finally:
+        sink.close()
+        session.close()
+
+
+def configure_logging():
+    """
+    Log to the autoreduce log file and stdout in the same way as the other autoreduce services
+    """
+    # Sets up logging when imported
+    import autoreduce_utils.settings  # pylint:disable=import-outside-toplevel,unused-import
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    """
+    Build the parser of the command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Detect new runs on the ISIS archive and submit them for reduction")
+    parser.add_argument("--once",
+                        action="store_true",
+                        help="Run a single detection cycle and exit, e.g. when started by cron")
+    parser.add_argument("--interval",
+                        type=float,
+                        help="Seconds between detection cycles when running as a daemon, defaults to "
+                        f"{POLL_INTERVAL} or {FALLBACK_POLL_INTERVAL} with --watch")
+    parser.add_argument("--watch",
+                        action="store_true",
+                        help="Detect changes to lastrun.txt with inotify, polling every instrument every "
+                        "--interval seconds as a fallback")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="Keep the phase timings and cProfile statistics of every detection cycle, not only "
+                        f"of those taking longer than PROFILE_SLOW_CYCLE ({PROFILE_SLOW_CYCLE:g}s)")
+    subparsers = parser.add_subparsers(dest="command")
+    backfill_parser = subparsers.add_parser("backfill",
+                                            help="Submit past runs of an instrument again, resuming where an "
+                                            "interrupted backfill of the same runs stopped")
+    backfill_parser.add_argument("instrument", help="Name of the instrument, e.g. WISH")
+    runs_group = backfill_parser.add_mutually_exclusive_group(required=True)
+    runs_group.add_argument("--runs", type=run_range, help="First and last run to submit, e.g. 44700-44750")
+    runs_group.add_argument("--cycle",
+                            help="Submit the runs with a data file in this directory under the instrument's data "
+                            "directory, e.g. cycle_22_1")
+    backfill_parser.add_argument("--rate",
+                                 type=float,
+                                 default=BACKFILL_RATE,
+                                 help=f"Maximum submissions started per second, defaults to {BACKFILL_RATE}")
+    backfill_parser.add_argument("--workers",
+                                 type=int,
+                                 default=BACKFILL_WORKERS,
+                                 help=f"Number of submissions made concurrently, defaults to {BACKFILL_WORKERS}")
+    subparsers.add_parser("latency",
+                          help="Show how long runs take from lastrun.txt being written to being detected and to "
+                          "being acknowledged")
+    profiles_parser = subparsers.add_parser("profiles",
+                                            help="Summarise the slowest profiled detection cycles and instruments")
+    profiles_parser.add_argument("--top", type=int, default=5, help="Number of cycles and instruments to show")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
     """
     Ingestion Entry point
     """
+    configure_logging()
+    args = argument_parser().parse_args(argv)
+
+    if args.command == "latency":
+        print(latency_report(LOCAL_CACHE_LOCATION))
+        return
+    if args.command == "profiles":
+        print(profile_report(LOCAL_CACHE_LOCATION, args.top))
+        return
+    if args.command == "backfill":
+        # Runs alongside live detection, so the last runs CSV file is neither created nor locked
+        if not backfill(args):
+            raise SystemExit(1)
+        return
+
+    if SHARDING != "none" and args.once:
+        # The replicas don't take the lock, a single cycle would poll the instruments they hold the leases on
+        LOGGING.error("--once can't be used with SHARDING=%s, the instruments are polled by the replicas", SHARDING)
+        raise SystemExit(1)
 
     # Create Path object for the last runs CSV file
     local_lastruns = Path(LOCAL_CACHE_LOCATION)
@@ -216,12 +954,29 @@ def main():
         LOGGING.info("Creating last runs CSV file")
         create_new_csv(local_lastruns)
 
+    if SHARDING != "none":
+        # Replicas share the instruments through leases instead of one of them holding the lock
+        run_daemon(args, LeaseManager(f"{LOCAL_CACHE_LOCATION}.leases", REPLICA_ID, SHARDING))
+        return
+
     # Acquire a lock on the last runs CSV file to prevent access
-    # by other instances of this script
+    # by other instances of this script. The daemon holds it until it stops.
+    lock = FileLock(f"{LOCAL_CACHE_LOCATION}.lock", timeout=1)
+    lock_wait_start = time.monotonic()
     try:
-        with FileLock(f"{LOCAL_CACHE_LOCATION}.lock", timeout=1):
-            update_last_runs(LOCAL_CACHE_LOCATION)
+        with lock:
+            lock_wait = time.monotonic() - lock_wait_start
+            LOCK_WAIT_SECONDS.observe(lock_wait)
+            if args.once:
+                try:
+                    update_last_runs(LOCAL_CACHE_LOCATION, profile=args.profile, lock_wait=lock_wait)
+                finally:
+                    if METRICS_TEXTFILE:
+                        write_textfile(METRICS_TEXTFILE)
+            else:
+                run_daemon(args)
     except Timeout:
+        LOCK_WAIT_SECONDS.observe(time.monotonic() - lock_wait_start)
         LOGGING.error("Error acquiring lock on last runs CSV."
                       " There may be another instance running.")
 
@@ -0,0 +1,169 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Adaptive polling schedule. Learns how often each instrument ends a run and
+polls busy instruments often and idle instruments rarely.
+"""
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from autoreduce_run_detection.settings import (POLL_INTERVAL_MIN, POLL_INTERVAL_MAX, POLL_CADENCE_FRACTION,
+                                               POLL_IDLE_FACTOR)
+
+LOGGING = logging.getLogger(__package__)
+
+# Weight given to the latest run inter-arrival time in the running estimate
+CADENCE_SMOOTHING = 0.3
+
+
+class InstrumentSchedule:
+    """
+    When one instrument is next polled, along with the time its last run
+    last changed and a moving average of the time between its runs
+    """
+
+    def __init__(self,
+                 last_run: Optional[str] = None,
+                 changed_at: Optional[float] = None,
+                 cadence: Optional[float] = None,
+                 interval: Optional[float] = None,
+                 next_poll: float = 0.0):
+        self.last_run = last_run
+        self.changed_at = changed_at
+        self.cadence = cadence
+        self.interval = POLL_INTERVAL_MIN if interval is None else interval
+        self.next_poll = next_poll
+
+    def ceiling(self, now: float) -> float:
+        """
+        Longest interval the instrument may be polled at. An instrument that
+        has ended a run within POLL_IDLE_FACTOR times its usual cadence is
+        polled at POLL_CADENCE_FRACTION of its cadence, any other at POLL_INTERVAL_MAX.
+        """
+        if self.cadence is None or self.changed_at is None or now - self.changed_at > POLL_IDLE_FACTOR * self.cadence:
+            return POLL_INTERVAL_MAX
+        return min(max(self.cadence * POLL_CADENCE_FRACTION, POLL_INTERVAL_MIN), POLL_INTERVAL_MAX)
+
+    def observe(self, last_run: Optional[str], now: float) -> bool:
+        """
+        Record the last run seen by a poll and schedule the next poll. A
+        change resets the interval to POLL_INTERVAL_MIN, otherwise it is
+        doubled up to the ceiling, as it is when lastrun.txt couldn't be read.
+
+        Args:
+            last_run: Last run in the instrument's lastrun.txt, None if it couldn't be read
+            now: Time of the poll
+        Returns:
+            True if the last run has changed
+        """
+        if last_run is None:
+            last_run = self.last_run
+        changed = self.last_run is not None and int(last_run) > int(self.last_run)
+        if changed:
+            if self.changed_at is not None:
+                # A long shutdown would otherwise dominate the estimate for many runs
+                sample = min((now - self.changed_at) / (int(last_run) - int(self.last_run)),
+                             POLL_INTERVAL_MAX / POLL_CADENCE_FRACTION)
+                self.cadence = sample if self.cadence is None else (CADENCE_SMOOTHING * sample +
+                                                                    (1 - CADENCE_SMOOTHING) * self.cadence)
+            self.changed_at = now
+            self.interval = POLL_INTERVAL_MIN
+        elif self.last_run is not None:
+            self.interval = max(min(self.interval * 2, self.ceiling(now)), POLL_INTERVAL_MIN)
+        self.last_run = last_run
+        self.next_poll = now + self.interval
+        return changed
+
+    def to_json(self) -> dict:
+        """
+        Form saved between invocations
+        """
+        return {
+            "last_run": self.last_run,
+            "changed_at": self.changed_at,
+            "cadence": self.cadence,
+            "interval": self.interval,
+            "next_poll": self.next_poll
+        }
+
+
+class PollSchedule:
+    """
+    The polling schedules of every instrument, persisted between invocations.
+    Times are wall clock times so that they remain valid across invocations.
+    """
+
+    def __init__(self,
+                 instruments: Optional[Dict[str, InstrumentSchedule]] = None,
+                 clock: Callable[[], float] = time.time):
+        self._instruments = instruments or {}
+        self.clock = clock
+        self._dirty = False
+
+    def due(self, rows: List[List[str]], now: Optional[float] = None) -> List[List[str]]:
+        """
+        The rows of the instruments that are due to be polled, including
+        instruments that have never been polled
+        """
+        now = self.clock() if now is None else now
+        return [row for row in rows if row[0] not in self._instruments or self._instruments[row[0]].next_poll <= now]
+
+    def next_due(self, rows: List[List[str]]) -> float:
+        """
+        Wall clock time at which the next of the instruments is due to be polled
+        """
+        return min((self._instruments[row[0]].next_poll if row[0] in self._instruments else 0.0 for row in rows),
+                   default=self.clock() + POLL_INTERVAL_MAX)
+
+    def observe(self, rows: List[List[Optional[str]]], now: Optional[float] = None):
+        """
+        Schedule the next poll of the instruments that have just been polled
+
+        Args:
+            rows: The instrument and the last run read from its lastrun.txt, or None if it couldn't be read
+            now: Time of the poll
+        """
+        now = self.clock() if now is None else now
+        for row in rows:
+            schedule = self._instruments.setdefault(row[0], InstrumentSchedule())
+            if schedule.observe(row[1], now):
+                LOGGING.debug("%s changed, polling it every %ss", row[0], schedule.interval)
+        self._dirty = True
+
+    @classmethod
+    def load(cls, location: str, clock: Callable[[], float] = time.time) -> "PollSchedule":
+        """
+        Load the schedule saved by a previous invocation, or an empty schedule
+
+        Args:
+            location: Where the schedule is saved
+            clock: Current wall clock time
+        """
+        try:
+            with open(location, mode='r', encoding="utf-8") as schedule_file:
+                saved = json.load(schedule_file)
+            instruments = {instrument: InstrumentSchedule(**schedule) for instrument, schedule in saved.items()}
+        except (OSError, ValueError, TypeError) as err:
+            if os.path.exists(location):
+                LOGGING.warning("Ignoring unreadable poll schedule %s: %s", location, err)
+            instruments = {}
+        return cls(instruments, clock)
+
+    def save(self, location: str):
+        """
+        Save the schedule for the next invocation if it has changed
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        saved = {instrument: schedule.to_json() for instrument, schedule in self._instruments.items()}
+        temporary = f"{location}.tmp"
+        with open(temporary, mode='w', encoding="utf-8") as schedule_file:
+            json.dump(saved, schedule_file)
+        os.replace(temporary, location)
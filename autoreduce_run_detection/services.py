@@ -0,0 +1,74 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+What run detection is handed rather than creating from the environment:
+the collaborators shared by the instrument monitors, and the options a run
+detection context can be given in place of its settings, e.g. by the
+benchmark and replay.
+"""
+import time
+from typing import TYPE_CHECKING, Callable, NamedTuple, Optional
+
+from autoreduce_run_detection.alerts import AlertDispatcher
+from autoreduce_run_detection.api import CircuitBreaker
+from autoreduce_run_detection.data_index import DataIndex
+from autoreduce_run_detection.latency import LatencyTracker
+from autoreduce_run_detection.ledger import SubmissionLedger
+from autoreduce_run_detection.outbox import Outbox
+from autoreduce_run_detection.recorder import TraceRecorder
+from autoreduce_run_detection.sinks import SubmissionSink
+from autoreduce_run_detection.stat_cache import StatCache
+from autoreduce_run_detection.summary import SummaryIndex
+
+if TYPE_CHECKING:
+    import requests
+
+
+class MonitorServices(NamedTuple):
+    """
+    Collaborators shared by the instrument monitors, each of them optional
+    """
+    # Sends alerts to Teams in the background when set
+    alerts: Optional[AlertDispatcher] = None
+    # Shared by the instruments to stop submitting while the API is down
+    breaker: Optional[CircuitBreaker] = None
+    # Shared by the instruments and reused between cycles to keep connections to the API alive
+    session: Optional["requests.Session"] = None
+    # Where runs are submitted, shared by the instruments so that a broker can batch their runs
+    sink: Optional[SubmissionSink] = None
+    stat_cache: Optional[StatCache] = None
+    # When set, new runs are queued here and submitted in the background
+    outbox: Optional[Outbox] = None
+    # When set, the RB number and title of the runs are read from summary.txt and submitted with them
+    summary_index: Optional[SummaryIndex] = None
+    # When set, runs are held back until their data file is in data_dir
+    data_index: Optional[DataIndex] = None
+    # When set, runs already acknowledged are not submitted again
+    ledger: Optional[SubmissionLedger] = None
+    # When set, the time from lastrun.txt being written to each run being acknowledged is recorded
+    latency: Optional[LatencyTracker] = None
+    # When set, what lastrun.txt reads as and the outcome of each submission are recorded for replay
+    recorder: Optional[TraceRecorder] = None
+
+
+class ContextOptions(NamedTuple):
+    """
+    Options of a run detection context, each left to its setting if not given
+    """
+    # Base URL of the autoreduce API, AUTOREDUCE_API_URL if not given
+    api_url: Optional[str] = None
+    # Retries of each request to the API, API_RETRIES if not given
+    api_retries: Optional[int] = None
+    # Seconds the API circuit breaker stays open for, CIRCUIT_RESET_TIMEOUT if not given
+    circuit_reset_timeout: Optional[float] = None
+    # Whether failures are alerted to TEAMS_URL, if it is set
+    alerts: bool = True
+    # Whether a trace is recorded to TRACE_FILE, if it is set
+    record: bool = True
+    # Used instead of the stat cache kept alongside the last runs CSV file
+    stat_cache: Optional[StatCache] = None
+    # Current wall clock time of the polling schedule, data file holds and run latencies
+    clock: Callable[[], float] = time.time
@@ -8,8 +8,11 @@
 Settings for End of run monitor
 """
 import os
-from autoreduce_utils.settings import AUTOREDUCE_HOME_ROOT
+import socket
 
+# The same directory as autoreduce_utils.settings, which is only imported by the entry point as importing it
+# sets up logging to a file in this directory
+AUTOREDUCE_HOME_ROOT = os.environ.get("AUTOREDUCTION_USERDIR", os.path.expanduser("~/.autoreduce"))
 LOCAL_CACHE_LOCATION = os.path.join(AUTOREDUCE_HOME_ROOT, 'last_runs.csv')
 
 if "AUTOREDUCTION_PRODUCTION" in os.environ:
@@ -19,5 +22,134 @@ else:
 
 AUTOREDUCE_TOKEN = os.environ.get('AUTOREDUCE_TOKEN')
 
+# JSON file of the instruments to monitor alongside those in SUPPORTED_INSTRUMENTS, mapping each to any of
+# last_run_file, summary_file, data_dir and file_ext to use instead of its locations on the ISIS archive,
+# or to null to retire it. While SUPPORTED_INSTRUMENTS is set, instruments configured in neither are retired too,
+# otherwise they are kept as they are.
+# The last runs are reconciled with them on every --once invocation, and when the file changes in daemon mode.
+INSTRUMENT_CONFIG = os.getenv("INSTRUMENT_CONFIG", None)
+
 # set this ENV var to allow error notifications to be sent to the Teams support channel
 TEAMS_URL = os.environ.get("TEAMS_URL", None)
+
+# Number of instruments polled concurrently on each cycle
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", "32"))
+
+# Per-instrument deadlines in seconds for reading lastrun.txt and for submitting runs to the API.
+# An instrument that misses its deadline keeps its previous last run and is retried next cycle.
+READ_TIMEOUT = float(os.getenv("LAST_RUN_READ_TIMEOUT", "10"))
+SUBMIT_TIMEOUT = float(os.getenv("SUBMIT_TIMEOUT", "30"))
+
+# Seconds between the start of consecutive detection cycles when running as a daemon
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "15"))
+
+# Seconds between full polls of every instrument when changes are detected with inotify.
+# Mounts that don't deliver inotify events (e.g. NFS/SMB) are only picked up by this poll.
+FALLBACK_POLL_INTERVAL = float(os.getenv("FALLBACK_POLL_INTERVAL", "300"))
+
+# Connect and read timeouts in seconds for each request made to the autoreduce API
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "3.05"))
+API_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "10"))
+
+# Number of times a submission is retried after a connection error or a 5xx response,
+# waiting a random time of up to API_BACKOFF * 2^attempt seconds (at most API_BACKOFF_MAX) in between
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+API_BACKOFF = float(os.getenv("API_BACKOFF", "0.5"))
+API_BACKOFF_MAX = float(os.getenv("API_BACKOFF_MAX", "10"))
+
+# Maximum number of runs submitted in one request; larger gaps are split and the
+# last run is advanced after each acknowledged chunk
+SUBMIT_CHUNK_SIZE = int(os.getenv("SUBMIT_CHUNK_SIZE", "100"))
+
+# Number of each instrument's most recent runs whose detection latency is kept for the rolling quantiles
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "1000"))
+
+# Keep the phase timings and cProfile statistics of each detection cycle taking at least PROFILE_SLOW_CYCLE seconds
+# (0 to disable, every cycle is kept with --profile) in <LAST_RUNS_CSV>.profiles, up to PROFILE_KEEP of the latest
+PROFILE_SLOW_CYCLE = float(os.getenv("PROFILE_SLOW_CYCLE", "60"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+# Record each change in the instruments' lastrun.txt and each submission to this JSON lines file, for replay.
+# It is passed through strftime, e.g. /var/log/run_detection/trace-%Y%m%d.jsonl for a trace per day.
+TRACE_FILE = os.getenv("TRACE_FILE", None)
+
+# Ceiling on the submissions started per second by the backfill subcommand, and the number made concurrently
+BACKFILL_RATE = float(os.getenv("BACKFILL_RATE", "1"))
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))
+
+# Where detected runs are submitted, a comma separated list of "api" (the autoreduce REST API) and
+# "stomp" (a STOMP broker such as ActiveMQ, needs the stomp extra). Runs are only recorded as submitted
+# once every sink has them.
+SUBMISSION_SINKS = [sink.strip() for sink in os.getenv("SUBMISSION_SINKS", "api").split(",") if sink.strip()]
+
+# The STOMP broker runs are published to. Submissions made within STOMP_BATCH_LINGER seconds of each other,
+# up to STOMP_BATCH_SIZE of them, are published in one transaction whose commit the broker must confirm.
+STOMP_HOST = os.getenv("STOMP_HOST", "127.0.0.1")
+STOMP_PORT = int(os.getenv("STOMP_PORT", "61613"))
+STOMP_USER = os.getenv("STOMP_USER", None)
+STOMP_PASSWORD = os.getenv("STOMP_PASSWORD", None)
+STOMP_DESTINATION = os.getenv("STOMP_DESTINATION", "/queue/DataReady")
+STOMP_TIMEOUT = float(os.getenv("STOMP_TIMEOUT", "10"))
+STOMP_BATCH_LINGER = float(os.getenv("STOMP_BATCH_LINGER", "0.05"))
+STOMP_BATCH_SIZE = int(os.getenv("STOMP_BATCH_SIZE", "500"))
+
+# Stop submitting to the API for CIRCUIT_RESET_TIMEOUT seconds after CIRCUIT_FAILURES consecutive failed
+# submissions, then let one submission through to probe whether it is back. Disabled when 0.
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "60"))
+
+# Teams alerts are sent in the background with a timeout of ALERT_TIMEOUT seconds. Repeated alerts for the
+# same instrument and error within ALERT_WINDOW seconds are coalesced into a single card.
+ALERT_WINDOW = float(os.getenv("ALERT_WINDOW", "600"))
+ALERT_TIMEOUT = float(os.getenv("ALERT_TIMEOUT", "5"))
+
+# Submit {"start": first, "end": last} ranges (end inclusive) instead of listing every run number
+SUBMIT_RANGES = os.getenv("SUBMIT_RANGES", "false").lower() in ("1", "true", "yes")
+
+# Where the last runs are kept: "csv" (the last runs CSV file) or "sqlite"
+# (a database next to it, importing the CSV file when first created)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "csv")
+
+# Queue detected runs in a persistent outbox that is drained in the background, instead of
+# submitting them during detection. Failed submissions are retried with a random wait of up to
+# OUTBOX_BACKOFF * 2^attempt seconds, capped at OUTBOX_BACKOFF_MAX.
+OUTBOX = os.getenv("OUTBOX", "false").lower() in ("1", "true", "yes")
+OUTBOX_DRAIN_INTERVAL = float(os.getenv("OUTBOX_DRAIN_INTERVAL", "1"))
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+
+# Attach the RB number and title of each run, read from the instrument's summary.txt, to its submission.
+# Off by default, as the API has to accept the metadata. The records of the last SUMMARY_INDEX_SIZE runs
+# of each instrument are kept.
+SUMMARY_METADATA = os.getenv("SUMMARY_METADATA", "false").lower() in ("1", "true", "yes")
+SUMMARY_INDEX_SIZE = int(os.getenv("SUMMARY_INDEX_SIZE", "500"))
+
+# Hold back runs until their data file is in a cycle directory of the instrument's data directory.
+# A run whose data file is still missing after DATA_HOLD_TIMEOUT seconds is submitted anyway.
+WAIT_FOR_DATA_FILES = os.getenv("WAIT_FOR_DATA_FILES", "false").lower() in ("1", "true", "yes")
+DATA_HOLD_TIMEOUT = float(os.getenv("DATA_HOLD_TIMEOUT", "3600"))
+
+# Serve metrics on http://METRICS_ADDRESS:METRICS_PORT/metrics when running as a daemon, disabled when 0
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_ADDRESS = os.getenv("METRICS_ADDRESS", "127.0.0.1")
+
+# Write metrics to this node-exporter textfile (e.g. /var/lib/node_exporter/run_detection.prom) after each --once run
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", None)
+
+# Poll each instrument at an interval learnt from how often it ends a run, instead of polling every
+# instrument every cycle. The interval is reset to POLL_INTERVAL_MIN when a new run is seen and doubled
+# after each poll without one, up to POLL_CADENCE_FRACTION of the instrument's average time between runs,
+# or up to POLL_INTERVAL_MAX once it has been idle for POLL_IDLE_FACTOR times that average.
+ADAPTIVE_POLLING = os.getenv("ADAPTIVE_POLLING", "false").lower() in ("1", "true", "yes")
+POLL_INTERVAL_MIN = float(os.getenv("POLL_INTERVAL_MIN", str(POLL_INTERVAL)))
+POLL_INTERVAL_MAX = float(os.getenv("POLL_INTERVAL_MAX", "600"))
+POLL_CADENCE_FRACTION = float(os.getenv("POLL_CADENCE_FRACTION", "0.05"))
+POLL_IDLE_FACTOR = float(os.getenv("POLL_IDLE_FACTOR", "3"))
+
+# Share the instruments between several daemon replicas instead of taking a lock on the last runs CSV file:
+# "none", "hash" (each instrument goes to a replica by rendezvous hashing over the live replicas) or "lease"
+# (replicas take free leases up to their fair share). Leases and heartbeats expire after LEASE_TTL seconds,
+# after which the instruments of a replica that has disappeared are taken over by the others.
+SHARDING = os.getenv("SHARDING", "none")
+REPLICA_ID = os.getenv("REPLICA_ID", socket.gethostname())
+LEASE_TTL = float(os.getenv("LEASE_TTL", "120"))
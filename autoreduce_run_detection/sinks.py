@@ -0,0 +1,330 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Destinations detected runs are submitted to: the autoreduce REST API, a
+STOMP message broker, or several of them at once.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, List, Optional
+
+from autoreduce_run_detection.alerts import AlertDispatcher
+from autoreduce_run_detection.api import CircuitBreaker, post_with_retries
+from autoreduce_run_detection.ledger import SubmissionLedger
+from autoreduce_run_detection.metrics import SUBMIT_RESPONSES
+from autoreduce_run_detection.settings import (AUTOREDUCE_API_URL, AUTOREDUCE_TOKEN, SUBMISSION_SINKS, STOMP_HOST,
+                                               STOMP_PORT, STOMP_USER, STOMP_PASSWORD, STOMP_DESTINATION, STOMP_TIMEOUT,
+                                               STOMP_BATCH_LINGER, STOMP_BATCH_SIZE)
+
+if TYPE_CHECKING:
+    import requests
+
+    from autoreduce_run_detection.broker import StompClient
+
+LOGGING = logging.getLogger(__package__)
+
+
+class SubmissionError(Exception):
+    """
+    The sink did not accept the runs
+    """
+
+
+class SinkUnavailable(SubmissionError):
+    """
+    The sink could not be reached at all
+    """
+
+
+def idempotency_key(instrument: str, start_run: int, end_run: int) -> str:
+    """
+    Key identifying a submission of runs start_run up to but not including end_run, the same every time they are
+    submitted, so that a sink can recognise a submission it has already accepted
+    """
+    return f"{instrument}-{start_run}-{end_run - 1}"
+
+
+class SubmissionSink(ABC):
+    """
+    Somewhere runs are submitted to
+    """
+
+    @abstractmethod
+    def submit(self, instrument: str, start_run: int, end_run: int, payload: dict) -> object:
+        """
+        Submit runs start_run up to but not including end_run of an instrument,
+        returning once the sink has acknowledged them
+
+        Args:
+            instrument: Name of the instrument
+            start_run: First run to submit
+            end_run: Run after the last one to submit
+            payload: Runs and metadata in the form accepted by the autoreduce API
+        Returns:
+            The sink's acknowledgement
+        Raises:
+            SubmissionError: If the runs were not acknowledged
+        """
+
+    def close(self):
+        """
+        Release any connections
+        """
+
+
+class APISink(SubmissionSink):
+    """
+    Submits runs to the autoreduce REST API, one request per submission
+    """
+
+    def __init__(self,
+                 session: Optional["requests.Session"] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 alerts: Optional[AlertDispatcher] = None,
+                 url: Optional[str] = None,
+                 retries: Optional[int] = None):
+        # Shared by the instruments and reused between cycles to keep connections to the API alive
+        self.session = session
+        # Shared by the instruments to stop submitting while the API is down
+        self.breaker = breaker
+        self.alerts = alerts
+        # AUTOREDUCE_API_URL and API_RETRIES if not given
+        self.url = url
+        self.retries = retries
+
+    def __str__(self):
+        return self.url if self.url is not None else AUTOREDUCE_API_URL
+
+    def submit(self, instrument: str, start_run: int, end_run: int, payload: dict) -> object:
+        if self.breaker is not None and not self.breaker.allow():
+            SUBMIT_RESPONSES.inc(instrument=instrument, code="circuit_open")
+            raise SubmissionError("the autoreduce API is unavailable")
+        import requests  # pylint:disable=import-outside-toplevel,redefined-outer-name
+
+        try:
+            response = post_with_retries(self.session,
+                                         f"{self}/runs/{instrument}",
+                                         self.retries,
+                                         json=payload,
+                                         headers={
+                                             "Content-Type": "application/json",
+                                             "Authorization": f"Token {AUTOREDUCE_TOKEN}",
+                                             "Idempotency-Key": idempotency_key(instrument, start_run, end_run)
+                                         })
+        except requests.exceptions.RequestException as err:
+            SUBMIT_RESPONSES.inc(instrument=instrument, code="error")
+            self._record_failure(type(err).__name__)
+            raise SinkUnavailable(str(err)) from err
+
+        SUBMIT_RESPONSES.inc(instrument=instrument, code=str(response.status_code))
+        if response.status_code >= 500:
+            self._record_failure(f"status code {response.status_code}")
+        elif self.breaker is not None:
+            self.breaker.record_success()
+        if response.status_code != 200:
+            raise SubmissionError(f"Request status code is not 200, error: {response.text}")
+        return response
+
+    def _record_failure(self, error_class: str):
+        if self.breaker is not None and self.breaker.record_failure() and self.alerts is not None:
+            self.alerts.alert(
+                "", "circuit_open", f"Autoreduce API is unavailable ({error_class}), "
+                f"pausing submissions for {self.breaker.reset_timeout:g}s")
+
+
+class _Batch:
+    """
+    Messages published together in one transaction
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.receipt: Optional[str] = None
+        self.error: Optional[Exception] = None
+
+
+class StompSink(SubmissionSink):
+    """
+    Publishes runs to a STOMP broker as JSON messages. Submissions made by
+    the instruments within `linger` seconds of each other are published in
+    one transaction, and each submission returns once the broker has
+    confirmed the commit.
+    """
+
+    def __init__(self,
+                 client: "StompClient",
+                 destination: str = STOMP_DESTINATION,
+                 linger: float = STOMP_BATCH_LINGER,
+                 batch_size: int = STOMP_BATCH_SIZE):
+        self.client = client
+        self.destination = destination
+        self.linger = linger
+        self.batch_size = batch_size
+        self._batch: Optional[_Batch] = None
+        self._lock = threading.Lock()
+        # One transaction at a time on the connection
+        self._publish_lock = threading.Lock()
+
+    def __str__(self):
+        return f"stomp://{self.client.host}:{self.client.port}{self.destination}"
+
+    def submit(self, instrument: str, start_run: int, end_run: int, payload: dict) -> object:
+        message = (self.destination, {
+            "content-type": "application/json",
+            "persistent": "true",
+            "idempotency-key": idempotency_key(instrument, start_run, end_run)
+        }, json.dumps({
+            "instrument": instrument,
+            **payload
+        }).encode())
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.messages.append(message)
+            if len(batch.messages) >= self.batch_size:
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            # Give the other instruments of this cycle a moment to join the batch
+            batch.full.wait(self.linger)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._publish(batch)
+        else:
+            # The leader always finishes the batch, its socket operations time out
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return f"{len(batch.messages)} messages in transaction {batch.receipt}"
+
+    def _publish(self, batch: _Batch):
+        # Already imported with the client, which needs stomp.py
+        from autoreduce_run_detection.broker import StompError  # pylint:disable=import-outside-toplevel
+
+        try:
+            with self._publish_lock:
+                batch.receipt = self.client.publish(batch.messages)
+        except StompError as err:
+            batch.error = SubmissionError(f"Broker refused the batch: {err}")
+        except OSError as err:
+            batch.error = SinkUnavailable(f"Unable to publish to the broker: {err}")
+        finally:
+            batch.done.set()
+
+    def close(self):
+        with self._publish_lock:
+            self.client.close()
+
+
+class FanOutSink(SubmissionSink):
+    """
+    Submits runs to several sinks. Every sink is tried, and the runs are
+    only acknowledged once all of them have them. The runs each sink
+    acknowledges are recorded in a ledger under the sink's name, so runs
+    that fail on one sink are only submitted again to the sinks that don't
+    have them yet.
+    """
+
+    def __init__(self,
+                 sinks: List[SubmissionSink],
+                 names: Optional[List[str]] = None,
+                 ledger: Optional[SubmissionLedger] = None):
+        self.sinks = sinks
+        # Identify the runs acknowledged by each sink in the ledger
+        self.names = names if names is not None else [str(sink) for sink in sinks]
+        # Kept in memory when no ledger is given, so acknowledgements are only remembered by this process
+        self._owns_ledger = ledger is None
+        self.ledger = ledger if ledger is not None else SubmissionLedger(":memory:")
+
+    def __str__(self):
+        return ", ".join(str(sink) for sink in self.sinks)
+
+    def _acknowledged(self, name: str, instrument: str, start_run: int, end_run: int) -> bool:
+        try:
+            return not self.ledger.unacknowledged(f"{name}/{instrument}", start_run, end_run)
+        except sqlite3.Error as err:
+            LOGGING.error("Unable to read the runs acknowledged by %s from the ledger: %s", name, err)
+            return False
+
+    def _record(self, name: str, instrument: str, start_run: int, end_run: int):
+        try:
+            self.ledger.record(f"{name}/{instrument}", start_run, end_run)
+        except sqlite3.Error as err:
+            LOGGING.error("Unable to record the runs acknowledged by %s in the ledger: %s", name, err)
+
+    def submit(self, instrument: str, start_run: int, end_run: int, payload: dict) -> object:
+        acknowledgements = []
+        errors = []
+        for name, sink in zip(self.names, self.sinks):
+            if self._acknowledged(name, instrument, start_run, end_run):
+                acknowledgements.append(f"Runs {start_run}-{end_run - 1} for {instrument} were already "
+                                        f"acknowledged by {sink}")
+                continue
+            try:
+                acknowledgements.append(sink.submit(instrument, start_run, end_run, payload))
+            except SubmissionError as err:
+                LOGGING.error("Submission of %s runs %i - %i to %s failed: %s", instrument, start_run, end_run - 1,
+                              sink, err)
+                errors.append(err)
+            else:
+                self._record(name, instrument, start_run, end_run)
+        if errors:
+            # Report an unreachable sink as such so that it is alerted on
+            raise next((err for err in errors if isinstance(err, SinkUnavailable)), errors[0])
+        return acknowledgements
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        if self._owns_ledger:
+            self.ledger.close()
+
+
+def create_sink(session: Optional["requests.Session"] = None,
+                breaker: Optional[CircuitBreaker] = None,
+                alerts: Optional[AlertDispatcher] = None,
+                names: Optional[List[str]] = None,
+                ledger: Optional[SubmissionLedger] = None,
+                api_url: Optional[str] = None,
+                api_retries: Optional[int] = None) -> SubmissionSink:
+    """
+    Create the sinks named in SUBMISSION_SINKS, fanning out to them if there are several
+
+    Args:
+        session: Session used to submit to the API
+        breaker: Circuit breaker around the API
+        alerts: Where an API outage is alerted
+        names: Names of the sinks, SUBMISSION_SINKS if not given
+        ledger: Where the runs acknowledged by each of several sinks are recorded, in memory if not given
+        api_url: Base URL of the API, AUTOREDUCE_API_URL if not given
+        api_retries: Retries of each request to the API, API_RETRIES if not given
+    """
+    names = names if names is not None else SUBMISSION_SINKS
+    sinks: List[SubmissionSink] = []
+    for name in names:
+        if name == "api":
+            sinks.append(APISink(session, breaker, alerts, api_url, api_retries))
+        elif name == "stomp":
+            # Only needs stomp.py when a STOMP sink is configured
+            from autoreduce_run_detection.broker import StompClient  # pylint:disable=import-outside-toplevel
+
+            sinks.append(
+                StompSink(StompClient(STOMP_HOST, STOMP_PORT, STOMP_USER, STOMP_PASSWORD, timeout=STOMP_TIMEOUT)))
+        else:
+            raise ValueError(f"Unknown submission sink '{name}', expected 'api' or 'stomp'")
+    if not sinks:
+        raise ValueError("No submission sinks configured")
+    return sinks[0] if len(sinks) == 1 else FanOutSink(sinks, names, ledger)
@@ -0,0 +1,95 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Cache of the parsed lastrun.txt files keyed by their file metadata, so that
+files which haven't changed since they were last read are not read again.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+LOGGING = logging.getLogger(__package__)
+
+FileKey = Tuple[int, int, int]
+
+
+class StatCache:
+    """
+    Keeps the parsed contents of each lastrun.txt along with its
+    (inode, mtime_ns, size). A file is only read again once its metadata
+    changes; a stat is much cheaper than an open and read on the archive mounts.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, Tuple[FileKey, List[str]]]] = None):
+        self._entries = entries or {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, path: str, reader: Callable[[], List[str]]) -> List[str]:
+        """
+        Return the cached contents of a file if it is unchanged, otherwise read it
+
+        Args:
+            path: Location of the file
+            reader: Reads and parses the file, its result is cached
+        Returns:
+            The parsed contents of the file
+        """
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == key:
+            with self._lock:
+                self.hits += 1
+            return list(entry[1])
+
+        # The key is taken before reading, so a write racing the read only causes another read next time
+        line_parts = reader()
+        with self._lock:
+            self.misses += 1
+            self._entries[path] = (key, list(line_parts))
+            self._dirty = True
+        return line_parts
+
+    def report(self):
+        """
+        Log how many reads have been saved
+        """
+        LOGGING.info("lastrun.txt stat cache: %i hits, %i misses", self.hits, self.misses)
+
+    @classmethod
+    def load(cls, location: str) -> "StatCache":
+        """
+        Load the cache saved by a previous invocation, or an empty cache if
+        there is none or it can't be read
+        """
+        try:
+            with open(location, mode='r', encoding="utf-8") as cache_file:
+                saved = json.load(cache_file)
+            entries = {path: (tuple(key), line_parts) for path, (key, line_parts) in saved.items()}
+        except (OSError, ValueError) as err:
+            if os.path.exists(location):
+                LOGGING.warning("Ignoring unreadable stat cache %s: %s", location, err)
+            entries = {}
+        return cls(entries)
+
+    def save(self, location: str):
+        """
+        Save the cache for the next invocation if it has changed
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            saved = {path: [list(key), line_parts] for path, (key, line_parts) in self._entries.items()}
+            self._dirty = False
+        temporary = f"{location}.tmp"
+        with open(temporary, mode='w', encoding="utf-8") as cache_file:
+            json.dump(saved, cache_file)
+        os.replace(temporary, location)
@@ -0,0 +1,210 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Storage of the last run detected on each instrument. Rows have the same
+fields as the last runs CSV file: instrument name, last run, lastrun.txt
+location, summary.txt location, data directory and file extension.
+"""
+import csv
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import List, Set
+
+from filelock import FileLock
+
+from autoreduce_run_detection.settings import STATE_BACKEND
+
+LOGGING = logging.getLogger(__package__)
+
+
+def read_last_runs(csv_name) -> List[List[str]]:
+    """
+    Read the rows of the last runs CSV file
+    """
+    with open(csv_name, mode='r', encoding="utf-8") as csv_file:
+        return list(csv.reader(csv_file))
+
+
+def write_last_runs(csv_name, rows: List[List[str]]):
+    """
+    Write the rows of the last runs CSV file. The rows are written to a
+    temporary file which then replaces the CSV file, so a crash part way
+    through never leaves a truncated CSV file behind.
+    """
+    temporary = f"{csv_name}.tmp"
+    with open(temporary, mode='w', encoding="utf-8", newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        for row in rows:
+            csv_writer.writerow(row)
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+    os.replace(temporary, csv_name)
+
+
+class StateStore(ABC):
+    """
+    Where the last runs are kept between cycles
+    """
+
+    @abstractmethod
+    def load(self) -> List[List[str]]:
+        """
+        Return the rows of every instrument
+        """
+
+    @abstractmethod
+    def update(self, row: List[str]):
+        """
+        Record a change to an instrument's row
+        """
+
+    @abstractmethod
+    def remove(self, instrument: str):
+        """
+        Forget an instrument that is no longer monitored
+        """
+
+    def flush(self):
+        """
+        Persist any changes not yet persisted by `update`
+        """
+
+    def close(self):
+        """
+        Release the store
+        """
+
+
+class CSVStateStore(StateStore):
+    """
+    Keeps the last runs in the CSV file, rewritten atomically on flush when a row has changed.
+    When the file is shared with other processes, the file is read again on flush under a lock
+    and only the rows changed or removed by this process are replaced.
+    """
+
+    def __init__(self, csv_name, shared: bool = False):
+        self.csv_name = csv_name
+        self.shared = shared
+        self._rows: List[List[str]] = []
+        self._changed: Set[str] = set()
+        self._removed: Set[str] = set()
+        self._dirty = False
+
+    def load(self) -> List[List[str]]:
+        self._rows = read_last_runs(self.csv_name)
+        return self._rows
+
+    def update(self, row: List[str]):
+        self._changed.add(row[0])
+        self._removed.discard(row[0])
+        for index, existing in enumerate(self._rows):
+            if existing[0] == row[0]:
+                if existing is not row:
+                    self._rows[index] = list(row)
+                self._dirty = True
+                return
+        self._rows.append(list(row))
+        self._dirty = True
+
+    def remove(self, instrument: str):
+        self._changed.discard(instrument)
+        self._removed.add(instrument)
+        self._rows = [row for row in self._rows if row[0] != instrument]
+        self._dirty = True
+
+    def flush(self):
+        if not self._dirty:
+            return
+        if self.shared:
+            with FileLock(f"{self.csv_name}.write.lock"):
+                changed = {row[0]: row for row in self._rows if row[0] in self._changed}
+                rows = [
+                    changed.pop(row[0], row) for row in read_last_runs(self.csv_name)
+                    if row and row[0] not in self._removed
+                ]
+                write_last_runs(self.csv_name, rows + list(changed.values()))
+        else:
+            write_last_runs(self.csv_name, self._rows)
+        self._changed.clear()
+        self._removed.clear()
+        self._dirty = False
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Keeps the last runs in an SQLite database in WAL mode. Each update is
+    committed straight away and only touches the instrument's own row.
+    An existing CSV file is imported when the database is empty.
+    """
+
+    def __init__(self, location, import_csv=None):
+        self.location = location
+        # Updates arrive from the poll worker threads
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(location, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL is durable across process crashes, only a power loss can lose the last commits
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS last_runs ("
+                                     "instrument TEXT PRIMARY KEY, "
+                                     "last_run INTEGER NOT NULL, "
+                                     "last_run_file TEXT NOT NULL, "
+                                     "summary_file TEXT NOT NULL, "
+                                     "data_dir TEXT NOT NULL, "
+                                     "file_ext TEXT NOT NULL, "
+                                     "position INTEGER NOT NULL)")
+        if import_csv is not None and os.path.isfile(import_csv) and not self.load():
+            LOGGING.info("Importing last runs from %s into %s", import_csv, location)
+            with self._lock, self._connection:
+                for position, row in enumerate(read_last_runs(import_csv)):
+                    if row:
+                        self._upsert(row, position)
+
+    def _upsert(self, row: List[str], position: int):
+        self._connection.execute(
+            "INSERT INTO last_runs VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(instrument) DO UPDATE SET last_run = excluded.last_run, "
+            "last_run_file = excluded.last_run_file, summary_file = excluded.summary_file, "
+            "data_dir = excluded.data_dir, file_ext = excluded.file_ext",
+            (row[0], int(row[1]), row[2], row[3], row[4], row[5], position))
+
+    def load(self) -> List[List[str]]:
+        with self._lock:
+            cursor = self._connection.execute("SELECT instrument, last_run, last_run_file, summary_file, data_dir, "
+                                              "file_ext FROM last_runs ORDER BY position, instrument")
+            return [[row[0], str(row[1]), *row[2:]] for row in cursor.fetchall()]
+
+    def update(self, row: List[str]):
+        with self._lock, self._connection:
+            position = self._connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM last_runs").fetchone()[0]
+            self._upsert(row, position)
+
+    def remove(self, instrument: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM last_runs WHERE instrument = ?", (instrument, ))
+
+    def close(self):
+        self._connection.close()
+
+
+def open_state_store(csv_name, shared: bool = False) -> StateStore:
+    """
+    Open the state store selected by STATE_BACKEND. The SQLite database is
+    kept next to the CSV file and imports it when first created.
+
+    Args:
+        csv_name: Location of the last runs CSV file
+        shared: Whether other processes update the same store
+    """
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(f"{os.path.splitext(str(csv_name))[0]}.sqlite3", import_csv=csv_name)
+    if STATE_BACKEND != "csv":
+        raise ValueError(f"Unknown STATE_BACKEND '{STATE_BACKEND}', expected 'csv' or 'sqlite'")
+    return CSVStateStore(csv_name, shared)
@@ -0,0 +1,167 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Incremental reading of the instruments' journal summary.txt, to attach the
+RB number and title of each run to its submission.
+"""
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from autoreduce_run_detection.settings import SUMMARY_INDEX_SIZE
+
+LOGGING = logging.getLogger(__package__)
+
+# summary.txt records are fixed width: instrument prefix and run number (8), user (17), title (24),
+# date (11), time (9), µAh (8) and RB number (8)
+RUN_ID = slice(0, 8)
+TITLE = slice(25, 49)
+RUN_ID_PATTERN = re.compile(r"[A-Za-z]+(\d+)")
+
+# The run ID column only holds the last digits of long run numbers
+RUN_NUMBER_DIGITS = 5
+
+
+def parse_summary_line(line: str) -> Optional[Dict[str, str]]:
+    """
+    Parse one record of summary.txt
+
+    Returns:
+        The run number, RB number and title of the record, or None if it isn't a run record
+    """
+    match = RUN_ID_PATTERN.match(line[RUN_ID])
+    fields = line.split()
+    if match is None or len(line) < TITLE.stop or not fields[-1].isdigit():
+        return None
+    return {"run_number": match.group(1), "rb_number": fields[-1], "title": line[TITLE].strip()}
+
+
+class SummaryTail:
+    """
+    Follows one summary.txt, reading only the records appended since the
+    last read. The byte offset and inode are kept so that a replaced or
+    truncated file is read again from the start. The most recent
+    SUMMARY_INDEX_SIZE records are kept in a run number -> metadata index.
+    """
+
+    def __init__(self, path: str, offset: int = 0, inode: int = 0, runs: Optional[Dict[str, Dict[str, str]]] = None):
+        self.path = path
+        self.offset = offset
+        self.inode = inode
+        self.runs: "OrderedDict[str, Dict[str, str]]" = OrderedDict(runs or {})
+        self.lock = threading.Lock()
+
+    def update(self):
+        """
+        Parse any records appended since the last update
+        """
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            # Rotated or truncated, start again from the beginning of the new file
+            self.inode = stat.st_ino
+            self.offset = 0
+        if stat.st_size == self.offset:
+            return
+        with open(self.path, mode='rb') as summary:
+            summary.seek(self.offset)
+            appended = summary.read(stat.st_size - self.offset)
+        # Leave a record that is still being written for the next update
+        complete = appended.rfind(b"\n") + 1
+        self.offset += complete
+        for line in appended[:complete].decode("utf-8", errors="replace").splitlines():
+            record = parse_summary_line(line)
+            if record is not None:
+                run_number = record.pop("run_number")
+                self.runs.pop(run_number, None)
+                self.runs[run_number] = record
+        while len(self.runs) > SUMMARY_INDEX_SIZE:
+            self.runs.popitem(last=False)
+
+    def lookup(self, run: int) -> Optional[Dict[str, str]]:
+        """
+        Metadata of a run if its record has been read
+        """
+        padded = str(run).zfill(RUN_NUMBER_DIGITS)
+        return self.runs.get(padded, self.runs.get(padded[-RUN_NUMBER_DIGITS:]))
+
+
+class SummaryIndex:
+    """
+    The summary.txt tails of every instrument, persisted between invocations
+    """
+
+    def __init__(self, tails: Optional[Dict[str, SummaryTail]] = None):
+        self._tails: Dict[str, SummaryTail] = tails or {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def metadata(self, instrument: str, summary_file: str, start_run: int, end_run: int) -> Dict[str, Dict[str, str]]:
+        """
+        Metadata of runs start_run up to but not including end_run found in the instrument's summary.txt
+
+        Returns:
+            Metadata keyed by run number, leaving out runs without a record. Empty if summary.txt can't be read.
+        """
+        with self._lock:
+            tail = self._tails.get(instrument)
+            if tail is None or tail.path != summary_file:
+                tail = self._tails[instrument] = SummaryTail(summary_file)
+        with tail.lock:
+            position = (tail.inode, tail.offset)
+            try:
+                tail.update()
+            except OSError as err:
+                LOGGING.warning("Unable to read summary file of %s: %s", instrument, err)
+            if position != (tail.inode, tail.offset):
+                self._dirty = True
+            found = {}
+            for run in range(start_run, end_run):
+                record = tail.lookup(run)
+                if record is not None:
+                    found[str(run)] = dict(record)
+        return found
+
+    @classmethod
+    def load(cls, location: str) -> "SummaryIndex":
+        """
+        Load the offsets and records saved by a previous invocation, or an empty index
+        """
+        try:
+            with open(location, mode='r', encoding="utf-8") as index_file:
+                saved = json.load(index_file)
+            tails = {instrument: SummaryTail(**tail) for instrument, tail in saved.items()}
+        except (OSError, ValueError, TypeError) as err:
+            if os.path.exists(location):
+                LOGGING.warning("Ignoring unreadable summary index %s: %s", location, err)
+            tails = {}
+        return cls(tails)
+
+    def save(self, location: str):
+        """
+        Save the offsets and records for the next invocation if they have changed
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            tails = list(self._tails.items())
+        saved = {}
+        for instrument, tail in tails:
+            with tail.lock:
+                saved[instrument] = {
+                    "path": tail.path,
+                    "offset": tail.offset,
+                    "inode": tail.inode,
+                    "runs": dict(tail.runs)
+                }
+        temporary = f"{location}.tmp"
+        with open(temporary, mode='w', encoding="utf-8") as index_file:
+            json.dump(saved, index_file)
+        os.replace(temporary, location)
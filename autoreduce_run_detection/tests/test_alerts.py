@@ -0,0 +1,81 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the Teams alert dispatcher
+"""
+import threading
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from requests.exceptions import ReadTimeout
+
+from autoreduce_run_detection.alerts import AlertDispatcher
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestAlertDispatcher(TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        self.session.post.return_value.status_code = 200
+        self.dispatcher = AlertDispatcher("http://teams", self.session, window=60)
+
+    def _texts(self):
+        return [call[1]["json"]["text"] for call in self.session.post.call_args_list]
+
+    @patch('autoreduce_run_detection.alerts.time.monotonic')
+    def test_repeated_alerts_coalesced_within_window(self, monotonic_mock):
+        monotonic_mock.return_value = 0
+        self.dispatcher.alert("WISH", "ConnectionError", "Failed to submit runs 1-1 for instrument WISH")
+        self.dispatcher.alert("GEM", "ConnectionError", "Failed to submit runs 5-5 for instrument GEM")
+        self.dispatcher.flush()
+        self.assertEqual(2, self.session.post.call_count)
+
+        for run in range(2, 5):
+            self.dispatcher.alert("WISH", "ConnectionError", f"Failed to submit runs {run}-{run} for instrument WISH")
+        monotonic_mock.return_value = 59
+        self.dispatcher.flush()
+        self.assertEqual(2, self.session.post.call_count)
+
+        monotonic_mock.return_value = 60
+        self.dispatcher.flush()
+        self.assertEqual("Failed to submit runs 4-4 for instrument WISH (3 failures in the last 60s)",
+                         self._texts()[-1])
+        self.assertEqual(3, self.session.post.call_count)
+
+    def test_error_classes_alerted_separately(self):
+        self.dispatcher.alert("WISH", "ConnectionError", "first")
+        self.dispatcher.alert("WISH", "ReadTimeout", "second")
+        self.dispatcher.flush()
+        self.assertEqual(["first", "second"], self._texts())
+
+    def test_sent_with_timeout_and_without_retries(self):
+        self.session.post.side_effect = ReadTimeout
+        self.dispatcher.alert("WISH", "ConnectionError", "text")
+        with patch('autoreduce_run_detection.alerts.LOGGING') as logging_mock:
+            self.dispatcher.flush()
+        self.session.post.assert_called_once()
+        self.assertIn("timeout", self.session.post.call_args[1])
+        logging_mock.error.assert_called_once()
+
+    def test_alert_does_not_wait_for_teams(self):
+        posting, release = threading.Event(), threading.Event()
+
+        def post(*_, **__):
+            posting.set()
+            release.wait(5)
+            return self.session.post.return_value
+
+        self.session.post.side_effect = post
+        self.dispatcher.start()
+        self.dispatcher.alert("WISH", "ConnectionError", "first")
+        self.assertTrue(posting.wait(5))
+        # Teams is still busy with the first card
+        self.dispatcher.alert("WISH", "ConnectionError", "second")
+        release.set()
+        self.dispatcher.stop()
+        self.assertFalse(self.dispatcher.is_alive())
+        self.assertEqual(["first", "second"], self._texts())
@@ -0,0 +1,152 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the autoreduce API session, run against a local stub HTTP server
+"""
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+
+from requests.exceptions import ConnectionError, ReadTimeout  # pylint:disable=redefined-builtin
+
+from autoreduce_run_detection.api import CircuitBreaker, backoff_delay, create_session, post_with_retries
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """
+    Replies with the next status code scripted on the server, 200 once they run out
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint:disable=invalid-name
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(self.client_address)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = json.dumps({"status": status}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+@patch('autoreduce_run_detection.api.backoff_delay', return_value=0)
+class TestAPI(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubAPIHandler)
+        self.server.statuses = []
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/runs/WISH"
+        self.session = create_session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_kept_alive(self, _):
+        for _ in range(3):
+            self.assertEqual(200, post_with_retries(self.session, self.url, json={"runs": [1]}).status_code)
+        self.assertEqual(1, len(set(self.server.requests)))
+
+    def test_5xx_retried(self, backoff_delay_mock):
+        self.server.statuses = [503, 502]
+        response = post_with_retries(self.session, self.url, retries=3, json={"runs": [1]})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual([0, 1], [call[0][0] for call in backoff_delay_mock.call_args_list])
+
+    def test_retry_budget_exhausted(self, _):
+        self.server.statuses = [500, 500, 500]
+        response = post_with_retries(self.session, self.url, retries=2, json={"runs": [1]})
+        self.assertEqual(500, response.status_code)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_4xx_not_retried(self, _):
+        self.server.statuses = [401]
+        response = post_with_retries(self.session, self.url, retries=3, json={"runs": [1]})
+        self.assertEqual(401, response.status_code)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_connection_error_retried_then_raised(self, backoff_delay_mock):
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            closed_url = f"http://127.0.0.1:{unused.getsockname()[1]}/runs/WISH"
+        with self.assertRaises(ConnectionError):
+            post_with_retries(self.session, closed_url, retries=2, json={"runs": [1]})
+        self.assertEqual(2, backoff_delay_mock.call_count)
+
+    def test_read_timeout_not_retried(self, backoff_delay_mock):
+        with patch.object(self.session, 'post', side_effect=ReadTimeout) as post_mock:
+            with self.assertRaises(ReadTimeout):
+                post_with_retries(self.session, self.url, retries=3, json={"runs": [1]})
+        post_mock.assert_called_once()
+        backoff_delay_mock.assert_not_called()
+
+    def test_timeouts_set(self, _):
+        with patch.object(self.session, 'post') as post_mock:
+            post_mock.return_value.status_code = 200
+            post_with_retries(self.session, self.url, json={"runs": [1]})
+        self.assertEqual(2, len(post_mock.call_args[1]["timeout"]))
+
+
+class TestBackoffDelay(TestCase):
+
+    @patch('autoreduce_run_detection.api.API_BACKOFF', 0.5)
+    @patch('autoreduce_run_detection.api.API_BACKOFF_MAX', 3)
+    def test_jittered_and_capped(self):
+        for attempt, limit in [(0, 0.5), (1, 1), (2, 2), (5, 3)]:
+            delays = [backoff_delay(attempt) for _ in range(50)]
+            self.assertTrue(all(0 <= delay <= limit for delay in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failures=3, reset_timeout=60)
+        self.assertFalse(breaker.record_failure())
+        breaker.record_success()
+        self.assertFalse(breaker.record_failure())
+        self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.record_failure())
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+
+    @patch('autoreduce_run_detection.api.time.monotonic')
+    def test_one_probe_per_reset_timeout(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        breaker = CircuitBreaker(failures=1, reset_timeout=60)
+        breaker.record_failure()
+
+        monotonic_mock.return_value = 160
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        # A failed probe keeps the circuit open for another timeout
+        self.assertFalse(breaker.record_failure())
+        monotonic_mock.return_value = 219
+        self.assertFalse(breaker.allow())
+        monotonic_mock.return_value = 220
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(failures=0)
+        for _ in range(10):
+            self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.allow())
@@ -0,0 +1,61 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the rate limited, resumable backfill
+"""
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_run_detection.backfill import BackfillCheckpoint, RateLimiter, backfill_chunks, run_backfill
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestBackfill(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.location = os.path.join(self.directory.name, "backfill.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @patch('autoreduce_run_detection.backfill.SUBMIT_CHUNK_SIZE', 3)
+    def test_chunks_split_at_gaps(self):
+        self.assertEqual([(100, 103), (103, 105), (200, 201)], backfill_chunks({100, 101, 102, 103, 104, 200}))
+
+    def test_rate_limited(self):
+        limiter = RateLimiter(20)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.acquire) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The first call goes straight away, the others are spaced 1/20s apart
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    @patch('autoreduce_run_detection.backfill.SUBMIT_CHUNK_SIZE', 2)
+    def test_resumes_after_failure(self):
+        failing = Mock(side_effect=lambda start_run, end_run: self.assertNotEqual(102, start_run))
+        self.assertFalse(run_backfill(BackfillCheckpoint.load(self.location, set(range(100, 106))), failing, rate=0))
+        self.assertEqual(3, failing.call_count)
+
+        submit = Mock()
+        checkpoint = BackfillCheckpoint.load(self.location, set(range(100, 106)))
+        self.assertEqual({102, 103}, checkpoint.remaining())
+        self.assertTrue(run_backfill(checkpoint, submit, rate=0))
+        submit.assert_called_once_with(102, 104)
+        # A finished backfill can be started again from scratch
+        self.assertFalse(os.path.exists(self.location))
+
+    def test_unreadable_checkpoint_ignored(self):
+        with open(self.location, mode='w', encoding="utf-8") as checkpoint_file:
+            checkpoint_file.write("{")
+        self.assertEqual({1, 2}, BackfillCheckpoint.load(self.location, {1, 2}).remaining())
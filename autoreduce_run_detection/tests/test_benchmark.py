@@ -0,0 +1,92 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the benchmark harness
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+from parameterized import parameterized
+
+from autoreduce_run_detection.benchmark import (RunSimulator, StubReductionAPI, SyntheticArchive, import_times,
+                                                percentile, run_benchmark, run_startup_benchmark)
+from autoreduce_run_detection.summary import parse_summary_line
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestBenchmark(TestCase):
+
+    def test_synthetic_archive(self):
+        """
+        Test that the archive is laid out like the ISIS archive and advances like an instrument
+        """
+        with tempfile.TemporaryDirectory() as root:
+            archive = SyntheticArchive(root, ["BENCH0"], first_run=1000)
+            archive.end_run("BENCH0", 2)
+            row = archive.rows()[0]
+            self.assertEqual(["BENCH0", "1002"], row[:2])
+            self.assertEqual(os.path.join(root, "NDXBENCH0", "Instrument", "logs", "lastrun.txt"), row[2])
+            with open(row[2], encoding="utf-8") as last_run:
+                self.assertEqual(["BENCH0", "00001002", "0"], last_run.readline().split())
+            with open(row[3], encoding="utf-8") as summary:
+                self.assertEqual("01002", parse_summary_line(summary.readlines()[-1])["run_number"])
+            self.assertTrue(os.path.isfile(os.path.join(row[4], "cycle_bench", "BENCH000001002.nxs")))
+
+    def test_simulator_is_repeatable(self):
+        with tempfile.TemporaryDirectory() as root:
+            first = RunSimulator(SyntheticArchive(os.path.join(root, "a"), ["BENCH0", "BENCH1"]), 3600, seed=1)
+            second = RunSimulator(SyntheticArchive(os.path.join(root, "b"), ["BENCH0", "BENCH1"]), 3600, seed=1)
+            self.assertEqual(first.advance(10), second.advance(10))
+            self.assertEqual(first.archive.last_runs, second.archive.last_runs)
+
+    @parameterized.expand([[0.0, 200], [1.0, 503]])
+    def test_stub_api(self, error_rate, status_code):
+        api = StubReductionAPI(error_rate=error_rate)
+        api.start()
+        try:
+            response = requests.post(f"{api.url}/runs/BENCH0", json={"runs": [1, 2]}, timeout=5)
+        finally:
+            api.stop()
+        self.assertEqual(status_code, response.status_code)
+        self.assertEqual(2 if status_code == 200 else 0, api.runs_received)
+        self.assertEqual({("BENCH0", 1), ("BENCH0", 2)} if status_code == 200 else set(), set(api.received))
+
+    def test_percentile(self):
+        self.assertEqual(0.0, percentile([], 0.5))
+        self.assertEqual(5, percentile(list(range(1, 11)), 0.5))
+        self.assertEqual(10, percentile(list(range(1, 11)), 0.99))
+
+    @parameterized.expand([["once"], ["daemon"]])
+    @patch('autoreduce_run_detection.api.API_BACKOFF', 0)
+    def test_run_benchmark(self, mode):
+        """
+        Test that every run ended on the archive is submitted to the stub API and reported
+        """
+        report = run_benchmark(instruments=3, cycles=3, mode=mode, runs_per_hour=3600)
+        self.assertEqual(3, report["cycles"])
+        self.assertGreater(report["runs_ended"], 0)
+        self.assertEqual(report["runs_ended"], report["runs_submitted"])
+        self.assertLessEqual(report["cycle_p50"], report["cycle_p99"])
+        self.assertGreater(report["peak_memory_mb"], 0)
+
+    def test_import_times(self):
+        stderr = ("import time: self [us] | cumulative | imported package\n"
+                  "import time:       120 |        120 |   json.decoder\n"
+                  "import time:       300 |       1500 | autoreduce_run_detection\n")
+        self.assertEqual({"json.decoder": 0.00012, "autoreduce_run_detection": 0.0015}, import_times(stderr))
+
+    def test_run_startup_benchmark(self):
+        """
+        Test that a --once invocation with no new runs starts without importing the HTTP stack
+        """
+        report = run_startup_benchmark(instruments=2, repeats=1)
+        self.assertEqual(1, report["repeats"])
+        self.assertGreater(report["import_p50"], 0)
+        self.assertGreater(report["once_p50"], report["import_p50"])
+        self.assertFalse(report["http_imported"])
@@ -0,0 +1,137 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the data directory index
+"""
+import os
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from autoreduce_run_detection.data_index import DataDirectoryIndex, DataIndex, from_ranges, list_runs, to_ranges
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestDataIndex(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.data_dir = self.directory.name
+        self.cycle_dir = os.path.join(self.data_dir, "cycle_18_4")
+        os.mkdir(self.cycle_dir)
+        for run in (44731, 44732):
+            self._land(run)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _land(self, run, cycle_dir=None):
+        cycle_dir = cycle_dir or self.cycle_dir
+        Path(cycle_dir, f"WISH000{run}.nxs").touch()
+        # Filesystems with coarse timestamps may not see the directory as modified otherwise
+        stat = os.stat(cycle_dir)
+        os.utime(cycle_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    def test_ranges(self):
+        self.assertEqual([(1, 3), (5, 5)], to_ranges({1, 2, 3, 5}))
+        self.assertEqual({1, 2, 3, 5}, from_ranges([(1, 3), (5, 5)]))
+
+    def test_list_runs(self):
+        Path(self.cycle_dir, "WISH00044733.log").touch()
+        Path(self.cycle_dir, "notes.nxs").touch()
+        self.assertEqual({44731, 44732}, list_runs(self.cycle_dir, ".nxs"))
+
+    def test_refresh_only_lists_changed_cycles(self):
+        """
+        Test that unchanged cycle directories are not listed again
+        """
+        index = DataDirectoryIndex(self.data_dir, ".nxs")
+        self.assertTrue(index.refresh())
+        self.assertTrue(index.has_run(44732))
+
+        with patch('autoreduce_run_detection.data_index.list_runs') as list_runs_mock:
+            self.assertFalse(index.refresh())
+        list_runs_mock.assert_not_called()
+
+        new_cycle = os.path.join(self.data_dir, "cycle_19_1")
+        os.mkdir(new_cycle)
+        self._land(44733, new_cycle)
+        self.assertTrue(index.refresh())
+        self.assertTrue(index.has_run(44733))
+
+    def test_ready_until_holds_missing_runs(self):
+        """
+        Test that runs are held from the first one without a data file, and released once it lands
+        """
+        index = DataIndex()
+        self.assertEqual(44733, index.ready_until("WISH", self.data_dir, ".nxs", 44731, 44735))
+        self._land(44734)
+        self.assertEqual(44733, index.ready_until("WISH", self.data_dir, ".nxs", 44733, 44735))
+        self._land(44733)
+        self.assertEqual(44735, index.ready_until("WISH", self.data_dir, ".nxs", 44733, 44735))
+
+    @patch('autoreduce_run_detection.data_index.DATA_HOLD_TIMEOUT', 0)
+    def test_ready_until_releases_after_timeout(self):
+        index = DataIndex()
+        self.assertEqual(44735, index.ready_until("WISH", self.data_dir, ".nxs", 44731, 44735))
+
+    def test_ready_until_unreadable_data_dir(self):
+        """
+        Test that runs aren't held back when the data directory can't be read
+        """
+        index = DataIndex()
+        self.assertEqual(44735, index.ready_until("WISH", os.path.join(self.data_dir, "missing"), ".nxs", 44733, 44735))
+
+    def test_hung_data_dir_holds_up_its_instrument_only(self):
+        """
+        Test that other instruments are looked up and the index saved while one instrument's data directory hangs
+        """
+        index = DataIndex()
+        index.ready_until("WISH", self.data_dir, ".nxs", 44731, 44733)
+        hung_dir = os.path.join(self.data_dir, "hung")
+        started, release = threading.Event(), threading.Event()
+        stat = os.stat
+
+        def hang_on_stat(path, *args, **kwargs):
+            if path == hung_dir:
+                started.set()
+                release.wait(5)
+            return stat(path, *args, **kwargs)
+
+        with patch('autoreduce_run_detection.data_index.os.stat', side_effect=hang_on_stat):
+            thread = threading.Thread(target=index.ready_until, args=("GEM", hung_dir, ".nxs", 100, 101))
+            thread.start()
+            try:
+                started.wait(5)
+                self.assertEqual(44733, index.ready_until("WISH", self.data_dir, ".nxs", 44731, 44735))
+                index.save(os.path.join(self.data_dir, "data_index.json"))
+                self.assertTrue(thread.is_alive())
+            finally:
+                release.set()
+                thread.join()
+
+    def test_save_and_load(self):
+        """
+        Test that the index and the held runs survive between invocations
+        """
+        location = os.path.join(self.data_dir, "data_index.json")
+        index = DataIndex()
+        index.ready_until("WISH", self.data_dir, ".nxs", 44731, 44734)
+        index.save(location)
+
+        loaded = DataIndex.load(location)
+        with patch('autoreduce_run_detection.data_index.list_runs') as list_runs_mock:
+            self.assertEqual(44733, loaded.ready_until("WISH", self.data_dir, ".nxs", 44733, 44734))
+        list_runs_mock.assert_not_called()
+
+    def test_load_unreadable(self):
+        location = os.path.join(self.data_dir, "data_index.json")
+        with open(location, mode='w', encoding="utf-8") as index_file:
+            index_file.write("{")
+        with self.assertLogs('autoreduce_run_detection', level='WARNING'):
+            DataIndex.load(location)
@@ -0,0 +1,72 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the run latency tracking
+"""
+import os
+import tempfile
+from unittest import TestCase
+
+from autoreduce_run_detection.latency import LatencyTracker, RunTiming, format_report, quantile
+from autoreduce_run_detection.metrics import RUN_LATENCY_QUANTILE_SECONDS
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestLatencyTracker(TestCase):
+
+    def test_runs_timed_from_detection_to_acknowledgement(self):
+        tracker = LatencyTracker()
+        tracker.detected("WISH", 100, 103, written=1000, detected=1010)
+        # Detected again on a later cycle, e.g. while held back or after a failed submission
+        tracker.detected("WISH", 100, 104, written=1050, detected=1060)
+        tracker.acknowledged("WISH", 100, 102, acknowledged=1020)
+        tracker.acknowledged("WISH", 102, 104, acknowledged=1100)
+        expected = [
+            RunTiming(100, 1000, 1010, 1020),
+            RunTiming(101, 1000, 1010, 1020),
+            RunTiming(102, 1000, 1010, 1100),
+            RunTiming(103, 1050, 1060, 1100)
+        ]
+        self.assertEqual(expected, tracker.timings()["WISH"])
+        self.assertEqual(
+            (10, 40, 50),
+            tuple(tracker.timings()["WISH"][3].stage(stage) for stage in ("detection", "submission", "total")))
+
+    def test_skipped_runs_dropped(self):
+        tracker = LatencyTracker()
+        tracker.detected("WISH", 100, 105, written=1000, detected=1010)
+        tracker.acknowledged("WISH", 103, 104, acknowledged=1020)
+        tracker.acknowledged("WISH", 104, 105, acknowledged=1030)
+        self.assertEqual([103, 104], [timing.run for timing in tracker.timings()["WISH"]])
+
+    def test_window(self):
+        tracker = LatencyTracker(window=2)
+        tracker.detected("WISH", 100, 105, written=1000, detected=1010)
+        tracker.acknowledged("WISH", 100, 105, acknowledged=1020)
+        self.assertEqual([103, 104], [timing.run for timing in tracker.timings()["WISH"]])
+
+    def test_persisted(self):
+        tracker = LatencyTracker()
+        tracker.detected("WISH", 100, 102, written=1000, detected=1010)
+        tracker.acknowledged("WISH", 100, 101, acknowledged=1020)
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, "latency.json")
+            tracker.save(location)
+            loaded = LatencyTracker.load(location)
+        loaded.acknowledged("WISH", 101, 102, acknowledged=1030)
+        self.assertEqual([RunTiming(100, 1000, 1010, 1020), RunTiming(101, 1000, 1010, 1030)], loaded.timings()["WISH"])
+
+    def test_report(self):
+        self.assertEqual(1, quantile([1, 2, 3, 4], 0.25))
+        self.assertEqual(4, quantile([1, 2, 3, 4], 0.99))
+        tracker = LatencyTracker()
+        tracker.detected("GEM", 1, 101, written=0, detected=5)
+        for run in range(1, 101):
+            tracker.acknowledged("GEM", run, run + 1, acknowledged=5 + run)
+        tracker.report()
+        self.assertEqual(95, RUN_LATENCY_QUANTILE_SECONDS.value(instrument="GEM", stage="submission", quantile="0.95"))
+        self.assertEqual(["GEM", "100", "5.0/5.0/5.0", "50.0/95.0/99.0", "55.0/100.0/104.0"],
+                         format_report(tracker.timings()).splitlines()[1].split())
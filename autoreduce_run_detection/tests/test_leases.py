@@ -0,0 +1,95 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the instrument leases shared by run detection replicas
+"""
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_run_detection.leases import LeaseManager
+from autoreduce_run_detection.run_detection import main
+
+INSTRUMENTS = [f"INST{index}" for index in range(20)]
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestLeaseManager(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.leases = os.path.join(self.directory.name, "last_runs.csv.leases")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            LeaseManager(self.leases, "first", mode="random")
+
+    def test_hash_mode_splits_instruments(self):
+        first, second = LeaseManager(self.leases, "first"), LeaseManager(self.leases, "second")
+        first.claim(INSTRUMENTS)
+        # The second replica only gets its instruments once the first has seen it and handed them over
+        self.assertEqual(set(), second.claim(INSTRUMENTS))
+        first_owned = first.claim(INSTRUMENTS)
+        second_owned = second.claim(INSTRUMENTS)
+        self.assertFalse(first_owned & second_owned)
+        self.assertEqual(set(INSTRUMENTS), first_owned | second_owned)
+        self.assertTrue(first_owned and second_owned)
+
+    def test_instruments_taken_over_when_replica_disappears(self):
+        first, second = LeaseManager(self.leases, "first", ttl=60), LeaseManager(self.leases, "second", ttl=60)
+        with patch('autoreduce_run_detection.leases.time.time', return_value=1000):
+            first.claim(INSTRUMENTS)
+            second.claim(INSTRUMENTS)
+            first.claim(INSTRUMENTS)
+            # Still leased by the first replica
+            self.assertFalse(second.acquire(sorted(first.owned)[0]))
+        with patch('autoreduce_run_detection.leases.time.time', return_value=1061):
+            self.assertEqual(set(INSTRUMENTS), second.claim(INSTRUMENTS))
+
+    def test_release_all_hands_over_straight_away(self):
+        first, second = LeaseManager(self.leases, "first"), LeaseManager(self.leases, "second")
+        first.claim(INSTRUMENTS)
+        second.claim(INSTRUMENTS)
+        second.release_all()
+        self.assertEqual(set(INSTRUMENTS), first.claim(INSTRUMENTS))
+        self.assertEqual(["first"], first.live_replicas())
+
+    def test_lease_mode_takes_fair_share(self):
+        first = LeaseManager(self.leases, "first", mode="lease")
+        second = LeaseManager(self.leases, "second", mode="lease")
+        self.assertEqual(20, len(first.claim(INSTRUMENTS)))
+        # The second replica has to wait for the first to hand over its extra instruments
+        second.claim(INSTRUMENTS)
+        self.assertEqual(10, len(first.claim(INSTRUMENTS)))
+        self.assertEqual(10, len(second.claim(INSTRUMENTS)))
+        self.assertFalse(first.owned & second.owned)
+
+
+class TestOnceAlongsideReplicas(TestCase):
+
+    @patch('autoreduce_run_detection.run_detection.SHARDING', "hash")
+    @patch('autoreduce_run_detection.run_detection.FileLock')
+    @patch('autoreduce_run_detection.run_detection.update_last_runs')
+    @patch('requests.Session.post')
+    def test_once_refused(self, requests_post_mock: Mock, update_last_runs_mock: Mock, lock_mock: Mock):
+        """
+        Test that a --once run doesn't poll the instruments a sharded replica holds the leases on
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            leases = LeaseManager(os.path.join(directory, "last_runs.csv.leases"), "first")
+            self.assertEqual({"WISH"}, leases.claim(["WISH"]))
+            with patch.object(Path, 'is_file', return_value=True), self.assertRaises(SystemExit):
+                main(["--once"])
+            self.assertEqual({"WISH"}, leases.claim(["WISH"]))
+            leases.release_all()
+        lock_mock.assert_not_called()
+        update_last_runs_mock.assert_not_called()
+        requests_post_mock.assert_not_called()
@@ -0,0 +1,56 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the ledger of acknowledged runs
+"""
+import os
+import tempfile
+from unittest import TestCase
+
+from autoreduce_run_detection.ledger import SubmissionLedger
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestSubmissionLedger(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.location = os.path.join(self.directory.name, "ledger.sqlite3")
+        self.ledger = SubmissionLedger(self.location)
+
+    def tearDown(self):
+        self.ledger.close()
+        self.directory.cleanup()
+
+    def test_in_order_submissions_compacted(self):
+        for start_run in range(100, 200, 10):
+            self.ledger.record("WISH", start_run, start_run + 10)
+        self.ledger.record("GEM", 5, 6)
+        self.assertEqual([(100, 200)], self.ledger.ranges("WISH"))
+        self.assertEqual([(5, 6)], self.ledger.ranges("GEM"))
+
+    def test_range_joining_and_covering_others(self):
+        self.ledger.record("WISH", 100, 105)
+        self.ledger.record("WISH", 110, 115)
+        self.ledger.record("WISH", 120, 125)
+        self.ledger.record("WISH", 105, 110)
+        self.assertEqual([(100, 115), (120, 125)], self.ledger.ranges("WISH"))
+        self.ledger.record("WISH", 90, 130)
+        self.assertEqual([(90, 130)], self.ledger.ranges("WISH"))
+
+    def test_unacknowledged(self):
+        self.ledger.record("WISH", 100, 105)
+        self.ledger.record("WISH", 110, 115)
+        self.assertEqual([(95, 100), (105, 110), (115, 120)], self.ledger.unacknowledged("WISH", 95, 120))
+        self.assertEqual([], self.ledger.unacknowledged("WISH", 101, 104))
+        self.assertEqual([(105, 107)], self.ledger.unacknowledged("WISH", 103, 107))
+        self.assertEqual([(100, 105)], self.ledger.unacknowledged("GEM", 100, 105))
+
+    def test_persisted(self):
+        self.ledger.record("WISH", 100, 105)
+        self.ledger.close()
+        self.ledger = SubmissionLedger(self.location)
+        self.assertEqual([(105, 106)], self.ledger.unacknowledged("WISH", 100, 106))
@@ -0,0 +1,112 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the metrics exposition
+"""
+import os
+import tempfile
+from unittest import TestCase
+
+import requests
+
+from autoreduce_run_detection.metrics import (OPENMETRICS_CONTENT_TYPE, Counter, Gauge, Histogram, MetricsServer,
+                                              Registry, write_textfile)
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = Counter("runs", "Runs \"submitted\"", ["instrument"], registry=self.registry)
+        self.histogram = Histogram("read_seconds",
+                                   "Read time", ["instrument"],
+                                   buckets=[0.1, 1],
+                                   registry=self.registry)
+
+    def test_counter(self):
+        self.counter.inc(instrument="WISH")
+        self.counter.inc(2, instrument="WISH")
+        self.assertEqual(3, self.counter.value(instrument="WISH"))
+        self.assertEqual(0, self.counter.value(instrument="GEM"))
+        with self.assertRaises(ValueError):
+            self.counter.inc(-1, instrument="WISH")
+        with self.assertRaises(ValueError):
+            self.counter.inc(code="200")
+
+    def test_gauge(self):
+        gauge = Gauge("latency_seconds", "Latency", ["quantile"], registry=self.registry)
+        self.assertIsNone(gauge.value(quantile="0.5"))
+        gauge.set(3, quantile="0.5")
+        gauge.set(1.5, quantile="0.5")
+        self.assertEqual(1.5, gauge.value(quantile="0.5"))
+        self.assertIn('# TYPE latency_seconds gauge\nlatency_seconds{quantile="0.5"} 1.5\n', self.registry.render())
+
+    def test_duplicate_name(self):
+        with self.assertRaises(ValueError):
+            Counter("runs", "Again", registry=self.registry)
+
+    def test_render_prometheus(self):
+        """
+        Test the text format read by the node-exporter textfile collector
+        """
+        self.counter.inc(instrument="WISH")
+        self.histogram.observe(0.1, instrument="WISH")
+        self.histogram.observe(5, instrument="WISH")
+        self.assertEqual(
+            '# HELP runs_total Runs \\"submitted\\"\n'
+            '# TYPE runs_total counter\n'
+            'runs_total{instrument="WISH"} 1.0\n'
+            '# HELP read_seconds Read time\n'
+            '# TYPE read_seconds histogram\n'
+            'read_seconds_bucket{instrument="WISH",le="0.1"} 1\n'
+            'read_seconds_bucket{instrument="WISH",le="1.0"} 1\n'
+            'read_seconds_bucket{instrument="WISH",le="+Inf"} 2\n'
+            'read_seconds_count{instrument="WISH"} 2\n'
+            'read_seconds_sum{instrument="WISH"} 5.1\n', self.registry.render())
+
+    def test_render_openmetrics(self):
+        self.counter.inc(instrument="WISH")
+        rendered = self.registry.render(openmetrics=True)
+        self.assertIn("# TYPE runs counter\n", rendered)
+        self.assertIn('runs_total{instrument="WISH"} 1.0\n', rendered)
+        self.assertTrue(rendered.endswith("# EOF\n"))
+
+    def test_histogram_time(self):
+        with self.assertRaises(OSError):
+            with self.histogram.time(instrument="WISH"):
+                raise OSError("archive unavailable")
+        self.assertEqual(1, self.histogram.count(instrument="WISH"))
+
+    def test_server(self):
+        """
+        Test that /metrics is served in the format asked for
+        """
+        self.counter.inc(instrument="WISH")
+        server = MetricsServer(0, registry=self.registry)
+        server.start()
+        try:
+            url = f"http://127.0.0.1:{server.port}"
+            response = requests.get(f"{url}/metrics", timeout=5)
+            self.assertEqual(200, response.status_code)
+            self.assertIn('runs_total{instrument="WISH"} 1.0', response.text)
+            response = requests.get(f"{url}/metrics",
+                                    headers={"Accept": "application/openmetrics-text; version=1.0.0"},
+                                    timeout=5)
+            self.assertEqual(OPENMETRICS_CONTENT_TYPE, response.headers["Content-Type"])
+            self.assertTrue(response.text.endswith("# EOF\n"))
+            self.assertEqual(404, requests.get(f"{url}/other", timeout=5).status_code)
+        finally:
+            server.stop()
+
+    def test_write_textfile(self):
+        self.counter.inc(instrument="WISH")
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, "run_detection.prom")
+            write_textfile(location, self.registry)
+            self.assertEqual([location], [entry.path for entry in os.scandir(directory)])
+            with open(location, encoding="utf-8") as textfile:
+                self.assertEqual(self.registry.render(), textfile.read())
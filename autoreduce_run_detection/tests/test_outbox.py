@@ -0,0 +1,107 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the submission outbox
+"""
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import Mock, call, patch
+
+from autoreduce_run_detection.metrics import OUTBOX_PENDING
+from autoreduce_run_detection.outbox import Outbox, OutboxDrainer
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.location = os.path.join(self.directory.name, "outbox.sqlite3")
+        self.outbox = Outbox(self.location)
+
+    def tearDown(self):
+        self.outbox.close()
+        self.directory.cleanup()
+
+    def _pending(self):
+        return [(entry.instrument, entry.start_run, entry.end_run) for entry in self.outbox.due(time.time() + 3600)]
+
+    def test_adjacent_and_overlapping_ranges_coalesced(self):
+        self.outbox.enqueue("WISH", 100, 105)
+        self.outbox.enqueue("WISH", 105, 108)
+        self.outbox.enqueue("WISH", 103, 110)
+        self.outbox.enqueue("GEM", 10, 11)
+        self.outbox.enqueue("WISH", 200, 201)
+        self.assertEqual([("GEM", 10, 11), ("WISH", 100, 110), ("WISH", 200, 201)], self._pending())
+        self.assertEqual((3, 12), self.outbox.depth())
+
+    def test_range_joining_two_entries(self):
+        self.outbox.enqueue("WISH", 100, 105)
+        self.outbox.enqueue("WISH", 110, 115)
+        self.outbox.enqueue("WISH", 105, 110)
+        self.assertEqual([("WISH", 100, 115)], self._pending())
+
+    def test_persisted(self):
+        self.outbox.enqueue("WISH", 100, 105)
+        self.outbox.close()
+        self.outbox = Outbox(self.location)
+        self.assertEqual([("WISH", 100, 105)], self._pending())
+
+    @patch('autoreduce_run_detection.outbox.SUBMIT_CHUNK_SIZE', 2)
+    def test_drain_in_chunks(self):
+        self.outbox.enqueue("WISH", 100, 105)
+        submit = Mock()
+        self.outbox.drain(submit)
+        submit.assert_has_calls([call("WISH", 100, 102), call("WISH", 102, 104), call("WISH", 104, 105)])
+        self.assertEqual((0, 0), self.outbox.depth())
+
+    @patch('autoreduce_run_detection.outbox.SUBMIT_CHUNK_SIZE', 2)
+    def test_failed_drain_keeps_progress_and_backs_off(self):
+        self.outbox.enqueue("WISH", 100, 105)
+        self.outbox.enqueue("GEM", 10, 11)
+        submit = Mock(side_effect=[None, None, RuntimeError("API down")])
+        self.outbox.drain(submit)
+
+        # GEM was submitted, WISH kept the runs from the failed chunk onwards
+        self.assertEqual([("WISH", 102, 105)], self._pending())
+        self.assertEqual([], self.outbox.due())
+        self.assertEqual(1, self.outbox.due(time.time() + 3600)[0].attempts)
+        self.assertEqual(1, OUTBOX_PENDING.value(unit="ranges"))
+        self.assertEqual(3, OUTBOX_PENDING.value(unit="runs"))
+
+    @patch('autoreduce_run_detection.outbox.OUTBOX_BACKOFF', 0)
+    @patch('autoreduce_run_detection.outbox.SUBMIT_CHUNK_SIZE', 2)
+    def test_partially_drained_entry_backs_off_from_first_attempt(self):
+        self.outbox.enqueue("WISH", 100, 105)
+        self.outbox.drain(Mock(side_effect=RuntimeError("API down")))
+        self.outbox.drain(Mock(side_effect=RuntimeError("API down")))
+        self.assertEqual(2, self.outbox.due()[0].attempts)
+
+        # Acknowledging a chunk resets the backoff, the failure after it is the first since then
+        self.outbox.drain(Mock(side_effect=[None, RuntimeError("API down")]))
+        self.assertEqual([("WISH", 102, 105)], self._pending())
+        self.assertEqual(1, self.outbox.due()[0].attempts)
+
+
+class TestOutboxDrainer(TestCase):
+
+    @patch('autoreduce_run_detection.outbox.OUTBOX_DRAIN_INTERVAL', 0.01)
+    def test_drains_in_background_until_stopped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(os.path.join(directory, "outbox.sqlite3"))
+            submit = Mock()
+            drainer = OutboxDrainer(outbox, submit)
+            drainer.start()
+            outbox.enqueue("WISH", 100, 101)
+            deadline = time.monotonic() + 2
+            while outbox.depth() != (0, 0) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            drainer.stop()
+            outbox.close()
+        submit.assert_called_once_with("WISH", 100, 101)
+        self.assertFalse(drainer.is_alive())
@@ -0,0 +1,130 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the profiling of detection cycles
+"""
+import glob
+import io
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from autoreduce_run_detection.profiling import CycleProfile, CycleProfiler, format_summary, load_captures
+
+
+def read_lastrun_txt():
+    """
+    Stands in for a read of lastrun.txt, so that it can be found by name in the profile
+    """
+    return ["WISH", "44735", "0"]
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestCycleProfile(TestCase):
+
+    def test_timings_and_stats(self):
+        """
+        Test that phases and the calls made for each instrument are timed and profiled
+        """
+        cycle = CycleProfile("all", lock_wait=1.0)
+        with cycle.phase("read"):
+            thread = threading.Thread(target=cycle.timed("WISH", "read", read_lastrun_txt))
+            thread.start()
+            thread.join()
+        cycle.stop()
+
+        self.assertEqual({"lock", "read"}, set(cycle.phases))
+        self.assertGreaterEqual(cycle.duration, 1.0)
+        self.assertEqual(["read"], list(cycle.instruments["WISH"]))
+        self.assertEqual([], cycle.unfinished)
+        output = io.StringIO()
+        stats = cycle.stats()
+        stats.stream = output
+        stats.print_stats()
+        self.assertIn("read_lastrun_txt", output.getvalue())
+
+    def test_unfinished_call(self):
+        """
+        Test that a call still running when the cycle ends, e.g. on a hung mount, is recorded as such
+        """
+        cycle = CycleProfile("all", profile_code=False)
+        started, release = threading.Event(), threading.Event()
+        thread = threading.Thread(target=cycle.timed("GEM", "read", lambda: (started.set(), release.wait(5))))
+        thread.start()
+        started.wait(5)
+        cycle.stop()
+        release.set()
+        thread.join()
+        self.assertEqual([["GEM", "read"]], cycle.unfinished)
+        self.assertIn("read", cycle.instruments["GEM"])
+        self.assertIsNone(cycle.stats())
+
+
+class TestCycleProfiler(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.profiles = os.path.join(self.directory.name, "last_runs.csv.profiles")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fast_cycles_not_kept(self):
+        with CycleProfiler(self.profiles, threshold=60).cycle("all") as cycle:
+            self.assertIsNotNone(cycle)
+        self.assertFalse(os.path.exists(self.profiles))
+        with CycleProfiler(self.profiles, threshold=0).cycle("all") as cycle:
+            self.assertIsNone(cycle)
+
+    def test_always_keeps_latest(self):
+        profiler = CycleProfiler(self.profiles, threshold=60, always=True, keep=2)
+        for _ in range(3):
+            with profiler.cycle("all") as cycle:
+                cycle.record("read", 0.5)
+        self.assertEqual(2, len(glob.glob(os.path.join(self.profiles, "*.json"))))
+        self.assertEqual(2, len(glob.glob(os.path.join(self.profiles, "*.prof"))))
+
+    def test_slow_cycle_arms_code_profiling(self):
+        """
+        Test that the code of the cycles after a slow one is profiled until the next slow one is kept
+        """
+        profiler = CycleProfiler(self.profiles, threshold=1e-9)
+        with profiler.cycle("all") as first:
+            pass
+        self.assertIsNone(first.stats())
+        self.assertTrue(profiler.armed())
+
+        with profiler.cycle("all") as second:
+            pass
+        self.assertIsNotNone(second.stats())
+        self.assertFalse(profiler.armed())
+        captures = load_captures([self.profiles])
+        self.assertEqual([None, True],
+                         [capture["profile"] and os.path.isfile(capture["profile"]) for capture in captures])
+
+
+class TestFormatSummary(TestCase):
+
+    def test_format_summary(self):
+        captures = []
+        for duration in [2.0, 90.0]:
+            instruments = {"WISH": {"read": 0.1, "submit": 0.2}, "GEM": {"read": duration}}
+            captures.append({
+                "scope": "all",
+                "started": 0,
+                "duration": duration,
+                "phases": {
+                    "read": duration
+                },
+                "instruments": instruments,
+                "unfinished": [],
+                "profile": None
+            })
+        lines = format_summary(captures, top=1).splitlines()
+        self.assertEqual(["all", "90.00", "90.00", "-"], lines[2].split()[2:])
+        self.assertEqual(["GEM", "2", "90.00", "0.00", "0"], lines[-1].split())
+        self.assertEqual("No detection cycles have been profiled", format_summary([]))
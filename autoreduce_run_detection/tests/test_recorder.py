@@ -0,0 +1,85 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the trace of archive observations and submissions
+"""
+import glob
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from autoreduce_run_detection.recorder import TraceRecorder, read_trace
+from autoreduce_run_detection.run_detection import InstrumentMonitor, InstrumentMonitorError, MonitorServices
+from autoreduce_run_detection.sinks import SubmissionError
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestTraceRecorder(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.location = os.path.join(self.directory.name, "trace.jsonl")
+        self.last_run_file = os.path.join(self.directory.name, "lastrun.txt")
+        self.recorder = TraceRecorder(self.location)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write_last_run(self, content):
+        with open(self.last_run_file, mode='w', encoding="utf-8") as last_run:
+            last_run.write(content)
+
+    def test_observations_recorded_on_change(self):
+        """
+        Test that a lastrun.txt read by the monitor is only recorded when it or the error reading it changes
+        """
+        monitor = InstrumentMonitor("WISH",
+                                    last_run_file=self.last_run_file,
+                                    services=MonitorServices(recorder=self.recorder))
+        self._write_last_run("WISH 44733 0")
+        for _ in range(2):
+            monitor.read_instrument_last_run()
+        self._write_last_run("WISH 44735 0")
+        monitor.read_instrument_last_run()
+        self._write_last_run("")
+        for _ in range(2):
+            with self.assertRaises(InstrumentMonitorError):
+                monitor.read_instrument_last_run()
+
+        entries = list(read_trace(self.location))
+        self.assertEqual(["44733", "44735", None], [entry.get("run") for entry in entries])
+        self.assertTrue(entries[2]["error"].startswith("InstrumentMonitorError: Unexpected last run file format"))
+        self.assertEqual({"WISH"}, {entry["i"] for entry in entries})
+
+    def test_submissions_recorded(self):
+        sink = Mock()
+        sink.submit.side_effect = ["accepted", SubmissionError("Rejected")]
+        monitor = InstrumentMonitor("WISH", services=MonitorServices(sink=sink, recorder=self.recorder))
+        monitor.submit_runs(44734, 44736)
+        with self.assertRaises(InstrumentMonitorError):
+            monitor.submit_runs(44736, 44737)
+
+        entries = list(read_trace(self.location))
+        self.assertEqual([[44734, 44736], [44736, 44737]], [entry["submit"] for entry in entries])
+        self.assertEqual([True, False], [entry["ok"] for entry in entries])
+        self.assertTrue(all(entry["d"] >= 0 for entry in entries))
+
+    def test_new_trace_starts_with_every_instrument(self):
+        """
+        Test that a trace per day starts with the instruments' current last runs, even if they are unchanged
+        """
+        self.recorder = TraceRecorder(os.path.join(self.directory.name, "trace-%Y%m%d.jsonl"))
+        with patch("autoreduce_run_detection.recorder.time.time", side_effect=[1664582400, 1664582401, 1664668800]):
+            for _ in range(3):
+                self.recorder.observe("WISH", lambda: ["WISH", "44733", "0"])
+        traces = sorted(glob.glob(os.path.join(self.directory.name, "trace-*.jsonl")))
+        self.assertEqual([1, 1], [len(list(read_trace(location))) for location in traces])
+
+    def test_read_trace_skips_cut_lines(self):
+        with open(self.location, mode='w', encoding="utf-8") as trace:
+            trace.write('{"t":1.0,"i":"WISH","run":"44733"}\n{"t":2.0,"i":"WI')
+        self.assertEqual([{"t": 1.0, "i": "WISH", "run": "44733"}], list(read_trace(self.location)))
@@ -0,0 +1,113 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the instrument registry
+"""
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from autoreduce_run_detection.registry import InstrumentRegistry, plan_changes
+
+ROWS = [
+    ["WISH", "44733", "lastrun_wish.txt", "summary_wish.txt", "data_dir", ".nxs"],
+    ["GEM", "100", "lastrun_gem.txt", "summary_gem.txt", "data_dir", ".nxs"],
+]
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestInstrumentRegistry(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.config_file = os.path.join(self.directory.name, "instruments.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write_config(self, config):
+        with open(self.config_file, mode='w', encoding="utf-8") as config_file:
+            json.dump(config, config_file)
+
+    @patch.dict(os.environ, {"SUPPORTED_INSTRUMENTS": "WISH, GEM"})
+    def test_load_merges_supported_instruments_and_config(self):
+        self._write_config({"GEM": {"data_dir": "/archive/GEM"}, "MARI": {}})
+        expected = {"WISH": {}, "GEM": {"data_dir": "/archive/GEM"}, "MARI": {}}
+        self.assertEqual(expected, InstrumentRegistry(self.config_file).load())
+
+    @patch.dict(os.environ, {}, clear=True)
+    def test_nothing_configured(self):
+        self.assertIsNone(InstrumentRegistry().load())
+
+    @patch.dict(os.environ, {"SUPPORTED_INSTRUMENTS": "WISH, GEM"})
+    def test_retired_in_config(self):
+        self._write_config({"GEM": None})
+        registry = InstrumentRegistry(self.config_file)
+        self.assertEqual({"WISH": {}, "GEM": None}, registry.load())
+        self.assertTrue(registry.exhaustive)
+
+    @patch.dict(os.environ, {}, clear=True)
+    def test_config_alone_not_exhaustive(self):
+        self._write_config({"GEM": {}})
+        registry = InstrumentRegistry(self.config_file)
+        self.assertEqual({"GEM": {}}, registry.load())
+        self.assertFalse(registry.exhaustive)
+
+    def test_invalid_config(self):
+        self._write_config({"GEM": {"data_directory": "/archive/GEM"}})
+        with self.assertRaises(ValueError):
+            InstrumentRegistry(self.config_file).load()
+
+    @patch.dict(os.environ, {"SUPPORTED_INSTRUMENTS": "WISH"})
+    def test_changed_when_config_rewritten(self):
+        """
+        Test that the configuration is only loaded again once the file or environment has changed
+        """
+        self._write_config({})
+        registry = InstrumentRegistry(self.config_file)
+        self.assertTrue(registry.changed())
+        registry.load()
+        self.assertFalse(registry.changed())
+        self._write_config({"MARI": {}})
+        self.assertTrue(registry.changed())
+        registry.load()
+        os.environ["SUPPORTED_INSTRUMENTS"] = "WISH,GEM"
+        self.assertTrue(registry.changed())
+
+
+class TestPlanChanges(TestCase):
+
+    def test_plan_changes(self):
+        """
+        Test that instruments are added and retired, and only overridden locations are moved
+        """
+        changes = plan_changes(ROWS, {"WISH": {"data_dir": "/archive/WISH"}, "MARI": {}, "GEM": None, "LET": None})
+        self.assertEqual(["MARI"], changes.added)
+        self.assertEqual(["GEM"], changes.retired)
+        self.assertEqual([["WISH", "44733", "lastrun_wish.txt", "summary_wish.txt", "/archive/WISH", ".nxs"]],
+                         changes.moved)
+
+    def test_unconfigured_instruments_kept(self):
+        """
+        Test that configuring one instrument's locations doesn't retire the instruments that aren't configured
+        """
+        changes = plan_changes(ROWS, {"WISH": {"data_dir": "/archive/WISH"}})
+        self.assertEqual([], changes.retired)
+        self.assertEqual(["WISH"], [row[0] for row in changes.moved])
+
+    def test_instruments_removed_from_supported_instruments_retired(self):
+        """
+        Test that the instruments configured in neither place are retired when SUPPORTED_INSTRUMENTS lists them all
+        """
+        changes = plan_changes(ROWS, {"WISH": {}, "MARI": {}}, exhaustive=True)
+        self.assertEqual(["MARI"], changes.added)
+        self.assertEqual(["GEM"], changes.retired)
+        self.assertEqual([], changes.moved)
+
+    def test_no_changes(self):
+        self.assertFalse(any(plan_changes(ROWS, {"WISH": {"file_ext": ".nxs"}, "GEM": {}})))
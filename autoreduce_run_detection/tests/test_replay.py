@@ -0,0 +1,76 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the replay of recorded traces
+"""
+import json
+import os
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+from parameterized import parameterized
+
+from autoreduce_run_detection.replay import compare, parse_trace, replay
+
+START = 1664582400.0
+
+# WISH ends two runs, GEM can't be read for a while and then ends two runs
+TRACE = [
+    {"t": START, "i": "WISH", "run": "00044733"},
+    {"t": START + 0.1, "i": "GEM", "run": "00000005"},
+    {"t": START + 20, "i": "GEM", "error": "InstrumentMonitorError: Unexpected last run file format"},
+    {"t": START + 30, "i": "WISH", "run": "00044735"},
+    {"t": START + 30.5, "i": "WISH", "submit": [44734, 44736], "d": 0.05, "ok": True},
+    {"t": START + 40, "i": "GEM", "run": "00000007"},
+    {"t": START + 40.5, "i": "GEM", "submit": [6, 8], "d": 0.07, "ok": True},
+]  # yapf: disable
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.location = os.path.join(self.directory.name, "trace.jsonl")
+        with open(self.location, mode='w', encoding="utf-8") as trace:
+            trace.writelines(json.dumps(entry) + "\n" for entry in TRACE)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_parse_trace(self):
+        """
+        Test that instruments start from before the runs they submitted, and failures set the API error rate
+        """
+        failed = {"t": START + 50, "i": "GEM", "submit": [3, 5], "d": 10.0, "ok": False, "error": "Timeout"}
+        trace = parse_trace(TRACE + [failed])
+        self.assertEqual({"WISH": 44733, "GEM": 2}, trace.first_runs)
+        self.assertEqual([None], [observation.run for observation in trace.observations if observation.run is None])
+        self.assertEqual({("WISH", 44734), ("WISH", 44735), ("GEM", 6), ("GEM", 7)}, set(trace.acknowledged))
+        self.assertEqual([0.05, 0.07], trace.latencies)
+        self.assertEqual(1 / 3, trace.error_rate)
+        with self.assertRaises(ValueError):
+            parse_trace([failed])
+
+    def test_compare(self):
+        trace = parse_trace(TRACE)
+        received = Counter({("WISH", 44734): 2, ("WISH", 44735): 1, ("GEM", 6): 1, ("GEM", 8): 1})
+        self.assertEqual((1, 1, 1), compare(trace, received))
+
+    @parameterized.expand([["once"], ["daemon"]])
+    def test_replay(self, mode):
+        """
+        Test that the runs acknowledged in the trace are submitted once each, with their latency in trace time
+        """
+        report = replay(self.location, speed=1000, interval=15, mode=mode)
+        self.assertEqual(2, report["instruments"])
+        self.assertEqual(4, report["cycles"])
+        self.assertEqual(4, report["runs_submitted"])
+        self.assertEqual((0, 0, 0), (report["runs_missed"], report["runs_duplicated"], report["runs_unexpected"]))
+        # WISH ended its runs 30s in, when a cycle ran, GEM 40s in, 5s before the next one
+        self.assertEqual(0.0, report["run_latency_p50"])
+        self.assertEqual(5.0, report["run_latency_p99"])
@@ -7,18 +7,32 @@
 Unit tests for run_detection
 """
 import csv
+import json
 import os
+import signal
+import tempfile
+import threading
+import time
+from functools import partial
 from pathlib import Path
-from unittest.mock import Mock, mock_open, patch, call
+from unittest.mock import ANY, Mock, mock_open, patch, call
 from unittest import TestCase
+import requests
 from requests.exceptions import RequestException, ConnectionError  # pylint:disable=redefined-builtin
 
 from filelock import FileLock
 from parameterized import parameterized
 
-from autoreduce_run_detection.run_detection import (InstrumentMonitor, InstrumentMonitorError, create_new_csv,
-                                                    update_last_runs, main)
-from autoreduce_run_detection.settings import AUTOREDUCE_API_URL, LOCAL_CACHE_LOCATION
+from autoreduce_run_detection.api import CircuitBreaker
+from autoreduce_run_detection.leases import LeaseManager
+from autoreduce_run_detection.metrics import CYCLE_SECONDS, LAST_RUN_READ_SECONDS, RUNS_SUBMITTED, SUBMIT_RESPONSES
+from autoreduce_run_detection.outbox import Outbox
+from autoreduce_run_detection.run_detection import (InstrumentMonitor, InstrumentMonitorError, MonitorServices,
+                                                    RunDetectionContext, RunDetectionDaemon, create_new_csv,
+                                                    new_csv_rows, submit_queued_runs, update_last_runs, main)
+from autoreduce_run_detection.state import SQLiteStateStore
+from autoreduce_run_detection.settings import (AUTOREDUCE_API_URL, FALLBACK_POLL_INTERVAL, LOCAL_CACHE_LOCATION,
+                                               POLL_INTERVAL)
 
 # pylint:disable=abstract-class-instantiated
 
@@ -89,6 +103,13 @@ class TestRunDetection(TestCase):
             os.remove('test_last_runs.csv')
         if os.path.isfile('lastrun_wish.txt'):
             os.remove('lastrun_wish.txt')
+        for file_name in [
+                'test_last_runs.csv.stat_cache.json', 'test_last_runs.sqlite3', 'test_last_runs.csv.outbox.sqlite3',
+                'test_last_runs.csv.summary_index.json', 'summary_wish.txt', 'test_last_runs.csv.data_index.json',
+                'test_last_runs.csv.ledger.sqlite3', 'test_last_runs.csv.latency.json'
+        ]:
+            if os.path.isfile(file_name):
+                os.remove(file_name)
 
     def test_read_instrument_last_run(self):
         with open('test_lastrun.txt', mode='w', encoding="utf-8") as last_run:
@@ -124,7 +145,71 @@ class TestRunDetection(TestCase):
         self.assertEqual(run_number, '44733')
         inst_mon.submit_runs.assert_has_calls([call(44732, 44734)])
 
-    @patch('autoreduce_run_detection.run_detection.requests.post', return_value=MockResponse())
+    @patch('autoreduce_run_detection.run_detection.SUBMIT_CHUNK_SIZE', 100)
+    def test_submit_run_difference_in_chunks(self):
+        inst_mon = InstrumentMonitor('WISH')
+        inst_mon.submit_runs = Mock(return_value=None)
+        progress = Mock()
+
+        run_number = inst_mon.submit_run_difference(1000, ['WISH', '00001250', '0'], progress)
+        self.assertEqual(run_number, '1250')
+        inst_mon.submit_runs.assert_has_calls([call(1001, 1101), call(1101, 1201), call(1201, 1251)])
+        progress.assert_has_calls([call('1100'), call('1200'), call('1250')])
+
+    @patch('autoreduce_run_detection.run_detection.SUBMIT_CHUNK_SIZE', 100)
+    def test_submit_run_difference_keeps_progress_of_acknowledged_chunks(self):
+        inst_mon = InstrumentMonitor('WISH')
+        inst_mon.submit_runs = Mock(side_effect=[None, InstrumentMonitorError])
+        progress = Mock()
+
+        with self.assertRaises(InstrumentMonitorError):
+            inst_mon.submit_run_difference(1000, ['WISH', '00001250', '0'], progress)
+        progress.assert_called_once_with('1100')
+
+    @patch('autoreduce_run_detection.run_detection.SUBMIT_RANGES', True)
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_submit_runs_as_range(self, requests_post_mock: Mock):
+        InstrumentMonitor('WISH', services=MonitorServices(session=requests.Session())).submit_runs(44734, 44736)
+        self.assertEqual({"start": 44734, "end": 44735, "user_id": 0}, requests_post_mock.call_args[1]["json"])
+
+    @patch('autoreduce_run_detection.api.API_RETRIES', 0)
+    @patch('requests.Session.post', side_effect=ConnectionError)
+    def test_submit_runs_skipped_while_circuit_open(self, requests_post_mock: Mock):
+        """
+        Test that runs aren't submitted once the API is known to be down, and that one alert is raised for it
+        """
+        alerts = Mock()
+        inst_mon = InstrumentMonitor('WISH',
+                                     services=MonitorServices(alerts=alerts,
+                                                              breaker=CircuitBreaker(2),
+                                                              session=requests.Session()))
+        for _ in range(3):
+            with self.assertRaises(InstrumentMonitorError):
+                inst_mon.submit_runs(44734, 44736)
+        self.assertEqual(2, requests_post_mock.call_count)
+        self.assertEqual(["ConnectionError", "circuit_open", "ConnectionError"],
+                         [alert[0][1] for alert in alerts.alert.call_args_list])
+
+    @patch('autoreduce_run_detection.run_detection.SUBMIT_CHUNK_SIZE', 1)
+    @patch('requests.Session.post')
+    def test_update_last_runs_partial_submission(self, requests_post_mock: Mock):
+        """
+        Test that the last run advances to the last acknowledged chunk when a later chunk fails
+        """
+        failed = MockResponse()
+        failed.status_code = 400
+        requests_post_mock.side_effect = [MockResponse(), failed]
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+
+        update_last_runs('test_last_runs.csv')
+        self.assertEqual([[44734], [44735]], [c[1]["json"]["runs"] for c in requests_post_mock.call_args_list])
+        with open('test_last_runs.csv', encoding="utf-8") as csv_file:
+            self.assertEqual('44734', next(csv.reader(csv_file))[1])
+
+    @patch('requests.Session.post', return_value=MockResponse())
     def test_update_last_runs(self, requests_post_mock: Mock):
         """
         Test submission with a 200 OK response, everything working OK
@@ -154,7 +239,249 @@ class TestRunDetection(TestCase):
                 if row:  # Avoid the empty rows
                     self.assertEqual('44735', row[1])
 
-    @patch('autoreduce_run_detection.run_detection.requests.post')
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_not_resubmitted_after_lost_state(self, requests_post_mock: Mock):
+        """
+        Test that runs acknowledged before the last runs were lost are not submitted again
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+        update_last_runs('test_last_runs.csv')
+        self.assertEqual("WISH-44734-44735", requests_post_mock.call_args[1]["headers"]["Idempotency-Key"])
+
+        # As if the process had stopped before the CSV file was written, with one more run since
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write("WISH 44736 0")
+        update_last_runs('test_last_runs.csv')
+        self.assertEqual([[44734, 44735], [44736]], [c[1]["json"]["runs"] for c in requests_post_mock.call_args_list])
+        with open('test_last_runs.csv', encoding="utf-8") as csv_file:
+            self.assertEqual('44736', next(csv.reader(csv_file))[1])
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_reconciles_instruments(self, requests_post_mock: Mock):
+        """
+        Test that configured instruments are added and the ones configured to be retired are retired, without
+        touching the rows kept
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write("GEM,100,lastrun_gem.txt,summary_gem.txt,data_dir,.nxs\n" + CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write("WISH 44733 0")
+        with tempfile.TemporaryDirectory() as directory:
+            lastrun_mari = os.path.join(directory, "lastrun_mari.txt")
+            with open(lastrun_mari, mode='w', encoding="utf-8") as lastrun_file:
+                lastrun_file.write("MARI 12 0")
+            config_file = os.path.join(directory, "instruments.json")
+            with open(config_file, mode='w', encoding="utf-8") as config:
+                json.dump({"MARI": {"last_run_file": lastrun_mari, "data_dir": directory}, "GEM": None}, config)
+
+            with patch('autoreduce_run_detection.run_detection.INSTRUMENT_CONFIG', config_file):
+                update_last_runs('test_last_runs.csv')
+
+            with open('test_last_runs.csv', encoding="utf-8") as csv_file:
+                rows = [row for row in csv.reader(csv_file) if row]
+            self.assertEqual([
+                CSV_FILE.split(","),
+                ["MARI", "12", lastrun_mari, "/isis/NDXMARI/Instrument/logs/journal/summary.txt", directory, ".nxs"]
+            ], rows)
+        requests_post_mock.assert_not_called()
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_profile(self, _: Mock):
+        """
+        Test that the phases and code of a profiled invocation are kept and summarised
+        """
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+        with tempfile.TemporaryDirectory() as directory:
+            csv_name = os.path.join(directory, "last_runs.csv")
+            with open(csv_name, mode='w', encoding="utf-8") as last_runs:
+                last_runs.write(CSV_FILE)
+            update_last_runs(csv_name, profile=True, lock_wait=0.5)
+            with patch('autoreduce_run_detection.run_detection.LOCAL_CACHE_LOCATION', csv_name), \
+                    patch('builtins.print') as print_mock:
+                main(["profiles"])
+
+        report = print_mock.call_args[0][0].splitlines()
+        self.assertEqual(["Started", "Scope", "Total", "Lock", "Open", "Load", "Read", "Submit", "Save", "Profile"],
+                         report[1].split())
+        self.assertEqual("once", report[2].split()[2])
+        self.assertTrue(report[2].endswith(".prof"))
+        self.assertEqual("WISH", report[-1].split()[0])
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_records_latency(self, _: Mock):
+        """
+        Test that the time from lastrun.txt being written to the runs being acknowledged is recorded and reported
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+        written = time.time() - 60
+        os.utime('lastrun_wish.txt', (written, written))
+
+        update_last_runs('test_last_runs.csv')
+        with patch('autoreduce_run_detection.run_detection.LOCAL_CACHE_LOCATION', 'test_last_runs.csv'), \
+                patch('builtins.print') as print_mock:
+            main(["latency"])
+        report = print_mock.call_args[0][0].splitlines()
+        self.assertEqual(2, len(report))
+        instrument, runs, detection, submission, total = report[1].split()
+        self.assertEqual(("WISH", "2"), (instrument, runs))
+        self.assertAlmostEqual(60, float(detection.split("/")[0]), delta=5)
+        self.assertLess(float(submission.split("/")[2]), 5)
+        self.assertAlmostEqual(60, float(total.split("/")[1]), delta=5)
+
+    @patch('autoreduce_run_detection.state.STATE_BACKEND', "sqlite")
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_sqlite_state(self, _: Mock):
+        """
+        Test that the SQLite store imports the CSV and records the new last run
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+
+        update_last_runs('test_last_runs.csv')
+        store = SQLiteStateStore('test_last_runs.sqlite3')
+        self.assertEqual('44735', store.load()[0][1])
+        store.close()
+
+    @patch('autoreduce_run_detection.run_detection.OUTBOX', True)
+    @patch('autoreduce_run_detection.outbox.OUTBOX_BACKOFF', 0)
+    @patch('requests.Session.post')
+    def test_update_last_runs_outbox(self, requests_post_mock: Mock):
+        """
+        Test that with the outbox the last run advances before submission and failed runs stay queued
+        """
+        failed = MockResponse()
+        failed.status_code = 503
+        requests_post_mock.return_value = failed
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+
+        with patch('autoreduce_run_detection.api.API_RETRIES', 0):
+            update_last_runs('test_last_runs.csv')
+        with open('test_last_runs.csv', encoding="utf-8") as csv_file:
+            self.assertEqual('44735', next(csv.reader(csv_file))[1])
+        outbox = Outbox('test_last_runs.csv.outbox.sqlite3')
+        self.assertEqual((1, 2), outbox.depth())
+
+        # Retried from the outbox once due, without re-detecting the runs
+        requests_post_mock.return_value = MockResponse()
+        outbox.drain(partial(submit_queued_runs, {}, MonitorServices(session=requests.Session())))
+        self.assertEqual((0, 0), outbox.depth())
+        self.assertEqual([44734, 44735], requests_post_mock.call_args[1]["json"]["runs"])
+        outbox.close()
+
+    @patch('autoreduce_run_detection.run_detection.SUMMARY_METADATA', True)
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_with_summary_metadata(self, requests_post_mock: Mock):
+        """
+        Test that the RB number and title from summary.txt are submitted with the runs
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+        with open('summary_wish.txt', mode='w', encoding="utf-8") as summary_wish:
+            summary_wish.write(SUMMARY_FILE.replace("WIS44733", "WIS44734"))
+
+        update_last_runs('test_last_runs.csv')
+        self.assertEqual({"44734": {
+            "rb_number": "1820461",
+            "title": "CeAuSb2 MRSX ROT=15.05 s"
+        }}, requests_post_mock.call_args[1]["json"]["metadata"])
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_without_summary_metadata(self, requests_post_mock: Mock):
+        """
+        Test that summary.txt is not read unless SUMMARY_METADATA is set
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+        with open('summary_wish.txt', mode='w', encoding="utf-8") as summary_wish:
+            summary_wish.write(SUMMARY_FILE.replace("WIS44733", "WIS44734"))
+
+        update_last_runs('test_last_runs.csv')
+        self.assertNotIn("metadata", requests_post_mock.call_args[1]["json"])
+        self.assertFalse(os.path.exists('test_last_runs.csv.summary_index.json'))
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_records_metrics(self, _: Mock):
+        """
+        Test that reads, submissions and the cycle are recorded in the metrics
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+        reads = LAST_RUN_READ_SECONDS.count(instrument="WISH")
+        submitted = RUNS_SUBMITTED.value(instrument="WISH")
+        responses = SUBMIT_RESPONSES.value(instrument="WISH", code="200")
+        cycles = CYCLE_SECONDS.count(scope="all")
+
+        update_last_runs('test_last_runs.csv')
+        self.assertEqual(reads + 1, LAST_RUN_READ_SECONDS.count(instrument="WISH"))
+        self.assertEqual(submitted + 2, RUNS_SUBMITTED.value(instrument="WISH"))
+        self.assertEqual(responses + 1, SUBMIT_RESPONSES.value(instrument="WISH", code="200"))
+        self.assertEqual(cycles + 1, CYCLE_SECONDS.count(scope="all"))
+
+    @patch('autoreduce_run_detection.run_detection.WAIT_FOR_DATA_FILES', True)
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_waits_for_data_files(self, requests_post_mock: Mock):
+        """
+        Test that runs whose data file hasn't landed are held back and submitted once it has
+        """
+        with tempfile.TemporaryDirectory() as data_dir:
+            cycle_dir = os.path.join(data_dir, "cycle_18_4")
+            os.mkdir(cycle_dir)
+            Path(cycle_dir, "WISH00044734.nxs").touch()
+            with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+                last_runs.write(CSV_FILE.replace("data_dir", data_dir))
+            with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+                lastrun_wish.write(LASTRUN_WISH_TXT)
+
+            update_last_runs('test_last_runs.csv')
+            self.assertEqual([44734], requests_post_mock.call_args[1]["json"]["runs"])
+            with open('test_last_runs.csv', encoding="utf-8") as csv_file:
+                self.assertEqual('44734', next(csv.reader(csv_file))[1])
+
+            Path(cycle_dir, "WISH00044735.nxs").touch()
+            # Make sure the cycle directory is seen as modified on filesystems with coarse timestamps
+            os.utime(cycle_dir, ns=(0, os.stat(cycle_dir).st_mtime_ns + 1))
+            update_last_runs('test_last_runs.csv')
+            self.assertEqual([44735], requests_post_mock.call_args[1]["json"]["runs"])
+            with open('test_last_runs.csv', encoding="utf-8") as csv_file:
+                self.assertEqual('44735', next(csv.reader(csv_file))[1])
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_skips_unchanged_last_run_file(self, requests_post_mock: Mock):
+        """
+        Test that an unchanged lastrun.txt is not read again on the next invocation
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+
+        update_last_runs('test_last_runs.csv')
+        with patch.object(InstrumentMonitor, '_read_last_run_file') as read_mock:
+            update_last_runs('test_last_runs.csv')
+        read_mock.assert_not_called()
+        requests_post_mock.assert_called_once()
+
+    @patch('requests.Session.post')
     def test_update_last_runs_not_200_status(self, requests_post_mock: Mock):
         """
         Test when the response is not 200 OK that the error is handled
@@ -191,7 +518,8 @@ class TestRunDetection(TestCase):
         [ConnectionError],
         [RequestException],
     ])
-    @patch('autoreduce_run_detection.run_detection.requests.post')
+    @patch('autoreduce_run_detection.api.API_RETRIES', 0)
+    @patch('requests.Session.post')
     @patch('autoreduce_run_detection.run_detection.LOGGING')
     def test_update_last_runs_with_error(self, exception_class, logger_mock: Mock, requests_post_mock: Mock):
         """
@@ -224,10 +552,13 @@ class TestRunDetection(TestCase):
         [ConnectionError],
         [RequestException],
     ])
-    @patch('autoreduce_run_detection.run_detection.requests.post')
+    @patch('autoreduce_run_detection.api.API_RETRIES', 0)
+    @patch('requests.Session.post')
     @patch('autoreduce_run_detection.run_detection.LOGGING')
+    @patch('autoreduce_run_detection.alerts.LOGGING')
     @patch('autoreduce_run_detection.run_detection.TEAMS_URL', return_value="http://fake_url")
-    def test_update_last_runs_with_error_and_teams_url_also_fails(self, exception_class, _: Mock, logger_mock: Mock,
+    def test_update_last_runs_with_error_and_teams_url_also_fails(self, exception_class, _: Mock,
+                                                                  alerts_logger_mock: Mock, logger_mock: Mock,
                                                                   requests_post_mock: Mock):
         """
         Test trying to update last runs but both the request to the
@@ -254,11 +585,13 @@ class TestRunDetection(TestCase):
                     self.assertEqual('44733', row[1])
 
         assert logger_mock.info.call_count == 2
-        assert logger_mock.error.call_count == 3
+        assert logger_mock.error.call_count == 2
+        # Teams is sent the alert in the background, outside of the submission
+        alerts_logger_mock.error.assert_called_once()
 
     @patch(
-        'autoreduce_run_detection.run_detection.requests.post',
-        side_effect=[RequestException, None]  # this means the second call will NOT raise an exception
+        'requests.Session.post',
+        side_effect=[RequestException, MockResponse()]  # this means the second call will NOT raise an exception
     )
     @patch('autoreduce_run_detection.run_detection.LOGGING')
     @patch('autoreduce_run_detection.run_detection.TEAMS_URL', return_value="http://fake_url")
@@ -293,6 +626,53 @@ class TestRunDetection(TestCase):
         assert requests_post_mock.call_count == 2
         assert teams_url in requests_post_mock.call_args[0]
 
+    @patch('autoreduce_run_detection.run_detection.READ_TIMEOUT', 0.2)
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_update_last_runs_hung_instrument(self, requests_post_mock: Mock):
+        """
+        Test that an instrument whose lastrun.txt read hangs does not hold back the other instruments
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write("GEM,100,lastrun_gem.txt,summary_gem.txt,data_dir,.nxs\n" + CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+
+        release = threading.Event()
+        read_instrument_last_run = InstrumentMonitor.read_instrument_last_run
+
+        def hang_on_gem(inst_mon):
+            if inst_mon.instrument_name == "GEM":
+                release.wait(5)
+                return ['GEM', '101', '0']
+            return read_instrument_last_run(inst_mon)
+
+        start = time.monotonic()
+        with patch.object(InstrumentMonitor, 'read_instrument_last_run', autospec=True, side_effect=hang_on_gem):
+            update_last_runs('test_last_runs.csv')
+        release.set()
+        self.assertLess(time.monotonic() - start, 2)
+
+        requests_post_mock.assert_called_once()
+        assert requests_post_mock.call_args[0][0] == f"{AUTOREDUCE_API_URL}/runs/WISH"
+        with open('test_last_runs.csv', encoding="utf-8") as csv_file:
+            rows = [row for row in csv.reader(csv_file) if row]
+        self.assertEqual([['GEM', '100'], ['WISH', '44735']], [row[:2] for row in rows])
+
+    @patch('autoreduce_run_detection.run_detection.new_csv_data')
+    def test_new_csv_rows_skips_unreadable_instrument(self, new_csv_data_mock: Mock):
+        """
+        Test that bootstrapping leaves out instruments whose lastrun.txt can't be read and keeps the order
+        """
+
+        def new_row(instrument):
+            if instrument == "GEM":
+                raise FileNotFoundError("lastrun.txt")
+            return [instrument, '1', '', '', '', '.nxs']
+
+        new_csv_data_mock.side_effect = new_row
+        rows = new_csv_rows(["WISH", "GEM", "MARI"])
+        self.assertEqual(["WISH", "MARI"], [row[0] for row in rows])
+
     @staticmethod
     @patch.dict(os.environ, {"SUPPORTED_INSTRUMENTS": "WISH"})
     @patch('autoreduce_run_detection.run_detection.InstrumentMonitor.read_instrument_last_run')
@@ -316,14 +696,301 @@ class TestRunDetection(TestCase):
         """
         with patch.object(Path, 'is_file') as mock_exists:
             mock_exists.return_value = True
-            main()
-            update_last_runs_mock.assert_called_with(LOCAL_CACHE_LOCATION)
+            main(["--once"])
+            update_last_runs_mock.assert_called_with(LOCAL_CACHE_LOCATION, profile=False, lock_wait=ANY)
             update_last_runs_mock.assert_called_once()
 
+    @patch('autoreduce_run_detection.run_detection.update_last_runs')
+    def test_main_writes_metrics_textfile(self, _: Mock):
+        """
+        Test that a one-shot run writes the metrics for the node-exporter textfile collector
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, "run_detection.prom")
+            with patch('autoreduce_run_detection.run_detection.METRICS_TEXTFILE', location), \
+                    patch.object(Path, 'is_file', return_value=True):
+                main(["--once"])
+            with open(location, encoding="utf-8") as textfile:
+                self.assertIn("run_detection_lock_wait_seconds_count", textfile.read())
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_main_backfill_cycle(self, requests_post_mock: Mock):
+        """
+        Test backfilling the runs of a cycle directory without touching the last runs or the lock
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            csv_name = os.path.join(directory, "last_runs.csv")
+            os.makedirs(os.path.join(directory, "data", "cycle_19_1"))
+            for name in ["WISH00044731.nxs", "WISH00044732.nxs", "WISH00044735.nxs", "WISH00044735.log"]:
+                Path(directory, "data", "cycle_19_1", name).touch()
+            with open(csv_name, mode='w', encoding="utf-8") as last_runs:
+                last_runs.write(f"WISH,44740,lastrun_wish.txt,summary_wish.txt,{directory}/data,.nxs\n")
+
+            with patch('autoreduce_run_detection.run_detection.LOCAL_CACHE_LOCATION', csv_name), \
+                    FileLock(f'{csv_name}.lock'):
+                main(["backfill", "WISH", "--cycle", "cycle_19_1", "--rate", "0"])
+            self.assertEqual([[44731, 44732], [44735]],
+                             sorted(c[1]["json"]["runs"] for c in requests_post_mock.call_args_list))
+            with open(csv_name, encoding="utf-8") as csv_file:
+                self.assertEqual('44740', next(csv.reader(csv_file))[1])
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_main_backfill_unknown_cycle_instrument(self, requests_post_mock: Mock):
+        with tempfile.TemporaryDirectory() as directory:
+            with patch('autoreduce_run_detection.run_detection.LOCAL_CACHE_LOCATION',
+                       os.path.join(directory, "last_runs.csv")):
+                with self.assertRaises(SystemExit):
+                    main(["backfill", "WISH", "--cycle", "cycle_19_1"])
+        requests_post_mock.assert_not_called()
+
     @staticmethod
     @patch('autoreduce_run_detection.run_detection.update_last_runs')
     def test_main_lock_timeout(_):
         with patch.object(Path, 'is_file') as mock_exists:
             mock_exists.return_value = True
             with FileLock(f'{LOCAL_CACHE_LOCATION}.lock'):
-                main()
+                main(["--once"])
+
+
+class TestRunDetectionDaemon(TestCase):
+
+    def tearDown(self):
+        for file_name in [
+                'test_last_runs.csv', 'lastrun_wish.txt', 'test_last_runs.csv.stat_cache.json',
+                'test_last_runs.csv.summary_index.json', 'test_last_runs.csv.schedule.json',
+                'test_last_runs.csv.ledger.sqlite3', 'test_last_runs.csv.latency.json'
+        ]:
+            if os.path.isfile(file_name):
+                os.remove(file_name)
+
+    @patch('autoreduce_run_detection.run_detection.create_session')
+    def test_run_cycle_keeps_state_in_memory(self, session_mock: Mock):
+        """
+        Test that the CSV is read once, monitors and session are reused and the CSV is only written on change
+        """
+        session_mock.return_value.post.return_value = MockResponse()
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+
+        daemon = RunDetectionDaemon('test_last_runs.csv', interval=0)
+        with patch('autoreduce_run_detection.state.write_last_runs') as write_mock:
+            daemon.run_cycle()
+            monitor = daemon.context.monitors['WISH']
+            daemon.run_cycle()
+
+        self.assertIs(monitor, daemon.context.monitors['WISH'])
+        self.assertIs(daemon.context.session, monitor.session)
+        self.assertIs(session_mock.return_value, monitor.session.session)
+        session_mock.return_value.post.assert_called_once()
+        write_mock.assert_called_once_with('test_last_runs.csv', daemon.rows)
+        self.assertEqual('44735', daemon.rows[0][1])
+
+    @patch('requests.Session.post', return_value=MockResponse())
+    def test_run_cycle_reconciles_changed_config(self, _: Mock):
+        """
+        Test that the daemon picks up instruments moved in the configuration file once it changes
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write("WISH 44733 0")
+        with tempfile.TemporaryDirectory() as directory:
+            config_file = os.path.join(directory, "instruments.json")
+            with open(config_file, mode='w', encoding="utf-8") as config:
+                json.dump({"WISH": {}}, config)
+            with patch('autoreduce_run_detection.run_detection.INSTRUMENT_CONFIG', config_file):
+                daemon = RunDetectionDaemon('test_last_runs.csv', interval=0)
+            try:
+                daemon.run_cycle()
+                monitor = daemon.context.monitors['WISH']
+                daemon.run_cycle()
+                self.assertIs(monitor, daemon.context.monitors['WISH'])
+
+                with open(config_file, mode='w', encoding="utf-8") as config:
+                    json.dump({"WISH": {"data_dir": directory}}, config)
+                daemon.run_cycle()
+            finally:
+                daemon.context.close()
+
+        self.assertEqual(directory, daemon.rows[0][4])
+        self.assertEqual(directory, daemon.context.monitors['WISH'].data_dir)
+        self.assertEqual('44733', daemon.rows[0][1])
+
+    @patch('autoreduce_run_detection.run_detection.SUBMIT_TIMEOUT', 0.1)
+    def test_run_cycle_waits_for_hung_submission(self):
+        """
+        Test that runs whose submission missed its deadline are not submitted again while it is still in flight,
+        and that it doesn't leave a thread behind on every cycle
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        with open('lastrun_wish.txt', mode='w', encoding="utf-8") as lastrun_wish:
+            lastrun_wish.write(LASTRUN_WISH_TXT)
+        release = threading.Event()
+
+        def hang(*_args, **_kwargs):
+            release.wait(5)
+            return MockResponse()
+
+        daemon = RunDetectionDaemon('test_last_runs.csv', interval=0)
+        try:
+            with patch('requests.Session.post', side_effect=hang) as post_mock:
+                daemon.run_cycle()
+                threads = threading.active_count()
+                for _ in range(10):
+                    daemon.run_cycle()
+                self.assertLessEqual(threading.active_count(), threads)
+                release.set()
+                for _ in range(100):
+                    if not daemon.context.workers.busy('WISH'):
+                        break
+                    time.sleep(0.01)
+                daemon.run_cycle()
+        finally:
+            release.set()
+            daemon.context.close()
+        post_mock.assert_called_once()
+        self.assertEqual('44735', daemon.rows[0][1])
+
+    def test_run_stops_and_survives_failed_cycles(self):
+        """
+        Test that a failing cycle does not end the loop and that stop() ends it cleanly
+        """
+        daemon = RunDetectionDaemon('test_last_runs.csv', interval=0)
+        cycles = []
+
+        def cycle(_instruments=None):
+            cycles.append(1)
+            if len(cycles) == 1:
+                raise OSError("archive unavailable")
+            daemon.stop()
+
+        with patch.object(daemon, 'run_cycle', side_effect=cycle):
+            daemon.run()
+        self.assertEqual(2, len(cycles))
+
+    @staticmethod
+    @patch('autoreduce_run_detection.run_detection.signal.signal')
+    @patch('autoreduce_run_detection.run_detection.RunDetectionDaemon')
+    def test_main_daemon(daemon_mock, signal_mock):
+        """
+        Test that main runs the daemon by default and stops it on SIGTERM
+        """
+        with patch.object(Path, 'is_file', return_value=True):
+            main(["--interval", "5", "--profile"])
+        daemon_mock.assert_called_once_with(LOCAL_CACHE_LOCATION, 5.0, None, None, True)
+        daemon_mock.return_value.run.assert_called_once()
+        signal_mock.assert_any_call(signal.SIGTERM, daemon_mock.return_value.stop)
+
+    @staticmethod
+    @patch('autoreduce_run_detection.run_detection.signal.signal')
+    @patch('autoreduce_run_detection.run_detection.LastRunWatcher')
+    @patch('autoreduce_run_detection.run_detection.RunDetectionDaemon')
+    def test_main_daemon_watch(daemon_mock, watcher_mock, _):
+        """
+        Test that --watch gives the daemon a watcher and the fallback poll interval
+        """
+        with patch.object(Path, 'is_file', return_value=True):
+            main(["--watch"])
+        daemon_mock.assert_called_once_with(LOCAL_CACHE_LOCATION, FALLBACK_POLL_INTERVAL, watcher_mock.return_value,
+                                            None, False)
+
+    @patch('autoreduce_run_detection.run_detection.poll_instruments')
+    def test_run_cycle_only_polls_changed_instruments(self, poll_instruments_mock: Mock):
+        """
+        Test that a cycle triggered by the watcher only polls the instruments that changed
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write("GEM,100,lastrun_gem.txt,summary_gem.txt,data_dir,.nxs\n" + CSV_FILE)
+        watcher = Mock()
+        daemon = RunDetectionDaemon('test_last_runs.csv', interval=0, watcher=watcher)
+        daemon.run_cycle()
+        self.assertEqual(2, watcher.watch.call_count)
+        daemon.run_cycle({"WISH"})
+
+        self.assertEqual(['GEM', 'WISH'], [row[0] for row in poll_instruments_mock.call_args_list[0][0][0]])
+        self.assertEqual(['WISH'], [row[0] for row in poll_instruments_mock.call_args_list[1][0][0]])
+        self.assertEqual(2, watcher.watch.call_count)
+
+    @patch('autoreduce_run_detection.run_detection.ADAPTIVE_POLLING', True)
+    @patch('autoreduce_run_detection.run_detection.poll_instruments')
+    def test_run_cycle_only_polls_due_instruments(self, poll_instruments_mock: Mock):
+        """
+        Test that with an adaptive schedule full polls skip instruments that aren't due, but changes don't
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write("GEM,100,lastrun_gem.txt,summary_gem.txt,data_dir,.nxs\n" + CSV_FILE)
+        daemon = RunDetectionDaemon('test_last_runs.csv', interval=0)
+        daemon.run_cycle()
+        daemon.run_cycle()
+        daemon.run_cycle({"WISH"})
+
+        self.assertEqual(['GEM', 'WISH'], [row[0] for row in poll_instruments_mock.call_args_list[0][0][0]])
+        self.assertEqual([], poll_instruments_mock.call_args_list[1][0][0])
+        self.assertEqual(['WISH'], [row[0] for row in poll_instruments_mock.call_args_list[2][0][0]])
+        self.assertTrue(os.path.isfile('test_last_runs.csv.schedule.json'))
+        self.assertGreater(daemon.context.next_due(daemon.rows, time.monotonic() + 3600), time.monotonic())
+
+    @patch('autoreduce_run_detection.run_detection.ADAPTIVE_POLLING', True)
+    @patch('autoreduce_run_detection.schedule.POLL_INTERVAL_MIN', 10)
+    @patch('autoreduce_run_detection.run_detection.poll_instruments')
+    def test_schedule_sees_runs_not_submitted(self, poll_instruments_mock: Mock):
+        """
+        Test that the schedule goes by the last run read from the archive, so runs that weren't submitted still
+        count as a change
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write(CSV_FILE)
+        context = RunDetectionContext('test_last_runs.csv')
+        rows = context.store.load()
+        try:
+            for archive_run in ["44733", "44733", "44735"]:
+                poll_instruments_mock.side_effect = lambda rows, *_, observed, run=archive_run, **__: observed.update(
+                    {row[0]: run
+                     for row in rows})
+                context.poll(rows)
+            self.assertEqual("44733", rows[0][1])
+            # Polled again after POLL_INTERVAL_MIN rather than the 40s it had backed off to
+            self.assertLessEqual(context.schedule.next_due(rows), time.time() + 10)
+        finally:
+            context.close()
+
+    @patch('autoreduce_run_detection.run_detection.poll_instruments')
+    def test_run_cycle_only_polls_leased_instruments(self, poll_instruments_mock: Mock):
+        """
+        Test that a replica only polls the instruments it holds the lease on, reloading the rows it takes over
+        """
+        with open('test_last_runs.csv', mode='w', encoding="utf-8") as last_runs:
+            last_runs.write("GEM,100,lastrun_gem.txt,summary_gem.txt,data_dir,.nxs\n" + CSV_FILE)
+        leases = Mock(spec=LeaseManager, replica="first", ttl=60, owned={"WISH"})
+        leases.claim.return_value = {"WISH"}
+        daemon = RunDetectionDaemon('test_last_runs.csv', interval=0, leases=leases)
+        with patch.object(daemon.context.store, 'load', wraps=daemon.context.store.load) as load_mock:
+            daemon.run_cycle()
+            self.assertEqual(1, load_mock.call_count)
+            leases.owned = set()
+            leases.claim.return_value = {"WISH"}
+            daemon._next_claim = 0  # pylint:disable=protected-access
+            daemon.run_cycle()
+            self.assertEqual(2, load_mock.call_count)
+
+        self.assertEqual(['WISH'], [row[0] for row in poll_instruments_mock.call_args_list[0][0][0]])
+        self.assertEqual("test_last_runs.csv.first", daemon.context.cache_name)
+
+    @staticmethod
+    @patch('autoreduce_run_detection.run_detection.SHARDING', "hash")
+    @patch('autoreduce_run_detection.run_detection.signal.signal')
+    @patch('autoreduce_run_detection.run_detection.FileLock')
+    @patch('autoreduce_run_detection.run_detection.LeaseManager')
+    @patch('autoreduce_run_detection.run_detection.RunDetectionDaemon')
+    def test_main_sharded(daemon_mock, leases_mock, lock_mock, _):
+        """
+        Test that sharded replicas run with leases rather than the lock on the last runs CSV file
+        """
+        with patch.object(Path, 'is_file', return_value=True):
+            main([])
+        lock_mock.assert_not_called()
+        leases_mock.assert_called_once_with(f"{LOCAL_CACHE_LOCATION}.leases", ANY, "hash")
+        daemon_mock.assert_called_once_with(LOCAL_CACHE_LOCATION, POLL_INTERVAL, None, leases_mock.return_value, False)
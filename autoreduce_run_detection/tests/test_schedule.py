@@ -0,0 +1,99 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the adaptive polling schedule
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from autoreduce_run_detection.schedule import InstrumentSchedule, PollSchedule
+
+ROWS = [["WISH", "100", "lastrun_wish.txt", "summary_wish.txt", "data_dir", ".nxs"],
+        ["GEM", "200", "lastrun_gem.txt", "summary_gem.txt", "data_dir", ".nxs"]]
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+@patch("autoreduce_run_detection.schedule.POLL_INTERVAL_MIN", 10)
+@patch("autoreduce_run_detection.schedule.POLL_INTERVAL_MAX", 600)
+@patch("autoreduce_run_detection.schedule.POLL_CADENCE_FRACTION", 0.1)
+@patch("autoreduce_run_detection.schedule.POLL_IDLE_FACTOR", 3)
+class TestInstrumentSchedule(TestCase):
+
+    def test_unchanged_instrument_backs_off_to_max(self):
+        schedule = InstrumentSchedule()
+        schedule.observe("100", 0)
+        self.assertEqual(10, schedule.interval)
+        intervals = []
+        for now in range(1, 9):
+            schedule.observe("100", now)
+            intervals.append(schedule.interval)
+        self.assertEqual([20, 40, 80, 160, 320, 600, 600, 600], intervals)
+        self.assertEqual(608, schedule.next_poll)
+
+    def test_change_resets_interval_and_learns_cadence(self):
+        schedule = InstrumentSchedule(last_run="100", changed_at=0, interval=600)
+        self.assertTrue(schedule.observe("102", 1200))
+        self.assertEqual(10, schedule.interval)
+        self.assertEqual(600, schedule.cadence)
+        self.assertEqual(1210, schedule.next_poll)
+
+    def test_active_instrument_backs_off_to_fraction_of_cadence(self):
+        schedule = InstrumentSchedule(last_run="100", changed_at=0, cadence=600)
+        for now in range(10, 100, 10):
+            schedule.observe("100", now)
+        self.assertEqual(60, schedule.interval)
+
+        # Idle for longer than POLL_IDLE_FACTOR runs
+        for now in range(1900, 2000, 10):
+            schedule.observe("100", now)
+        self.assertEqual(600, schedule.interval)
+
+    def test_unreadable_last_run_backs_off(self):
+        schedule = InstrumentSchedule(last_run="100", changed_at=0, interval=10)
+        self.assertFalse(schedule.observe(None, 10))
+        self.assertEqual(20, schedule.interval)
+        self.assertEqual("100", schedule.last_run)
+
+    def test_long_gap_capped_in_cadence(self):
+        schedule = InstrumentSchedule(last_run="100", changed_at=0)
+        schedule.observe("101", 10_000_000)
+        self.assertEqual(6000, schedule.cadence)
+
+
+@patch("autoreduce_run_detection.schedule.POLL_INTERVAL_MIN", 10)
+class TestPollSchedule(TestCase):
+
+    def test_only_due_instruments_polled(self):
+        schedule = PollSchedule({"WISH": InstrumentSchedule("100", next_poll=50)})
+        self.assertEqual(["GEM"], [row[0] for row in schedule.due(ROWS, now=10)])
+        self.assertEqual(["WISH", "GEM"], [row[0] for row in schedule.due(ROWS, now=50)])
+        self.assertEqual(0, schedule.next_due(ROWS))
+
+        schedule.observe(ROWS[1:], now=10)
+        self.assertEqual(20, schedule.next_due(ROWS))
+
+    def test_persisted_between_invocations(self):
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, "schedule.json")
+            PollSchedule().save(location)
+            self.assertFalse(os.path.exists(location))
+
+            schedule = PollSchedule()
+            schedule.observe(ROWS, now=10)
+            schedule.save(location)
+            loaded = PollSchedule.load(location)
+            self.assertEqual([], loaded.due(ROWS, now=11))
+            self.assertEqual(schedule.next_due(ROWS), loaded.next_due(ROWS))
+
+    def test_load_missing_or_corrupt(self):
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, "schedule.json")
+            self.assertEqual(ROWS, PollSchedule.load(location).due(ROWS))
+            with open(location, mode='w', encoding="utf-8") as schedule_file:
+                schedule_file.write('{"WISH": {"unknown": 1}}')
+            self.assertEqual(ROWS, PollSchedule.load(location).due(ROWS))
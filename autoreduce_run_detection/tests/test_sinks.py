@@ -0,0 +1,240 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the submission sinks, run against a local stub STOMP broker
+"""
+import json
+import os
+import socketserver
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, NamedTuple
+from unittest import TestCase
+from unittest.mock import Mock
+
+from autoreduce_run_detection.broker import StompClient
+from autoreduce_run_detection.ledger import SubmissionLedger
+from autoreduce_run_detection.sinks import (APISink, FanOutSink, SinkUnavailable, StompSink, SubmissionError,
+                                            create_sink)
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class Frame(NamedTuple):
+    """
+    A STOMP frame, without the header escapes the stub broker doesn't need
+    """
+    command: str
+    headers: Dict[str, str]
+    body: bytes = b""
+
+
+def encode_frame(frame: Frame) -> bytes:
+    lines = [frame.command] + [f"{name}:{value}" for name, value in frame.headers.items()]
+    return ("\n".join(lines) + "\n\n").encode() + frame.body + b"\0"
+
+
+class FrameReader:
+    """
+    Reads frames from the client's socket, skipping heart-beats in between
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = b""
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("Connection closed by the client")
+        self._buffer += data
+
+    def _read_until(self, delimiter: bytes) -> bytes:
+        while delimiter not in self._buffer:
+            self._fill()
+        data, self._buffer = self._buffer.split(delimiter, 1)
+        return data
+
+    def read(self) -> Frame:
+        while True:
+            self._buffer = self._buffer.lstrip(b"\r\n")
+            if self._buffer:
+                break
+            self._fill()
+        command, *lines = self._read_until(b"\n\n").decode().replace("\r\n", "\n").split("\n")
+        headers: Dict[str, str] = {}
+        for line in lines:
+            name, _, value = line.partition(":")
+            headers.setdefault(name, value)
+        if "content-length" not in headers:
+            return Frame(command, headers, self._read_until(b"\0"))
+        length = int(headers["content-length"])
+        while len(self._buffer) <= length:
+            self._fill()
+        body, self._buffer = self._buffer[:length], self._buffer[length + 1:]
+        return Frame(command, headers, body)
+
+
+class StubBrokerHandler(socketserver.BaseRequestHandler):
+    """
+    Speaks just enough STOMP to take messages in transactions, delivering them on commit
+    """
+
+    def handle(self):
+        reader = FrameReader(self.request)
+        transactions = {}
+        while True:
+            try:
+                frame = reader.read()
+            except ConnectionError:
+                return
+            if frame.command in ("CONNECT", "STOMP"):
+                self.request.sendall(encode_frame(Frame("CONNECTED", {"version": "1.2"})))
+            elif frame.command == "BEGIN":
+                transactions[frame.headers["transaction"]] = []
+            elif frame.command == "SEND":
+                transactions[frame.headers["transaction"]].append(frame)
+            elif frame.command == "COMMIT":
+                messages = transactions.pop(frame.headers["transaction"])
+                if self.server.refuse_commits:
+                    self.request.sendall(encode_frame(Frame("ERROR", {"message": "queue full"})))
+                    return
+                self.server.delivered.extend(messages)
+                self.server.commits.append(len(messages))
+                self.request.sendall(encode_frame(Frame("RECEIPT", {"receipt-id": frame.headers["receipt"]})))
+            elif frame.command == "DISCONNECT":
+                self.request.sendall(encode_frame(Frame("RECEIPT", {"receipt-id": frame.headers["receipt"]})))
+                return
+
+
+class StubBroker(socketserver.ThreadingTCPServer):
+    """
+    Local broker recording the messages delivered and the size of each committed transaction
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubBrokerHandler)
+        self.delivered = []
+        self.commits = []
+        self.refuse_commits = False
+
+
+class TestStompSink(TestCase):
+
+    def setUp(self):
+        self.broker = StubBroker()
+        threading.Thread(target=self.broker.serve_forever, daemon=True).start()
+        self.client = StompClient(*self.broker.server_address, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.shutdown()
+        self.broker.server_close()
+
+    def test_instruments_batched_into_one_transaction(self):
+        sink = StompSink(self.client, "/queue/DataReady", linger=0.5)
+        instruments = ["WISH", "GEM", "MARI", "LET"]
+        with ThreadPoolExecutor(len(instruments)) as executor:
+            acknowledgements = list(
+                executor.map(lambda name: sink.submit(name, 1, 3, {
+                    "runs": [1, 2],
+                    "user_id": 0
+                }), instruments))
+
+        self.assertEqual([4], self.broker.commits)
+        self.assertEqual(1, len(set(acknowledgements)))
+        bodies = [json.loads(frame.body) for frame in self.broker.delivered]
+        self.assertEqual(sorted(instruments), sorted(body["instrument"] for body in bodies))
+        self.assertEqual({
+            "instrument": "WISH",
+            "runs": [1, 2],
+            "user_id": 0
+        }, next(body for body in bodies if body["instrument"] == "WISH"))
+        self.assertEqual("/queue/DataReady", self.broker.delivered[0].headers["destination"])
+        keys = {frame.headers["idempotency-key"] for frame in self.broker.delivered}
+        self.assertEqual({f"{name}-1-2" for name in instruments}, keys)
+
+    def test_batch_size_limit(self):
+        sink = StompSink(self.client, "/queue/DataReady", linger=5, batch_size=1)
+        sink.submit("WISH", 1, 2, {"runs": [1]})
+        sink.submit("WISH", 2, 3, {"runs": [2]})
+        self.assertEqual([1, 1], self.broker.commits)
+
+    def test_refused_commit_not_delivered(self):
+        sink = StompSink(self.client, "/queue/DataReady", linger=0)
+        self.broker.refuse_commits = True
+        with self.assertRaises(SubmissionError):
+            sink.submit("WISH", 1, 2, {"runs": [1]})
+        self.assertEqual([], self.broker.delivered)
+
+        # A new connection is made for the next batch
+        self.broker.refuse_commits = False
+        sink.submit("WISH", 1, 2, {"runs": [1]})
+        self.assertEqual(1, len(self.broker.delivered))
+
+    def test_broker_unreachable(self):
+        self.broker.shutdown()
+        self.broker.server_close()
+        sink = StompSink(self.client, "/queue/DataReady", linger=0)
+        with self.assertRaises(SinkUnavailable):
+            sink.submit("WISH", 1, 2, {"runs": [1]})
+
+
+class TestFanOutSink(TestCase):
+
+    def test_failed_sink_retried_alone(self):
+        """
+        Test that every sink is tried, and only the sink that failed is given the runs again
+        """
+        failing, working = Mock(), Mock()
+        failing.submit.side_effect = SinkUnavailable("down")
+        sink = FanOutSink([failing, working], ["stomp", "api"])
+        with self.assertRaises(SinkUnavailable):
+            sink.submit("WISH", 1, 2, {"runs": [1]})
+        working.submit.assert_called_once_with("WISH", 1, 2, {"runs": [1]})
+
+        with self.assertRaises(SinkUnavailable):
+            sink.submit("WISH", 1, 2, {"runs": [1]})
+        failing.submit.side_effect = None
+        acknowledgements = sink.submit("WISH", 1, 2, {"runs": [1]})
+        self.assertEqual(failing.submit.return_value, acknowledgements[0])
+        self.assertEqual(3, failing.submit.call_count)
+        working.submit.assert_called_once()
+
+        # Runs only part of which a sink has are submitted to it again
+        sink.submit("WISH", 1, 3, {"runs": [1, 2]})
+        self.assertEqual(2, working.submit.call_count)
+        sink.close()
+        failing.close.assert_called_once()
+
+    def test_acknowledgements_kept_in_ledger(self):
+        """
+        Test that a new process doesn't submit runs again to a sink that acknowledged them before it stopped
+        """
+        failing, working = Mock(), Mock()
+        failing.submit.side_effect = SinkUnavailable("down")
+        with tempfile.TemporaryDirectory() as directory:
+            ledger = SubmissionLedger(os.path.join(directory, "ledger.sqlite3"))
+            try:
+                with self.assertRaises(SinkUnavailable):
+                    FanOutSink([failing, working], ["stomp", "api"], ledger).submit("WISH", 1, 2, {"runs": [1]})
+                failing.submit.side_effect = None
+                FanOutSink([failing, working], ["stomp", "api"], ledger).submit("WISH", 1, 2, {"runs": [1]})
+                working.submit.assert_called_once()
+                self.assertEqual([(1, 2)], ledger.ranges("stomp/WISH"))
+                # Runs acknowledged by all the sinks are recorded under the instrument by the monitor alone
+                self.assertEqual([], ledger.ranges("WISH"))
+            finally:
+                ledger.close()
+
+    def test_create_sink(self):
+        self.assertIsInstance(create_sink(names=["api"]), APISink)
+        self.assertEqual("http://stub:8000/api", str(create_sink(names=["api"], api_url="http://stub:8000/api")))
+        fan_out = create_sink(names=["api", "stomp"])
+        self.assertEqual([APISink, StompSink], [type(sink) for sink in fan_out.sinks])
+        with self.assertRaises(ValueError):
+            create_sink(names=["kafka"])
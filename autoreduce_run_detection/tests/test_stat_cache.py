@@ -0,0 +1,76 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the lastrun.txt stat cache
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+
+from autoreduce_run_detection.stat_cache import StatCache
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestStatCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.last_run_file = os.path.join(self.directory.name, "lastrun.txt")
+        self.cache_file = os.path.join(self.directory.name, "stat_cache.json")
+        self._write("WISH 00044733 0", 1_000_000_000)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, content, mtime_ns):
+        with open(self.last_run_file, mode='w', encoding="utf-8") as last_run:
+            last_run.write(content)
+        os.utime(self.last_run_file, ns=(mtime_ns, mtime_ns))
+
+    def test_unchanged_file_not_read_again(self):
+        cache = StatCache()
+        reader = Mock(return_value=['WISH', '00044733', '0'])
+        self.assertEqual(['WISH', '00044733', '0'], cache.read(self.last_run_file, reader))
+        self.assertEqual(['WISH', '00044733', '0'], cache.read(self.last_run_file, reader))
+        reader.assert_called_once()
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_changed_file_read_again(self):
+        cache = StatCache()
+        cache.read(self.last_run_file, Mock(return_value=['WISH', '00044733', '0']))
+        # Same size, only the modification time tells the files apart
+        self._write("WISH 00044734 0", 2_000_000_000)
+        reader = Mock(return_value=['WISH', '00044734', '0'])
+        self.assertEqual(['WISH', '00044734', '0'], cache.read(self.last_run_file, reader))
+        reader.assert_called_once()
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+    def test_persisted_between_invocations(self):
+        cache = StatCache()
+        cache.read(self.last_run_file, Mock(return_value=['WISH', '00044733', '0']))
+        cache.save(self.cache_file)
+
+        reader = Mock()
+        loaded = StatCache.load(self.cache_file)
+        self.assertEqual(['WISH', '00044733', '0'], loaded.read(self.last_run_file, reader))
+        reader.assert_not_called()
+
+    def test_save_skipped_when_unchanged(self):
+        StatCache().save(self.cache_file)
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_load_missing_or_corrupt(self):
+        self.assertEqual(0, StatCache.load(self.cache_file).hits)
+        with open(self.cache_file, mode='w', encoding="utf-8") as cache_file:
+            cache_file.write("{not json")
+        reader = Mock(return_value=['WISH', '00044733', '0'])
+        StatCache.load(self.cache_file).read(self.last_run_file, reader)
+        reader.assert_called_once()
+
+    def test_missing_file_raises(self):
+        with self.assertRaises(FileNotFoundError):
+            StatCache().read(os.path.join(self.directory.name, "missing.txt"), Mock())
@@ -0,0 +1,141 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the last runs state stores
+"""
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from autoreduce_run_detection.state import (CSVStateStore, SQLiteStateStore, open_state_store, read_last_runs,
+                                            write_last_runs)
+
+ROWS = [
+    ["WISH", "44733", "lastrun_wish.txt", "summary_wish.txt", "data_dir", ".nxs"],
+    ["GEM", "100", "lastrun_gem.txt", "summary_gem.txt", "data_dir", ".nxs"],
+]
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestCSVStateStore(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.csv_name = os.path.join(self.directory.name, "last_runs.csv")
+        write_last_runs(self.csv_name, ROWS)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_flush_writes_changes(self):
+        store = CSVStateStore(self.csv_name)
+        rows = store.load()
+        rows[1][1] = "101"
+        store.update(rows[1])
+        store.flush()
+        self.assertEqual("101", read_last_runs(self.csv_name)[1][1])
+        self.assertEqual(["last_runs.csv"], os.listdir(self.directory.name))
+
+    def test_flush_skipped_without_changes(self):
+        store = CSVStateStore(self.csv_name)
+        store.load()
+        with patch('autoreduce_run_detection.state.write_last_runs') as write_mock:
+            store.flush()
+        write_mock.assert_not_called()
+
+    def test_shared_flush_keeps_changes_of_other_processes(self):
+        first, second = CSVStateStore(self.csv_name, shared=True), CSVStateStore(self.csv_name, shared=True)
+        first_rows, second_rows = first.load(), second.load()
+        first_rows[0][1] = "44734"
+        first.update(first_rows[0])
+        first.flush()
+        second_rows[1][1] = "101"
+        second.update(second_rows[1])
+        second.flush()
+        self.assertEqual(["44734", "101"], [row[1] for row in read_last_runs(self.csv_name)])
+
+    def test_shared_remove_keeps_changes_of_other_processes(self):
+        first, second = CSVStateStore(self.csv_name, shared=True), CSVStateStore(self.csv_name, shared=True)
+        first.load()
+        second_rows = second.load()
+        first.remove("GEM")
+        first.flush()
+        second_rows[0][1] = "44734"
+        second.update(second_rows[0])
+        second.flush()
+        self.assertEqual([["WISH", "44734"]], [row[:2] for row in read_last_runs(self.csv_name)])
+
+    def test_failed_write_keeps_previous_file(self):
+        with patch('autoreduce_run_detection.state.os.replace', side_effect=OSError):
+            with self.assertRaises(OSError):
+                write_last_runs(self.csv_name, [])
+        self.assertEqual(ROWS, read_last_runs(self.csv_name))
+
+
+class TestSQLiteStateStore(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.csv_name = os.path.join(self.directory.name, "last_runs.csv")
+        self.database = os.path.join(self.directory.name, "last_runs.sqlite3")
+        write_last_runs(self.csv_name, ROWS)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_imports_csv(self):
+        store = SQLiteStateStore(self.database, import_csv=self.csv_name)
+        self.assertEqual(ROWS, store.load())
+        store.close()
+
+        # The CSV is only imported into an empty database
+        write_last_runs(self.csv_name, ROWS[:1])
+        store = SQLiteStateStore(self.database, import_csv=self.csv_name)
+        self.assertEqual(ROWS, store.load())
+        store.close()
+
+    def test_update_committed_per_instrument(self):
+        store = SQLiteStateStore(self.database, import_csv=self.csv_name)
+        store.update(["GEM", "105", "lastrun_gem.txt", "summary_gem.txt", "data_dir", ".nxs"])
+
+        # Visible to another connection straight away, without closing the store
+        with sqlite3.connect(self.database) as other:
+            self.assertEqual([("GEM", 105), ("WISH", 44733)],
+                             other.execute("SELECT instrument, last_run FROM last_runs ORDER BY instrument").fetchall())
+            self.assertEqual("wal", other.execute("PRAGMA journal_mode").fetchone()[0])
+        store.close()
+
+    def test_update_adds_instrument_last(self):
+        store = SQLiteStateStore(self.database, import_csv=self.csv_name)
+        store.update(["MARI", "5", "lastrun_mari.txt", "summary_mari.txt", "data_dir", ".nxs"])
+        self.assertEqual(["WISH", "GEM", "MARI"], [row[0] for row in store.load()])
+        store.close()
+
+    def test_remove(self):
+        store = SQLiteStateStore(self.database, import_csv=self.csv_name)
+        store.remove("WISH")
+        self.assertEqual(ROWS[1:], store.load())
+        store.close()
+
+
+class TestOpenStateStore(TestCase):
+
+    def test_csv_by_default(self):
+        self.assertIsInstance(open_state_store("last_runs.csv"), CSVStateStore)
+
+    @patch('autoreduce_run_detection.state.STATE_BACKEND', "sqlite")
+    def test_sqlite_next_to_csv(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = open_state_store(os.path.join(directory, "last_runs.csv"))
+            self.assertEqual(os.path.join(directory, "last_runs.sqlite3"), store.location)
+            store.close()
+
+    @patch('autoreduce_run_detection.state.STATE_BACKEND', "redis")
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            open_state_store("last_runs.csv")
@@ -0,0 +1,126 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the summary.txt tail reader
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from autoreduce_run_detection.summary import SummaryIndex, SummaryTail, parse_summary_line
+
+RECORD = "WIS{run}Smith,Smith,SmithCeAuSb2 MRSX ROT=15.05 s28-MAR-2019 09:14:23    34.3 {rb}\n"
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestSummaryTail(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.summary_file = os.path.join(self.directory.name, "summary.txt")
+        self._append(RECORD.format(run=44731, rb=1820461))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _append(self, content, mode='a'):
+        with open(self.summary_file, mode=mode, encoding="utf-8") as summary:
+            summary.write(content)
+
+    def test_parse_summary_line(self):
+        self.assertEqual({
+            "run_number": "44731",
+            "rb_number": "1820461",
+            "title": "CeAuSb2 MRSX ROT=15.05 s"
+        }, parse_summary_line(RECORD.format(run=44731, rb=1820461)))
+        self.assertIsNone(parse_summary_line(""))
+        self.assertIsNone(parse_summary_line("not a run record"))
+
+    def test_only_appended_records_read(self):
+        tail = SummaryTail(self.summary_file)
+        tail.update()
+        offset = tail.offset
+        self._append(RECORD.format(run=44732, rb=1820462))
+        with patch('autoreduce_run_detection.summary.parse_summary_line', wraps=parse_summary_line) as parse_mock:
+            tail.update()
+        parse_mock.assert_called_once()
+        self.assertGreater(tail.offset, offset)
+        self.assertEqual("1820462", tail.lookup(44732)["rb_number"])
+
+    def test_partial_record_left_for_next_update(self):
+        tail = SummaryTail(self.summary_file)
+        record = RECORD.format(run=44732, rb=1820462)
+        self._append(record[:30])
+        tail.update()
+        self.assertIsNone(tail.lookup(44732))
+        self._append(record[30:])
+        tail.update()
+        self.assertEqual("1820462", tail.lookup(44732)["rb_number"])
+
+    def test_rotation_read_from_start(self):
+        tail = SummaryTail(self.summary_file)
+        tail.update()
+        replacement = self.summary_file + ".new"
+        with open(replacement, mode='w', encoding="utf-8") as summary:
+            summary.write(RECORD.format(run="00001", rb=1900001))
+        os.replace(replacement, self.summary_file)
+        tail.update()
+        self.assertEqual("1900001", tail.lookup(1)["rb_number"])
+
+    def test_truncation_read_from_start(self):
+        tail = SummaryTail(self.summary_file)
+        tail.update()
+        self._append(RECORD.format(run="00002", rb=1900002)[:40], mode='w')
+        tail.update()
+        self.assertEqual(0, tail.offset)
+
+    @patch('autoreduce_run_detection.summary.SUMMARY_INDEX_SIZE', 2)
+    def test_index_bounded(self):
+        self._append("".join(RECORD.format(run=run, rb=1820461) for run in range(44732, 44735)))
+        tail = SummaryTail(self.summary_file)
+        tail.update()
+        self.assertEqual(["44733", "44734"], list(tail.runs))
+
+    def test_long_run_numbers_matched_by_last_digits(self):
+        tail = SummaryTail(self.summary_file)
+        tail.update()
+        self.assertEqual("1820461", tail.lookup(144731)["rb_number"])
+
+
+class TestSummaryIndex(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.summary_file = os.path.join(self.directory.name, "summary.txt")
+        self.location = os.path.join(self.directory.name, "summary_index.json")
+        with open(self.summary_file, mode='w', encoding="utf-8") as summary:
+            summary.write(RECORD.format(run=44731, rb=1820461) + RECORD.format(run=44732, rb=1820462))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_metadata_of_range(self):
+        index = SummaryIndex()
+        self.assertEqual(["44732"], list(index.metadata("WISH", self.summary_file, 44732, 44735)))
+
+    def test_missing_summary_file(self):
+        index = SummaryIndex()
+        self.assertEqual({}, index.metadata("WISH", os.path.join(self.directory.name, "missing"), 1, 2))
+
+    def test_persisted_between_invocations(self):
+        index = SummaryIndex()
+        index.metadata("WISH", self.summary_file, 44731, 44732)
+        index.save(self.location)
+
+        loaded = SummaryIndex.load(self.location)
+        with patch('autoreduce_run_detection.summary.open') as open_mock:
+            self.assertEqual("1820462", loaded.metadata("WISH", self.summary_file, 44732, 44733)["44732"]["rb_number"])
+        open_mock.assert_not_called()
+
+    def test_save_skipped_when_unchanged(self):
+        SummaryIndex().save(self.location)
+        self.assertFalse(os.path.exists(self.location))
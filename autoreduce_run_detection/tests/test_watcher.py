@@ -0,0 +1,62 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the inotify lastrun.txt watcher
+"""
+import os
+import sys
+import tempfile
+from unittest import TestCase, skipUnless
+
+from autoreduce_run_detection.watcher import LastRunWatcher
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+@skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+class TestLastRunWatcher(TestCase):
+
+    def setUp(self):
+        self.archive = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.watcher = LastRunWatcher()
+        self.last_run_files = {}
+        for instrument in ["WISH", "GEM"]:
+            logs = os.path.join(self.archive.name, f"NDX{instrument}", "Instrument", "logs")
+            os.makedirs(logs)
+            self.last_run_files[instrument] = os.path.join(logs, "lastrun.txt")
+            self._write(instrument, f"{instrument} 100 0")
+            self.assertTrue(self.watcher.watch(instrument, self.last_run_files[instrument]))
+
+    def tearDown(self):
+        self.watcher.close()
+        self.archive.cleanup()
+
+    def _write(self, instrument, content):
+        with open(self.last_run_files[instrument], mode='w', encoding="utf-8") as last_run:
+            last_run.write(content)
+
+    def test_no_changes(self):
+        self.assertEqual(set(), self.watcher.wait_for_changes(0.05))
+
+    def test_rewritten_in_place(self):
+        self._write("WISH", "WISH 101 0")
+        self.assertEqual({"WISH"}, self.watcher.wait_for_changes(1))
+        self.assertEqual(set(), self.watcher.wait_for_changes(0.05))
+
+    def test_replaced_by_rename(self):
+        temporary = self.last_run_files["GEM"] + ".tmp"
+        with open(temporary, mode='w', encoding="utf-8") as last_run:
+            last_run.write("GEM 101 0")
+        self.assertEqual(set(), self.watcher.wait_for_changes(0.05))
+        os.replace(temporary, self.last_run_files["GEM"])
+        self.assertEqual({"GEM"}, self.watcher.wait_for_changes(1))
+
+    def test_other_files_ignored(self):
+        with open(os.path.dirname(self.last_run_files["WISH"]) + "/other.txt", mode='w', encoding="utf-8") as other:
+            other.write("not a last run")
+        self.assertEqual(set(), self.watcher.wait_for_changes(0.05))
+
+    def test_missing_directory(self):
+        self.assertFalse(self.watcher.watch("MARI", os.path.join(self.archive.name, "NDXMARI", "lastrun.txt")))
@@ -0,0 +1,79 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Unit tests for the workers instruments are polled on
+"""
+import threading
+import time
+from unittest import TestCase
+
+from autoreduce_run_detection.workers import PollWorkers
+
+
+# pylint:disable=too-few-public-methods,missing-function-docstring
+class TestPollWorkers(TestCase):
+
+    def setUp(self):
+        self.workers = PollWorkers(4)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.workers.shutdown()
+
+    def test_outcomes(self):
+        """
+        Test that the return value or exception of each call is returned by its key
+        """
+
+        def fail():
+            raise ValueError("unreadable")
+
+        outcomes = self.workers.call_with_deadlines({0: ("WISH", lambda: "44733"), 1: ("GEM", fail)}, 1)
+        self.assertEqual("44733", outcomes[0])
+        self.assertIsInstance(outcomes[1], ValueError)
+        self.assertFalse(self.workers.busy("WISH"))
+
+    def test_hung_instrument_skipped_until_it_returns(self):
+        """
+        Test that an instrument stuck past its deadline holds on to one thread and isn't called again until it returns
+        """
+        calls = []
+        threads = threading.active_count()
+
+        def hang():
+            calls.append("GEM")
+            self.release.wait(5)
+            return "100"
+
+        for _ in range(20):
+            outcomes = self.workers.call_with_deadlines({0: ("GEM", hang), 1: ("WISH", lambda: "44733")}, 0.05)
+            self.assertIsInstance(outcomes[0], TimeoutError)
+            self.assertEqual("44733", outcomes[1])
+        self.assertEqual(["GEM"], calls)
+        self.assertTrue(self.workers.busy("GEM"))
+        self.assertLessEqual(threading.active_count(), threads + 4)
+
+        self.release.set()
+        for _ in range(100):
+            if not self.workers.busy("GEM"):
+                break
+            time.sleep(0.01)
+        self.assertEqual({0: "100"}, self.workers.call_with_deadlines({0: ("GEM", hang)}, 1))
+
+    def test_queued_calls_cancelled(self):
+        """
+        Test that calls queued behind hung workers are cancelled once their deadline has passed
+        """
+        workers = PollWorkers(1)
+        try:
+            calls = {0: ("GEM", lambda: self.release.wait(5)), 1: ("WISH", lambda: "44733")}
+            outcomes = workers.call_with_deadlines(calls, 0.05)
+            self.assertIsInstance(outcomes[1], TimeoutError)
+            self.release.set()
+            self.assertEqual({1: "44733"}, workers.call_with_deadlines({1: calls[1]}, 1))
+        finally:
+            workers.shutdown()
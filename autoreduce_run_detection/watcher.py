@@ -0,0 +1,133 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Event driven detection of changes to the instruments' lastrun.txt using Linux inotify.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+from typing import Dict, Set
+
+LOGGING = logging.getLogger(__package__)
+
+# Flags from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# A lastrun.txt is either rewritten in place (closed after writing) or replaced by a rename
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class LastRunWatcher:
+    """
+    Watches the log directories holding the instruments' lastrun.txt and
+    reports which instruments have had their lastrun.txt written. Watching
+    the directory rather than the file also catches a lastrun.txt that is
+    replaced by a rename.
+
+    Remote writes to NFS/SMB mounts do not generate events, so instruments
+    are still expected to be polled at a low frequency as a fallback.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "Unable to initialise inotify")
+        # watch descriptor -> {file name in the directory: instruments}
+        self._watches: Dict[int, Dict[str, Set[str]]] = {}
+        self._directories: Dict[str, int] = {}
+        self._unwatchable: Set[str] = set()
+
+    def watch(self, instrument: str, last_run_file: str) -> bool:
+        """
+        Start watching the lastrun.txt of an instrument
+
+        Args:
+            instrument: Name of the instrument
+            last_run_file: Location of the instrument's lastrun.txt
+        Returns:
+            False if the directory could not be watched, in which case the
+            instrument is only picked up by the fallback poll
+        """
+        directory, file_name = os.path.split(os.path.abspath(last_run_file))
+        wd = self._directories.get(directory)
+        if wd is None:
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                if directory not in self._unwatchable:
+                    LOGGING.warning("Unable to watch %s for instrument %s: %s", directory, instrument,
+                                    os.strerror(ctypes.get_errno()))
+                    self._unwatchable.add(directory)
+                return False
+            self._unwatchable.discard(directory)
+            self._directories[directory] = wd
+            self._watches[wd] = {}
+        self._watches[wd].setdefault(file_name, set()).add(instrument)
+        return True
+
+    def wait_for_changes(self, timeout: float) -> Set[str]:
+        """
+        Wait up to `timeout` seconds for any watched lastrun.txt to be written
+
+        Returns:
+            Names of the instruments whose lastrun.txt has been written, empty if none
+        """
+        readable, _, _ = select.select([self._fd], [], [], max(0.0, timeout))
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            changed |= self._parse_events(buffer)
+        return changed
+
+    def _parse_events(self, buffer: bytes) -> Set[str]:
+        changed = set()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, treat every instrument as changed
+                for files in self._watches.values():
+                    for instruments in files.values():
+                        changed |= instruments
+            elif mask & IN_IGNORED:
+                # The directory has gone, e.g. the mount was removed
+                files = self._watches.pop(wd, {})
+                self._directories = {path: other for path, other in self._directories.items() if other != wd}
+                for instruments in files.values():
+                    LOGGING.warning("No longer watching lastrun.txt of %s", ", ".join(sorted(instruments)))
+            else:
+                changed |= self._watches.get(wd, {}).get(name, set())
+        return changed
+
+    def close(self):
+        """
+        Stop watching and release the inotify instance
+        """
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
@@ -0,0 +1,141 @@
+# ##################################################################################### #
+# ISIS File Polling Repository : https://github.com/ISISSoftwareServices/ISISFilePolling
+#
+# Copyright &copy; 2020 ISIS Rutherford Appleton Laboratory UKRI
+# ##################################################################################### #
+"""
+Worker threads the instruments are polled on, kept between detection cycles.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Callable, Dict, Hashable, List, Tuple
+
+from autoreduce_run_detection.settings import POLL_WORKERS
+
+
+class PollWorkers:
+    """
+    Pool of daemon threads the lastrun.txt reads and submissions are run on.
+    Threads are started as calls are submitted, up to `workers`, and reused
+    between cycles.
+
+    A call stuck on a hung mount keeps its thread until it returns, and its
+    instrument is busy until then so it is skipped rather than given another
+    thread, or submitting the same runs again while the first submission is
+    still in flight. As the threads are daemon threads, an invocation that
+    exits with a call still stuck is not held up by it, unlike with a
+    ThreadPoolExecutor whose threads are joined at exit.
+    """
+
+    def __init__(self, workers: int = POLL_WORKERS):
+        self.workers = max(1, workers)
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._threads: List[threading.Thread] = []
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        # instrument -> number of its calls that are running
+        self._busy: Dict[str, int] = {}
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as err:  # pylint:disable=broad-except
+                    future.set_exception(err)
+            self._idle.release()
+
+    def submit(self, func: Callable, *args) -> Future:
+        """
+        Run a call on one of the threads, starting another if none is idle
+
+        Returns:
+            The future of the call, which can be cancelled until it starts
+        """
+        future: Future = Future()
+        self._queue.put((future, func, args))
+        with self._lock:
+            # An idle thread takes the call, its permit is given back once it is idle again
+            idle = self._idle.acquire(blocking=False)  # pylint:disable=consider-using-with
+            if not idle and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"poll-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def busy(self, instrument: str) -> bool:
+        """
+        Whether a call made for the instrument is still running, e.g. from a previous cycle
+        """
+        with self._lock:
+            return instrument in self._busy
+
+    def _tracked(self, instrument: str, func: Callable[[], object], started: Dict[Hashable, float], key: Hashable):
+        with self._lock:
+            self._busy[instrument] = self._busy.get(instrument, 0) + 1
+        started[key] = time.monotonic()
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self._busy[instrument] -= 1
+                if not self._busy[instrument]:
+                    del self._busy[instrument]
+
+    def call_with_deadlines(self, calls: Dict[Hashable, Tuple[str, Callable[[], object]]],
+                            timeout: float) -> Dict[Hashable, object]:
+        """
+        Run each call and wait for it for at most `timeout` seconds from the
+        moment it starts. Calls still queued behind busy workers when the
+        deadline passes are cancelled, and calls made for an instrument that
+        is still busy are not made.
+
+        Args:
+            calls: The instrument each call is made for and the call, keyed by an identifier, usually the row index
+            timeout: Deadline in seconds given to each call
+        Returns:
+            The return value of each call keyed by identifier, or the exception
+            it raised, or a TimeoutError if it missed its deadline or wasn't made
+        """
+        phase_start = time.monotonic()
+        started: Dict[Hashable, float] = {}
+        outcomes: Dict[Hashable, object] = {
+            key: TimeoutError(f"Skipping {instrument}, its previous call has not returned yet")
+            for key, (instrument, _) in calls.items() if self.busy(instrument)
+        }
+        futures: Dict[Future, Hashable] = {
+            self.submit(self._tracked, *calls[key], started, key): key
+            for key in calls if key not in outcomes
+        }
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            deadlines = {future: started.get(futures[future], phase_start) + timeout for future in pending}
+            for future in [future for future in pending if deadlines[future] <= now]:
+                future.cancel()
+                outcomes[futures[future]] = TimeoutError(f"Deadline of {timeout}s exceeded")
+                pending.discard(future)
+            if not pending:
+                break
+            done, pending = wait(pending,
+                                 timeout=min(deadlines[future] for future in pending) - now,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                outcomes[futures[future]] = error if error is not None else future.result()
+        return outcomes
+
+    def shutdown(self):
+        """
+        Stop the idle threads, and the others once their calls return, without waiting for them
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)